@@ -0,0 +1,27 @@
+#!/usr/bin/env python
+
+# Writes the annotated genbank for an ISMapper typing result from the
+# GFF3 of its hits (<sample>_<query>_annotated.gff) and the reference it
+# was typed against, for when the whole annotated reference is needed.
+
+from argparse import ArgumentParser
+from create_typing_out import materialise_genbank
+
+def parse_args():
+    '''
+    Parse the input arguments, use -h for help.
+    '''
+
+    parser = ArgumentParser(description="Create the annotated genbank of an ISMapper typing result")
+    parser.add_argument('--gff', type=str, required=True, help='GFF3 of hits written by ISMapper (_annotated.gff)')
+    parser.add_argument('--ref', type=str, required=True, help='reference genbank the sample was typed against')
+    parser.add_argument('--output', type=str, required=True, help='name for output genbank')
+    return parser.parse_args()
+
+def main():
+
+    args = parse_args()
+    materialise_genbank(args.gff, args.ref, args.output)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+# A small banded local aligner for checking the sequence between the ends
+# of a known hit against the IS query, without running BLAST.
+#
+# Shared words (like a BLAST seed) between the two sequences give the
+# diagonal the alignment lies on, and Smith-Waterman is then run only
+# within a band around it. The cells on each anti-diagonal of the band
+# don't depend on each other, so each anti-diagonal is worked out at once
+# with NumPy. The number of matches and the length of the alignment are
+# carried along with the score, so identity and coverage are known without
+# a traceback. Scores follow the blastn (megablast) defaults doubled to
+# integers: match 1, mismatch -2, linear gap 2.5.
+
+import numpy as np
+
+MATCH = 2
+MISMATCH = -4
+GAP = 5
+# Length of the words used to find the diagonal of the alignment
+WORD_SIZE = 11
+# Extra diagonals either side of the seeds to include in the band
+BAND_PADDING = 32
+
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+def encode(sequence, unknown):
+    '''
+    Encodes a sequence as an array of codes (A, C, G, T are 0-3),
+    with any other base given the code unknown.
+    '''
+
+    codes = np.full(len(sequence), unknown, dtype=np.int8)
+    array = np.frombuffer(sequence.upper().encode('ascii'), dtype=np.uint8)
+    for code, base in enumerate('ACGT'):
+        codes[array == ord(base)] = code
+    return codes
+
+def reverse_complement(sequence):
+    return ''.join(COMPLEMENT.get(base, 'N') for base in reversed(sequence.upper()))
+
+def seed_diagonals(subject, query):
+    '''
+    Returns the diagonals (query position - subject position)
+    of the words shared by the two sequences.
+    '''
+
+    words = {}
+    for j in range(len(query) - WORD_SIZE + 1):
+        words.setdefault(query[j:j + WORD_SIZE], []).append(j)
+    diagonals = []
+    for i in range(len(subject) - WORD_SIZE + 1):
+        for j in words.get(subject[i:i + WORD_SIZE], []):
+            diagonals.append(j - i)
+    return np.array(diagonals, dtype=np.int64)
+
+def band(diagonals, subject_length, query_length):
+    '''
+    Returns the lowest and highest diagonal of the band, covering the
+    seeds near the most common diagonal.
+    '''
+
+    most_common = np.bincount(diagonals - diagonals.min()).argmax() + diagonals.min()
+    spread = int(0.1 * min(subject_length, query_length)) + BAND_PADDING
+    near = diagonals[np.abs(diagonals - most_common) <= spread]
+    return near.min() - BAND_PADDING, near.max() + BAND_PADDING
+
+def banded_local_align(subject, query, low, high):
+    '''
+    Smith-Waterman local alignment of subject (rows) against query
+    (columns), only scoring cells with low <= column - row <= high.
+    Returns the score, number of matches and length (in columns, counting
+    gaps) of the best alignment.
+    '''
+
+    n = len(subject)
+    m = len(query)
+    s_codes = encode(subject, 4)
+    q_codes = encode(query, 5)
+    # Score, matches and length for the last two anti-diagonals,
+    # indexed by row
+    score_1, score_2 = np.zeros(n + 1, dtype=np.int32), np.zeros(n + 1, dtype=np.int32)
+    matches_1, matches_2 = np.zeros(n + 1, dtype=np.int32), np.zeros(n + 1, dtype=np.int32)
+    length_1, length_2 = np.zeros(n + 1, dtype=np.int32), np.zeros(n + 1, dtype=np.int32)
+    best = (0, 0, 0)
+    for t in range(2, n + m + 1):
+        # Rows of the cells on this anti-diagonal (row + column = t) in the band
+        first = max(1, t - m, -((high - t) // 2))
+        last = min(n, t - 1, (t - low) // 2)
+        score_0 = np.zeros(n + 1, dtype=np.int32)
+        matches_0 = np.zeros(n + 1, dtype=np.int32)
+        length_0 = np.zeros(n + 1, dtype=np.int32)
+        if first <= last:
+            same = s_codes[first - 1:last] == q_codes[t - last - 1:t - first][::-1]
+            diagonal = score_2[first - 1:last] + np.where(same, MATCH, MISMATCH)
+            up = score_1[first - 1:last] - GAP
+            left = score_1[first:last + 1] - GAP
+            score = np.maximum(np.maximum(diagonal, up), np.maximum(left, 0))
+            # Carry the matches and length of the chosen cell
+            from_diagonal = score == diagonal
+            from_up = ~from_diagonal & (score == up)
+            matches = np.where(from_diagonal, matches_2[first - 1:last] + same, np.where(from_up, matches_1[first - 1:last], matches_1[first:last + 1]))
+            length = np.where(from_diagonal, length_2[first - 1:last], np.where(from_up, length_1[first - 1:last], length_1[first:last + 1])) + 1
+            # A score of 0 starts a new alignment
+            matches[score == 0] = 0
+            length[score == 0] = 0
+            score_0[first:last + 1] = score
+            matches_0[first:last + 1] = matches
+            length_0[first:last + 1] = length
+            top = score.argmax()
+            if score[top] > best[0]:
+                best = (int(score[top]), int(matches[top]), int(length[top]))
+        score_2, score_1 = score_1, score_0
+        matches_2, matches_1 = matches_1, matches_0
+        length_2, length_1 = length_1, length_0
+    return best
+
+def align_to_query(sequence, query):
+    '''
+    Aligns a sequence (either strand) to the query.
+    Returns the percent identity and the alignment length as a percent
+    of the query length, for the best alignment, as BLAST reports them
+    for the top hit. Returns an empty list if the sequences don't share
+    a word of WORD_SIZE.
+    '''
+
+    sequence = str(sequence).upper()
+    query = str(query).upper()
+    # Align the strand sharing the most words with the query
+    strands = []
+    for strand in [sequence, reverse_complement(sequence)]:
+        strands.append((seed_diagonals(strand, query), strand))
+    diagonals, strand = max(strands, key=lambda seeds: len(seeds[0]))
+    if len(diagonals) == 0:
+        return []
+    low, high = band(diagonals, len(strand), len(query))
+    score, matches, length = banded_local_align(strand, query, low, high)
+    if length == 0:
+        return []
+    return ['%.3f' % (100.0 * matches / length), 100.0 * length / len(query)]
@@ -12,99 +12,169 @@ from Bio.Blast.Applications import NcbiblastnCommandline
 from operator import itemgetter
 import os, sys, re, collections, operator
 from collections import OrderedDict
+import numpy as np
+from profiling import start_profiling
+from compiled_table import ANNOTATION_ROWS, CALL_CODES, CALL_SYMBOLS, read_sparse_table, sparse_rows
+
+# Number of isolate rows converted and written out at a time
+ROW_BLOCK = 1000
 
 def parse_args():
 
     parser = ArgumentParser(description="Create a binary table from the compiled table for ISMapper")
-    parser.add_argument('--table', type=str, required=True, help='input table')
+    parser.add_argument('--table', type=str, required=True, help='input table (compiled table text file, or .npz from compiled_table.py --sparse)')
     parser.add_argument('--output', type=str, required=True, help='output binary table')
     parser.add_argument('--imprecise', type=str, required=False, default='1', help='Binary value for imprecise (*) hit (can be 1, 0 or 0.5), default is 1')
     parser.add_argument('--question', type=str, required=False, default='0', help='Binary value for questionable (?) hit (can be 1, 0 or 0.5), default is 0')
     parser.add_argument('--delimiter', type=str, required=False, default=',', help='delimiter for output file (default is , can also be t for tab)')
+    parser.add_argument('--packed', action='store_true', required=False, help='Write the binary table as bit-packed matrices (.npz) of confident and uncertain calls instead of text, for distance_table.py')
+    parser.add_argument('--profile', type=str, required=False, help='Directory to save profiling information (cProfile stats and memory use) to')
 
     return parser.parse_args()
 
+def read_text_table(table_file):
+    '''
+    Reads a compiled table in text format.
+    Returns the position headers, the isolate names and an int8
+    matrix of CALL_CODES (one row per isolate, one column per position).
+    The reference row and the flanking gene rows are not included.
+    '''
+
+    isolates = []
+    rows = []
+    with open(table_file) as table_in:
+        header_info = table_in.readline().strip().split('\t')
+        # Just want to record positions
+        positions = [element for element in header_info if 'isolate' not in element]
+        # Ignore the reference isolate for the time being as it's wrong
+        table_in.readline()
+        for line in table_in:
+            info = line.strip().split('\t')
+            # If we're at flanking genes (end of table), don't include this information
+            if info[0] in ANNOTATION_ROWS:
+                continue
+            isolates.append(info[0])
+            rows.append(np.array([CALL_CODES[call] for call in info[1:]], dtype=np.int8))
+    if len(rows) != 0:
+        calls = np.vstack(rows)
+    else:
+        calls = np.zeros((0, len(positions)), dtype=np.int8)
+    return positions, isolates, calls
+
+def call_counts(calls, code):
+    '''
+    Counts the occurance of a call code in each column of the matrix.
+    '''
+
+    return (calls == code).sum(axis=0)
+
+def value_table(conf_value, imp_value, quest_value, imprecise, question):
+    '''
+    Takes the per position counts of +, * and ? calls.
+    Returns an array of output values with one row per position,
+    indexed by call code.
+    If there are more isolates with a + or * at a position than
+    with a ?, then ? is marked as a 1 (confident hit) at that position,
+    otherwise the user specified values are used.
+    '''
+
+    values = np.empty((len(conf_value), len(CALL_SYMBOLS)), dtype=object)
+    values[:, CALL_CODES['-']] = '0'
+    values[:, CALL_CODES['+']] = '1'
+    values[:, CALL_CODES['*']] = imprecise
+    values[:, CALL_CODES['?']] = question
+    present = conf_value + imp_value
+    promote = (present != 0) & (quest_value < present)
+    values[promote, CALL_CODES['*']] = '1'
+    values[promote, CALL_CODES['?']] = '1'
+    return values
+
+def write_packed_table(output, positions, isolates, values, get_rows):
+    '''
+    Writes the binary table as a compressed .npz file of two bit-packed
+    matrices (one row per isolate, one bit per position, packed with
+    numpy.packbits along each row): confident, for calls with a binary
+    value of 1, and uncertain, for the other * and ? calls (those
+    given a value of 0 or 0.5 by --imprecise and --question).
+    The isolate names, position headers and the unpacked shape are
+    stored as separate arrays.
+    '''
+
+    columns = np.arange(len(positions))
+    confident = []
+    uncertain = []
+    for start in range(0, len(isolates), ROW_BLOCK):
+        stop = min(start + ROW_BLOCK, len(isolates))
+        codes = get_rows(start, stop)
+        block_confident = values[columns, codes] == '1'
+        confident.append(np.packbits(block_confident, axis=1))
+        uncertain.append(np.packbits((codes != CALL_CODES['-']) & ~block_confident, axis=1))
+    width = (len(positions) + 7) // 8
+    with open(output, 'wb') as out:
+        np.savez_compressed(out,
+            confident=np.vstack(confident) if confident else np.zeros((0, width), dtype=np.uint8),
+            uncertain=np.vstack(uncertain) if uncertain else np.zeros((0, width), dtype=np.uint8),
+            shape=np.array([len(isolates), len(positions)]),
+            isolates=np.array(isolates),
+            positions=np.array(positions))
+
+def read_packed_table(packed_file):
+    '''
+    Reads a binary table written by write_packed_table.
+    Returns a dictionary of the stored arrays.
+    '''
+
+    with np.load(packed_file) as table:
+        return dict((key, table[key]) for key in table.files)
+
 def main():
 
     args = parse_args()
+    start_profiling(args.profile, 'binary_table')
 
-    # Open the output file for writing
-    out_file = open(args.output, 'w')
     # Check to make sure the delmiter is correct
     if args.delimiter != ',' and args.delimiter != 't':
         print 'Delimiter type unknown. Must be , or t.'
         # Exit the script if it's not
         sys.exit()
+    if args.delimiter == 't':
+        delimiter = '\t'
+    else:
+        delimiter = ','
+
+    # Read the sparse compiled table directly, the reference is the first row
+    # and is ignored for the time being as it's wrong
+    if args.table.endswith('.npz'):
+        table = read_sparse_table(args.table)
+        positions = list(table['positions'])
+        isolates = list(table['isolates'][1:])
+        first_entry = table['indptr'][1]
+        entry_columns = table['indices'][first_entry:]
+        entry_codes = table['data'][first_entry:]
+        counts = [np.bincount(entry_columns[entry_codes == CALL_CODES[symbol]], minlength=len(positions)) for symbol in ['+', '*', '?']]
+        get_rows = lambda start, stop: sparse_rows(table, start + 1, stop + 1)
+    else:
+        positions, isolates, calls = read_text_table(args.table)
+        counts = [call_counts(calls, CALL_CODES[symbol]) for symbol in ['+', '*', '?']]
+        get_rows = lambda start, stop: calls[start:stop]
 
-    header_names = {}
-    ordered_header_names = []
-    # Open up the compiled table and read through line by line
-    with open(args.table) as table_in:
-        header = 0
-        for line in table_in:
-            # Get the header information, append to dictionary and list
-            if header == 0:
-                header_info = line.strip().split('\t')
-                for element in header_info:
-                    header_names[element] = []
-                    # Just want to record positions
-                    if 'isolate' not in element:
-                        ordered_header_names.append(element)
-                # Write the header to the output file
-                if args.delimiter == 't':
-                    out_file.write(line)
-                elif args.delimiter == ',':
-                    info = line.strip().split('\t')
-                    out_file.write(','.join(info) + '\n')
-                # Increment header as we're done with header now
-                header += 1
-            elif header == 1:
-                # Ignore the reference isolate for the time being as it's wrong
-                header += 1
-            # If we're at flanking genes (end of table), don't include this information
-            elif 'left' in line or 'right' in line:
-                pass
-            # Otherwise add +, *, ? or - values to correct position header
-            else:
-                info = line.strip().split('\t')
-                # Gather list of isolate names
-                header_names['isolate'].append(info[0])
-                for index in range(1, len(info)):
-                    header_names[ordered_header_names[index-1]].append(info[index])
     # For each position, count the occurance of + and *
     # Compare this to occurance of ?, want to make ? a 1 (confident hit)
     # if there are many other isolates with an IS at this position
-    for pos in ordered_header_names:
-        conf_value = header_names[pos].count('+')
-        imp_value = header_names[pos].count('*')
-        quest_value = header_names[pos].count('?')
-        # Repalce +, *, ? and - with correct values
-        if (conf_value + imp_value) != 0 and (float(quest_value) / float((conf_value + imp_value))) < 1:
-            # Then mark ? as 1's
-            header_names[pos] = [h.replace('+', '1') for h in header_names[pos]]
-            header_names[pos] = [h.replace('-', '0') for h in header_names[pos]]
-            header_names[pos] = [h.replace('*', '1') for h in header_names[pos]]
-            header_names[pos] = [h.replace('?', '1') for h in header_names[pos]]
-        else:
-            # Mark ? as user specificed value (default 0)
-            header_names[pos] = [h.replace('+', '1') for h in header_names[pos]]
-            header_names[pos] = [h.replace('-', '0') for h in header_names[pos]]
-            header_names[pos] = [h.replace('*', args.imprecise) for h in header_names[pos]]
-            header_names[pos] = [h.replace('?', args.question) for h in header_names[pos]]
-    # Should now have each position in binary format
-    # Can now loop through each row (determined by isolate) and print out
-    # Header has already been printed to file
-    for isolate_no in range(0, len(header_names['isolate'])):
-        # Get isolate name
-        row = [header_names['isolate'][isolate_no]]
-        for pos in ordered_header_names:
-            row.append(header_names[pos][isolate_no])
-        # Join together the row with the correct delimiter
-        if args.delimiter == 't':
-            out_file.write('\t'.join(row) + '\n')
-        elif args.delimiter == ',':
-            out_file.write(','.join(row) + '\n')
-    out_file.close()
+    values = value_table(counts[0], counts[1], counts[2], args.imprecise, args.question)
+    if args.packed:
+        write_packed_table(args.output, positions, isolates, values, get_rows)
+        return
+    columns = np.arange(len(positions))
+
+    # Write out the header, then each row (determined by isolate)
+    # in blocks of rows
+    with open(args.output, 'w') as out_file:
+        out_file.write(delimiter.join(['isolate'] + positions) + '\n')
+        for start in range(0, len(isolates), ROW_BLOCK):
+            stop = min(start + ROW_BLOCK, len(isolates))
+            block = values[columns, get_rows(start, stop)]
+            out_file.write(''.join(delimiter.join([isolate] + list(row)) + '\n' for isolate, row in zip(isolates[start:stop], block)))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
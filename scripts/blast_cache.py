@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# On-disk cache of BLAST results for ISMapper.
+#
+# Results are stored one file per search, keyed by a hash of the query
+# sequences, the contents of the fasta the BLAST database was built from
+# and the BLAST parameters. Query names are not part of the key, so the
+# same sequence found in different isolates (eg: a known IS site) is only
+# BLASTed once. The cache is bounded in size, with the least recently used
+# results removed first, and can be shared by concurrent jobs: results are
+# written to a temporary file and renamed into place, and only one job
+# prunes the cache at a time.
+
+import os, errno, fcntl, hashlib, tempfile
+from Bio import SeqIO
+from Bio.Blast.Applications import NcbiblastnCommandline
+
+# Default maximum size of the cache in MB
+DEFAULT_CACHE_SIZE = 100
+
+# key = (path, size, modification time), value = hash of the file contents
+_file_hashes = {}
+
+def file_hash(path):
+    '''
+    Returns the SHA1 hash of a file's contents.
+    Hashes are remembered for as long as the file is unchanged.
+    '''
+
+    info = os.stat(path)
+    file_key = (os.path.abspath(path), info.st_size, info.st_mtime)
+    if file_key not in _file_hashes:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as file_in:
+            for block in iter(lambda: file_in.read(1 << 20), b''):
+                sha.update(block)
+        _file_hashes[file_key] = sha.hexdigest()
+    return _file_hashes[file_key]
+
+class BlastCache(object):
+    def __init__(self, cache_dir, max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        # maximum size in bytes
+        self.max_size = max_size * 1024 * 1024
+        try:
+            os.makedirs(cache_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def key(self, query, database, parameters):
+        '''
+        Creates the cache key for a BLAST of the query fasta against the
+        database (the path to the fasta the database was built from),
+        using the given parameters.
+        '''
+
+        sha = hashlib.sha1()
+        for record in SeqIO.parse(query, 'fasta'):
+            sha.update(str(record.seq).upper().encode() + b'\n')
+        sha.update(file_hash(database).encode() + b'\n')
+        sha.update(parameters.encode())
+        return sha.hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + '.tsv')
+
+    def fetch(self, key, query, output):
+        '''
+        Writes the cached result for key to the output file, with the
+        query name set to the name of the current query.
+        Returns True if the result was in the cache, otherwise False.
+        '''
+
+        query_ids = [record.id for record in SeqIO.parse(query, 'fasta')]
+        try:
+            with open(self.entry_path(key)) as cached, open(output, 'w') as out:
+                for line in cached:
+                    info = line.split('\t')
+                    if len(query_ids) == 1:
+                        info[0] = query_ids[0]
+                    out.write('\t'.join(info))
+            # Mark the result as recently used
+            os.utime(self.entry_path(key), None)
+        except (IOError, OSError):
+            # Not cached, or removed by another job while we were reading it
+            return False
+        return True
+
+    def store(self, key, output):
+        '''
+        Adds the BLAST output file to the cache under key.
+        '''
+
+        handle, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(handle, 'w') as temp_file, open(output) as blast_out:
+            temp_file.write(blast_out.read())
+        os.rename(temp_path, self.entry_path(key))
+        self.prune()
+
+    def prune(self):
+        '''
+        Removes the least recently used results until the cache is
+        below its maximum size.
+        Skipped if another job is already pruning the cache.
+        '''
+
+        with open(os.path.join(self.cache_dir, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            entries = []
+            total_size = 0
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith('.tsv'):
+                    continue
+                try:
+                    info = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, name))
+                total_size += info.st_size
+            entries.sort()
+            for mtime, size, name in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+                total_size -= size
+
+def run_blastn(query, database, output, outfmt, cache=None, build_database=None):
+    '''
+    Perform a BLAST using the NCBI command line tools in BioPython,
+    reusing the result from the cache if there is one.
+    build_database is called with the database before BLASTing, so
+    that the database is only built when the result isn't cached.
+    '''
+
+    if cache is not None:
+        key = cache.key(query, database, 'blastn outfmt=' + outfmt)
+        if cache.fetch(key, query, output):
+            return
+    if build_database is not None:
+        build_database(database)
+    blastn_cline = NcbiblastnCommandline(query=query, db=database, outfmt=outfmt, out=output)
+    stdout, stderr = blastn_cline()
+    if cache is not None:
+        cache.store(key, output)
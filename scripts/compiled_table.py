@@ -8,11 +8,35 @@ from Bio import SeqFeature
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import generic_dna
-from Bio.Blast.Applications import NcbiblastnCommandline
 from operator import itemgetter
 import os, sys, re, collections, operator
 from collections import OrderedDict
+import numpy as np
 import time
+import tempfile
+import multiprocessing
+import heapq, shutil, itertools
+from blast_cache import BlastCache, DEFAULT_CACHE_SIZE, run_blastn
+from hit_records import TABLE_CALLS, read_hits
+from profiling import start_profiling
+
+# Codes used for the isolate calls in the sparse (.npz) compiled table.
+# '-' (absent) is 0 so it is never stored in the sparse matrix.
+CALL_SYMBOLS = ['-', '+', '*', '?']
+CALL_CODES = dict((symbol, code) for code, symbol in enumerate(CALL_SYMBOLS))
+# When an isolate has more than one call in a merged position,
+# the most confident one is kept
+CALL_PRIORITY = {'+': 3, '*': 2, '?': 1}
+# Number of shards of tables given to each process with --processes
+SHARDS_PER_PROCESS = 4
+# Rough sizes in memory used to fit the work to --max_memory: a hit
+# record waiting to be sorted, and a call in a row of the text table
+RECORD_BYTES = 200
+CELL_BYTES = 50
+# Largest number of sorted run files merged at once
+MAX_OPEN_RUNS = 256
+# Labels of the rows written after the isolate rows in the compiled table
+ANNOTATION_ROWS = ['orientation', 'left ID', 'left distance', 'left strand', 'left info', 'right ID', 'right distance', 'right strand', 'right info']
 
 class Position(object):
     def __init__(self, x, y, orientation, isolate_dict, left_feature, right_feature):
@@ -29,16 +53,22 @@ def parse_args():
 
     parser = ArgumentParser(description="Create a table of IS hits in all isolates for ISMapper")
     # Inputs
-    parser.add_argument('--tables', nargs='+', type=str, required=True, help='tables to compile')
+    parser.add_argument('--tables', nargs='+', type=str, required=True, help='tables to compile, either the _table.txt or the binary _table.hits files of each isolate')
     parser.add_argument('--reference_gbk', type=str, required=True, help='gbk file of reference to report closest genes')
     parser.add_argument('--seq', type=str, required=True, help='fasta file for insertion sequence looking for in reference')
     # Parameters for hits
     parser.add_argument('--gap', type=int, required=False, default=0, help='distance between regions to call overlapping')
+    parser.add_argument('--max_memory', type=int, required=False, help='Compile the table using about this much memory (in MB) however many isolates there are, by sorting the hits on disk. Merges hits the same way as --processes (which it replaces)')
+    parser.add_argument('--processes', type=int, required=False, default=1, help='Number of processes to read and merge the tables with (default 1). With more than 1, overlapping hits are merged in one pass after reading all tables, so the positions do not depend on the order or number of processes')
     parser.add_argument('--cds', nargs='+', type=str, required=False, default=['locus_tag', 'gene', 'product'], help='qualifiers to look for in reference genbank for CDS features')
     parser.add_argument('--trna', nargs='+', type=str, required=False, default=['locus_tag', 'product'], help='qualifiers to look for in reference genbank for tRNA features')
     parser.add_argument('--rrna', nargs='+', type=str, required=False, default=['locus_tag', 'product'], help='qualifiers to look for in reference genbank for rRNA features')
+    parser.add_argument('--blast_cache', type=str, required=False, help='Directory to cache BLAST results in, so they can be reused by later runs')
+    parser.add_argument('--blast_cache_size', type=int, required=False, default=DEFAULT_CACHE_SIZE, help='Maximum size of the BLAST cache in MB (default ' + str(DEFAULT_CACHE_SIZE) + ')')
     # Output parameters
     parser.add_argument('--output', type=str, required=True, help='name of output file')
+    parser.add_argument('--sparse', action='store_true', required=False, help='Write the compiled table as a sparse binary matrix (.npz) instead of a text table')
+    parser.add_argument('--profile', type=str, required=False, help='Directory to save profiling information (cProfile stats and memory use) to')
 
     return parser.parse_args()
 
@@ -154,28 +184,23 @@ def check_ranges(positions, range_to_check, gap, orientation):
 
     return False, False
 
-def get_ref_positions(reference, is_query, positions_list):
+def get_ref_positions(reference, is_query, positions_list, cache=None):
     '''
     Get the coordinates of known IS sites in the reference.
 
-    Takes the reference genbank, the IS query and the dictionary to add_argument
-    IS query positions into, as well as a dictionary to add orientations
-    of each of these positions.
-    Returns these positions and orientations, as well as the reference name
+    Takes the reference fasta, the IS query and the list to add
+    IS query positions into, as well as an optional BlastCache to
+    reuse the BLAST result from.
+    Returns these positions, as well as the reference name
     for file naming.
     '''
-    # Get the name of the IS query to create temp file
-    is_name = os.path.split(is_query)[1]
     ref_name = os.path.split(reference)[1]
-    blast_output = os.getcwd() + '/' + is_name + '_' + ref_name + '.tmp'
-
-    # Create a BLAST database of the reference if there isn't one already
-    # Should probably use this function - blast_db(reference)
-    if not os.path.exists(reference):
-        os.system('makeblastdb -in ' + reference + ' -dbtype nucl')
-    # Do the BLAST
-    blastn_cline = NcbiblastnCommandline(query=is_query, db=reference, outfmt="'6 qseqid qlen sacc pident length slen sstart send evalue bitscore qcovs'", out=blast_output)
-    stdout, stderr = blastn_cline()
+    handle, blast_output = tempfile.mkstemp(suffix='.tmp')
+    os.close(handle)
+
+    # Do the BLAST, creating a BLAST database of the reference if
+    # there isn't one already
+    run_blastn(is_query, reference, blast_output, "'6 qseqid qlen sacc pident length slen sstart send evalue bitscore qcovs'", cache=cache, build_database=blast_db)
     # Open the BLAST output and get IS query sites
     with open(blast_output) as out:
         for line in out:
@@ -197,6 +222,7 @@ def get_ref_positions(reference, is_query, positions_list):
                 #else:
                 #    orientation_dict[(min(x, y), max(x, y))] = 'F'
                 positions_list.append(new_pos)
+    os.remove(blast_output)
     return positions_list, ref_name
 
 def get_qualifiers(cds_qualifiers, trna_qualifiers, rrna_qualifiers, feature):
@@ -432,11 +458,461 @@ def final_ranges_check(positions, gap):
 
     return(final_positions)
 
+def call_symbol(call):
+    '''
+    Returns the symbol for a call in an isolate table:
+    ? if uncertain, * if imprecise or + if confident.
+    '''
+
+    if '?' in call:
+        return '?'
+    elif '*' in call:
+        return '*'
+    else:
+        return '+'
+
+# The symbol of each call code in the binary hit records
+TABLE_CALL_SYMBOLS = [call_symbol(call) for call in TABLE_CALLS]
+
+def isolate_name(result_file):
+    '''
+    Returns the isolate name of a _table.txt or _table.hits file.
+    '''
+
+    if result_file.endswith('_table.hits'):
+        return result_file[:-len('_table.hits')]
+    return result_file.split('_table.txt')[0]
+
+def table_hits(result_file):
+    '''
+    Yields the orientation, start, end and call symbol of each hit
+    in an isolate _table.txt file, or _table.hits file of binary hit
+    records (see hit_records.py), which are read without any parsing.
+    '''
+
+    if result_file.endswith('.hits'):
+        hits = read_hits(result_file)
+        starts = np.minimum(hits['x'], hits['y']).tolist()
+        ends = np.maximum(hits['x'], hits['y']).tolist()
+        symbols = [TABLE_CALL_SYMBOLS[code] for code in hits['call'].tolist()]
+        for hit in zip(hits['orientation'].tolist(), starts, ends, symbols):
+            yield hit
+        return
+    with open(result_file) as file_open:
+        # Skip the header
+        next(file_open, None)
+        for line in file_open:
+            # Check to make sure there were actually hits
+            if 'No hits found' in line or line.strip() == '':
+                continue
+            info = line.strip('\n').split('\t')
+            is_start = min(int(info[2]), int(info[3]))
+            is_end = max(int(info[3]), int(info[2]))
+            yield info[1], is_start, is_end, call_symbol(info[5])
+
+def parse_table(result_file):
+    '''
+    Reads the hits in an isolate _table.txt or _table.hits file.
+    Returns the isolate name and a Position for each hit.
+    '''
+
+    isolate = isolate_name(result_file)
+    positions = []
+    for orientation, is_start, is_end, symbol in table_hits(result_file):
+        positions.append(Position(is_start, is_end, orientation, {isolate: symbol}, None, None))
+    return isolate, positions
+
+def merge_calls(isolate_dict, other_dict):
+    '''
+    Adds the calls in other_dict to isolate_dict, keeping the
+    most confident call (see CALL_PRIORITY) for each isolate.
+    '''
+
+    for isolate, call in other_dict.items():
+        if isolate not in isolate_dict or CALL_PRIORITY[call] > CALL_PRIORITY[isolate_dict[isolate]]:
+            isolate_dict[isolate] = call
+
+def merge_positions(positions, gap):
+    '''
+    Merges positions of the same orientation that overlap or are
+    within gap of each other, including chains of positions that
+    only overlap through each other.
+    The result is the same however the positions are split up and
+    merged in parts, so shards of tables can be merged separately
+    and their results merged again.
+    Returns the merged positions, sorted by orientation and x.
+    '''
+
+    merged = []
+    for pos in sorted(positions, key=lambda pos: (pos.orientation, pos.x, pos.y)):
+        last = merged[-1] if merged else None
+        if last is not None and last.orientation == pos.orientation and pos.x <= last.y + gap:
+            last.y = max(last.y, pos.y)
+            merge_calls(last.isolate_dict, pos.isolate_dict)
+        else:
+            merged.append(Position(pos.x, pos.y, pos.orientation, dict(pos.isolate_dict), None, None))
+    return merged
+
+def merge_shard(shard):
+    '''
+    Reads a shard of tables and merges their hits, for a worker process.
+    Takes a tuple of the table files and the gap.
+    Returns the merged positions.
+    '''
+
+    result_files, gap = shard
+    positions = []
+    for result_file in result_files:
+        positions += parse_table(result_file)[1]
+    return merge_positions(positions, gap)
+
+def merge_tables(result_files, ref_positions, gap, processes):
+    '''
+    Reads the tables in shards, with each shard merged in a separate
+    process, and merges the positions of the shards together with
+    the reference positions.
+    Returns the merged positions.
+    '''
+
+    shard_size = max(1, -(-len(result_files) // (processes * SHARDS_PER_PROCESS)))
+    shards = [(result_files[i:i + shard_size], gap) for i in range(0, len(result_files), shard_size)]
+    merged = merge_positions(ref_positions, gap)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for shard_positions in pool.imap_unordered(merge_shard, shards):
+            merged = merge_positions(merged + shard_positions, gap)
+    finally:
+        pool.close()
+        pool.join()
+    return merged
+
+def position_label(pos):
+    '''
+    Returns the column header for a position, written in the
+    direction of the IS (y-x for reverse hits).
+    '''
+
+    if pos.orientation == 'F':
+        return str(pos.x) + '-' + str(pos.y)
+    else:
+        return str(pos.y) + '-' + str(pos.x)
+
+def annotation_values(pos):
+    '''
+    Returns the values for the orientation and flanking gene rows
+    of a position, in the order given by ANNOTATION_ROWS.
+    '''
+
+    return [pos.orientation, pos.left_feature[0], pos.left_feature[1], pos.left_feature[2][-1], str(pos.left_feature[2]),
+            pos.right_feature[0], pos.right_feature[1], pos.right_feature[2][-1], str(pos.right_feature[2])]
+
+def write_table(output, ref_name, list_of_isolates, list_of_positions):
+    '''
+    Writes the compiled table as tab delimited text, one row per
+    isolate (reference first) and one column per position, followed
+    by the orientation and flanking gene rows.
+    '''
+
+    with open(output, 'w') as out:
+        header = ['isolate']
+        for pos in list_of_positions:
+            header.append(position_label(pos))
+        out.write('\t'.join(header) + '\n')
+        # Add the values for the reference positions, then
+        # loop through each isolate and create each row
+        for isolate in [ref_name] + list_of_isolates:
+            row = [isolate]
+            for pos in list_of_positions:
+                row.append(pos.isolate_dict.get(isolate, '-'))
+            out.write('\t'.join(row) + '\n')
+        # Print orientation and flanking genes for each position
+        annotations = [annotation_values(pos) for pos in list_of_positions]
+        for index, label in enumerate(ANNOTATION_ROWS):
+            out.write('\t'.join([label] + [values[index] for values in annotations]) + '\n')
+
+def write_sparse_table(output, ref_name, list_of_isolates, list_of_positions):
+    '''
+    Writes the compiled table as a compressed .npz file.
+    The calls are stored as a CSR matrix of CALL_CODES (rows are
+    the reference followed by each isolate, columns are positions)
+    in the arrays data, indices, indptr and shape, so that
+    scipy.sparse.csr_matrix((data, indices, indptr), shape) rebuilds it.
+    Isolate names, position labels and coordinates, and the
+    annotation rows are stored as separate arrays.
+    '''
+
+    row_names = [ref_name] + list_of_isolates
+    row_index = dict((isolate, index) for index, isolate in enumerate(row_names))
+    rows = []
+    columns = []
+    codes = []
+    for column, pos in enumerate(list_of_positions):
+        for isolate, call in pos.isolate_dict.items():
+            rows.append(row_index[isolate])
+            columns.append(column)
+            codes.append(CALL_CODES[call])
+    rows = np.array(rows, dtype=np.int64)
+    columns = np.array(columns, dtype=np.int32)
+    # Order the entries by row, then by column within a row
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(len(row_names) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(row_names)))
+    save_sparse_table(output, row_names, list_of_positions, np.array(codes, dtype=np.int8)[order], columns[order], indptr)
+
+def save_sparse_table(output, row_names, list_of_positions, data, indices, indptr):
+    '''
+    Saves the CSR arrays of a compiled table, along with the isolate
+    names and position labels and annotations (see write_sparse_table).
+    '''
+
+    annotations = [annotation_values(pos) for pos in list_of_positions]
+    with open(output, 'wb') as out:
+        np.savez_compressed(out,
+            data=data,
+            indices=indices,
+            indptr=indptr,
+            shape=np.array([len(row_names), len(list_of_positions)]),
+            isolates=np.array(row_names),
+            reference=np.array(row_names[0]),
+            positions=np.array([position_label(pos) for pos in list_of_positions]),
+            x=np.array([pos.x for pos in list_of_positions], dtype=np.int64),
+            y=np.array([pos.y for pos in list_of_positions], dtype=np.int64),
+            orientation=np.array([pos.orientation for pos in list_of_positions]),
+            annotation_labels=np.array(ANNOTATION_ROWS),
+            annotations=np.array(annotations).reshape(len(list_of_positions), len(ANNOTATION_ROWS)).T)
+
+def table_records(result_files):
+    '''
+    Yields a (start, end, orientation, row, call code) record for each
+    hit in the isolate tables, where row is the row of the isolate in
+    the compiled table (the reference is row 0).
+    '''
+
+    for row, result_file in enumerate(result_files, 1):
+        for pos in parse_table(result_file)[1]:
+            for call in pos.isolate_dict.values():
+                yield (pos.x, pos.y, pos.orientation, row, CALL_CODES[call])
+
+def write_run(records, temp_dir):
+    '''
+    Writes sorted records to a run file in temp_dir.
+    Returns the name of the file.
+    '''
+
+    handle, run_file = tempfile.mkstemp(suffix='.run', dir=temp_dir)
+    with os.fdopen(handle, 'w') as out:
+        for record in records:
+            out.write('\t'.join(str(value) for value in record) + '\n')
+    return run_file
+
+def read_run(run_file):
+    '''
+    Yields the records in a run file written by write_run.
+    '''
+
+    with open(run_file) as run_in:
+        for line in run_in:
+            start, end, orientation, row, code = line.rstrip('\n').split('\t')
+            yield (int(start), int(end), orientation, int(row), int(code))
+
+def spill_sorted_runs(records, run_size, temp_dir):
+    '''
+    Sorts the records run_size at a time, writing each
+    sorted run to disk. Returns the run files.
+    '''
+
+    run_files = []
+    buffer = []
+    for record in records:
+        buffer.append(record)
+        if len(buffer) >= run_size:
+            buffer.sort()
+            run_files.append(write_run(buffer, temp_dir))
+            buffer = []
+    if len(buffer) != 0 or len(run_files) == 0:
+        buffer.sort()
+        run_files.append(write_run(buffer, temp_dir))
+    return run_files
+
+def merge_runs(run_files, temp_dir):
+    '''
+    Merges sorted run files, first merging them into larger runs if
+    there are more than MAX_OPEN_RUNS. Returns an iterator of the
+    records in sorted order.
+    '''
+
+    while len(run_files) > MAX_OPEN_RUNS:
+        merged_files = []
+        for i in range(0, len(run_files), MAX_OPEN_RUNS):
+            group = run_files[i:i + MAX_OPEN_RUNS]
+            merged_files.append(write_run(heapq.merge(*[read_run(run_file) for run_file in group]), temp_dir))
+            for run_file in group:
+                os.remove(run_file)
+        run_files = merged_files
+    return heapq.merge(*[read_run(run_file) for run_file in run_files])
+
+def sorted_positions(records, gap):
+    '''
+    Merges records sorted by start into positions, following the same
+    rules as merge_positions. Both orientations are merged in one pass,
+    so at most one position of each orientation is open at a time.
+    Yields (x, y, orientation, calls) in order of x then orientation,
+    where calls is a dictionary of row: call code.
+    '''
+
+    # key = orientation, value = [x, y, calls] of the open position
+    open_positions = {}
+    # closed positions waiting for open positions that may come before them
+    waiting = []
+    for start, end, orientation, row, code in records:
+        current = open_positions.get(orientation)
+        if current is not None and start <= current[1] + gap:
+            current[1] = max(current[1], end)
+        else:
+            if current is not None:
+                heapq.heappush(waiting, (current[0], orientation, current[1], current[2]))
+            current = [start, end, {}]
+            open_positions[orientation] = current
+        # The lowest code is the most confident call (see CALL_PRIORITY)
+        if row not in current[2] or code < current[2][row]:
+            current[2][row] = code
+        first_open = min((pos[0], pos_orientation) for pos_orientation, pos in open_positions.items())
+        while waiting and waiting[0][:2] < first_open:
+            x, pos_orientation, y, calls = heapq.heappop(waiting)
+            yield x, y, pos_orientation, calls
+    for orientation, pos in open_positions.items():
+        heapq.heappush(waiting, (pos[0], orientation, pos[1], pos[2]))
+    while waiting:
+        x, orientation, y, calls = heapq.heappop(waiting)
+        yield x, y, orientation, calls
+
+def spill_columns(positions, row_count, column_file, block_size):
+    '''
+    Writes the call codes of each position to column_file, one column
+    of row_count codes after another, block_size columns at a time.
+    Returns the positions, without their calls.
+    '''
+
+    list_of_positions = []
+    block = np.zeros((block_size, row_count), dtype=np.int8)
+    filled = 0
+    with open(column_file, 'wb') as out:
+        for x, y, orientation, calls in positions:
+            block[filled, list(calls.keys())] = list(calls.values())
+            filled += 1
+            list_of_positions.append(Position(x, y, orientation, None, None, None))
+            if filled == block_size:
+                block.tofile(out)
+                block[:] = 0
+                filled = 0
+        block[:filled].tofile(out)
+    return list_of_positions
+
+def column_rows(column_file, position_count, row_count, start, stop):
+    '''
+    Reads rows start to stop of the calls written by spill_columns
+    as a dense int8 matrix of CALL_CODES.
+    '''
+
+    if position_count == 0:
+        return np.zeros((stop - start, 0), dtype=np.int8)
+    columns = np.memmap(column_file, dtype=np.int8, mode='r', shape=(position_count, row_count))
+    return np.array(columns[:, start:stop].T)
+
+def external_compile(result_files, ref_positions, gap, max_memory, temp_dir):
+    '''
+    Merges the hits in the isolate tables into positions using about
+    max_memory MB. The hits are sorted on disk in runs, the runs are
+    merged into positions and the calls for each position are written
+    to disk in blocks of columns.
+    Returns the positions and a function returning a block of rows
+    (reference first) of call codes.
+    '''
+
+    budget = max_memory * 1024 * 1024
+    row_count = len(result_files) + 1
+    ref_records = [(pos.x, pos.y, pos.orientation, 0, CALL_CODES['+']) for pos in ref_positions]
+    run_files = spill_sorted_runs(itertools.chain(ref_records, table_records(result_files)), max(1, budget // RECORD_BYTES), temp_dir)
+    print 'Sorted hits into ' + str(len(run_files)) + ' runs'
+    column_file = os.path.join(temp_dir, 'columns.bin')
+    list_of_positions = spill_columns(sorted_positions(merge_runs(run_files, temp_dir), gap), row_count, column_file, max(1, budget // 2 // row_count))
+    get_rows = lambda start, stop: column_rows(column_file, len(list_of_positions), row_count, start, stop)
+    return list_of_positions, get_rows
+
+def row_block_size(max_memory, position_count):
+    '''
+    Returns the number of rows of a table with position_count
+    columns to write at a time, to use about max_memory MB.
+    '''
+
+    return max(1, max_memory * 1024 * 1024 // (max(1, position_count) * CELL_BYTES))
+
+def write_table_rows(output, row_names, list_of_positions, get_rows, block_size):
+    '''
+    Writes the compiled table as text, the same as write_table, taking
+    the calls from get_rows block_size rows at a time.
+    '''
+
+    symbols = np.array(CALL_SYMBOLS)
+    with open(output, 'w') as out:
+        out.write('\t'.join(['isolate'] + [position_label(pos) for pos in list_of_positions]) + '\n')
+        for start in range(0, len(row_names), block_size):
+            stop = min(start + block_size, len(row_names))
+            block = symbols[get_rows(start, stop)]
+            out.write(''.join('\t'.join([name] + list(row)) + '\n' for name, row in zip(row_names[start:stop], block)))
+        annotations = [annotation_values(pos) for pos in list_of_positions]
+        for index, label in enumerate(ANNOTATION_ROWS):
+            out.write('\t'.join([label] + [values[index] for values in annotations]) + '\n')
+
+def write_sparse_table_rows(output, row_names, list_of_positions, get_rows, block_size):
+    '''
+    Writes the compiled table as a .npz file, the same as
+    write_sparse_table, taking the calls from get_rows
+    block_size rows at a time.
+    '''
+
+    data = []
+    indices = []
+    counts = []
+    for start in range(0, len(row_names), block_size):
+        stop = min(start + block_size, len(row_names))
+        block = get_rows(start, stop)
+        block_rows, block_columns = np.nonzero(block)
+        data.append(block[block_rows, block_columns])
+        indices.append(block_columns.astype(np.int32))
+        counts.append(np.bincount(block_rows, minlength=stop - start))
+    indptr = np.zeros(len(row_names) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.concatenate(counts))
+    save_sparse_table(output, row_names, list_of_positions, np.concatenate(data).astype(np.int8), np.concatenate(indices), indptr)
+
+def read_sparse_table(sparse_file):
+    '''
+    Reads a compiled table written by write_sparse_table.
+    Returns a dictionary of the stored arrays.
+    '''
+
+    with np.load(sparse_file) as table:
+        return dict((key, table[key]) for key in table.files)
+
+def sparse_rows(table, start, stop):
+    '''
+    Expands rows start to stop of a sparse compiled table into a
+    dense int8 matrix of CALL_CODES.
+    '''
+
+    indptr = table['indptr']
+    block = np.zeros((stop - start, table['shape'][1]), dtype=np.int8)
+    first, last = indptr[start], indptr[stop]
+    block_rows = np.repeat(np.arange(stop - start), np.diff(indptr[start:stop + 1]))
+    block[block_rows, table['indices'][first:last]] = table['data'][first:last]
+    return block
+
 def main():
 
     start_time = time.time()
 
     args = parse_args()
+    start_profiling(args.profile, 'compiled_table')
 
     unique_results_files = list(OrderedDict.fromkeys(args.tables))
     list_of_isolates = []
@@ -453,38 +929,39 @@ def main():
     # Create a fasta file of the reference for BLAST
     print 'Creating fasta file and database of reference ...'
     gbk_to_fasta(args.reference_gbk, reference_fasta)
-    # Make a BLAST database
-    blast_db(reference_fasta)
+    if args.blast_cache:
+        blast_cache = BlastCache(args.blast_cache, args.blast_cache_size)
+    else:
+        blast_cache = None
     # Get the reference positions and orientations for this IS query
     print '\nGetting query positions in reference ...'
-    list_of_positions, ref_name = get_ref_positions(reference_fasta, args.seq, list_of_positions)
+    list_of_positions, ref_name = get_ref_positions(reference_fasta, args.seq, list_of_positions, blast_cache)
 
     elapsed_time = time.time() - start_time
     print 'Time taken: ' + str(elapsed_time)
     #print list_of_positions
     #print ref_name
-    # Loop through each table give to --tables
-    print 'Collating results files ...'
-    for result_file in unique_results_files:
-        # Get isolate name
-        isolate = result_file.split('_table.txt')[0]
-        list_of_isolates.append(isolate)
-        # Skip the header
-        header = 0
-        with open(result_file) as file_open:
-            for line in file_open:
-                # Skip header
-                if header == 0:
-                    header += 1
-                # Check to make sure there were actually hits
-                elif 'No hits found' not in line and line != '':
-                    info = line.strip('\n').split('\t')
-                    # Get orientation for hit and start/end coordinates
-                    orientation = info[1]
-                    is_start = min(int(info[2]), int(info[3]))
-                    is_end = max(int(info[3]), int(info[2]))
-                    # Note whether call is Known, Novel or Possible related IS
-                    call = info[5]
+    # --max_memory spills the hits to a temporary folder, which
+    # is removed whether or not the table is written
+    temp_dir = None
+    try:
+        # Loop through each table give to --tables
+        print 'Collating results files ...'
+        if args.max_memory:
+            list_of_isolates = [isolate_name(result_file) for result_file in unique_results_files]
+            # Spill the hits next to the output rather than to /tmp, which may be small
+            temp_dir = tempfile.mkdtemp(prefix='compiled_table_', dir=os.path.dirname(os.path.abspath(args.output)))
+            list_of_positions, get_rows = external_compile(unique_results_files, list_of_positions, args.gap, args.max_memory, temp_dir)
+        elif args.processes > 1:
+            list_of_isolates = [isolate_name(result_file) for result_file in unique_results_files]
+            list_of_positions = merge_tables(unique_results_files, list_of_positions, args.gap, args.processes)
+        else:
+            for result_file in unique_results_files:
+                # Get isolate name
+                isolate = isolate_name(result_file)
+                list_of_isolates.append(isolate)
+                # Get orientation, start/end coordinates and call (as +, * or ?) of each hit
+                for orientation, is_start, is_end, call in table_hits(result_file):
                     # See if this position is already in the list of positions
                     match = False
                     isolate_dict = {}
@@ -547,104 +1024,59 @@ def main():
                                 new_pos = Position(is_start, is_end, orientation, isolate_dict, None, None)
                                 list_of_positions.append(new_pos)
 
-    # do one last check for positions that should be merged
-    list_of_positions = final_ranges_check(list_of_positions, args.gap)
+            # do one last check for positions that should be merged
+            list_of_positions = final_ranges_check(list_of_positions, args.gap)
 
-    elapsed_time = time.time() - start_time
-    print 'Time taken: ' + str(elapsed_time)
+        elapsed_time = time.time() - start_time
+        print 'Time taken: ' + str(elapsed_time)
 
-    # Get the flanking genes for each position now they've all been merged
-    print 'Getting flanking genes for each position (this step is the longest and could take some time) ...'
-    # key = (start, end), valye = [left_gene, right_gene]
-    position_genes = {}
-
-    # Get feature list
-    gb = SeqIO.read(args.reference_gbk, "genbank")
-    feature_list = []
-    feature_count = 0
-    feature_types = ["CDS", "tRNA", "rRNA"]
-
-    for feature in gb.features:
-        if feature.type in feature_types:
-            feature_list.append([int(feature.location.start), int(feature.location.end), feature_count])
-            feature_count += 1
-        else:
-            feature_count += 1
-    # Sort the list just in case it's out of order (has caused issues in the past!!)
-    feature_list = sorted(feature_list, key=itemgetter(0))
-    # Get flanking genes
-    for pos in list_of_positions:
-        genes_before, genes_after =  get_flanking_genes(gb.features, feature_list, pos.x, pos.y, args.cds, args.trna, args.rrna, len(gb.seq))
-        pos.left_feature = genes_before
-        pos.right_feature = genes_after
+        # Get the flanking genes for each position now they've all been merged
+        print 'Getting flanking genes for each position (this step is the longest and could take some time) ...'
+        # key = (start, end), valye = [left_gene, right_gene]
+        position_genes = {}
 
+        # Get feature list
+        gb = SeqIO.read(args.reference_gbk, "genbank")
+        feature_list = []
+        feature_count = 0
+        feature_types = ["CDS", "tRNA", "rRNA"]
 
-    elapsed_time = time.time() - start_time
-    print 'Time taken: ' + str(elapsed_time)
-
-    # Order positions from smallest to largest for final table output
-    list_of_positions.sort(key=lambda x: x.x)
-
-    # Write out table
-    print 'Writing output table to ' + args.output + ' ...'
-    with open(args.output, 'w') as out:
-        header = ['isolate']
-        for pos in list_of_positions:
-            if pos.orientation == 'F':
-                header.append(str(pos.x) + '-' + str(pos.y))
+        for feature in gb.features:
+            if feature.type in feature_types:
+                feature_list.append([int(feature.location.start), int(feature.location.end), feature_count])
+                feature_count += 1
             else:
-                header.append(str(pos.y) + '-' + str(pos.x))
-        out.write('\t'.join(header) + '\n')
-        # Add the values for the reference positions
-        row = [ref_name]
+                feature_count += 1
+        # Sort the list just in case it's out of order (has caused issues in the past!!)
+        feature_list = sorted(feature_list, key=itemgetter(0))
+        # Get flanking genes
         for pos in list_of_positions:
-            if ref_name in pos.isolate_dict.keys():
-                row.append(pos.isolate_dict[ref_name])
-            else:
-                row.append('-')
-        out.write('\t'.join(row) + '\n')
+            genes_before, genes_after =  get_flanking_genes(gb.features, feature_list, pos.x, pos.y, args.cds, args.trna, args.rrna, len(gb.seq))
+            pos.left_feature = genes_before
+            pos.right_feature = genes_after
 
-        # Loop through each isolate
-        # and create each row
-        for isolate in list_of_isolates:
-            row = [isolate]
-            for pos in list_of_positions:
-                if isolate in pos.isolate_dict.keys():
-                    row.append(pos.isolate_dict[isolate])
-                else:
-                    row.append('-')
-            out.write('\t'.join(row) + '\n')
-        # Set up flanking genes
-        row_orientation = ['orientation']
-        row_l_locus = ['left ID']
-        row_r_locus = ['right ID']
-        row_l_dist = ['left distance']
-        row_r_dist = ['right distance']
-        row_l_strand = ['left strand']
-        row_r_strand = ['right strand']
-        row_l_prod = ['left info']
-        row_r_prod = ['right info']
 
-        # Print orientation and flanking genes for each position
-        for pos in list_of_positions:
-            row_orientation.append(pos.orientation)
-            row_l_locus.append(pos.left_feature[0])
-            row_r_locus.append(pos.right_feature[0])
-            row_l_dist.append(pos.left_feature[1])
-            row_r_dist.append(pos.right_feature[1])
-            row_l_strand.append(pos.left_feature[2][-1])
-            row_r_strand.append(pos.right_feature[2][-1])
-            row_l_prod.append(pos.left_feature[2])
-            row_r_prod.append(pos.right_feature[2])
-        out.write('\t'.join(row_orientation) + '\n')
-        out.write('\t'.join(row_l_locus) + '\n')
-        out.write('\t'.join(row_l_dist) + '\n')
-        out.write('\t'.join(row_l_strand) + '\n')
-        out.write('\t'.join(str(i) for i in row_l_prod) + '\n')
-        out.write('\t'.join(row_r_locus) + '\n')
-        out.write('\t'.join(row_r_dist) + '\n')
-        out.write('\t'.join(row_r_strand) + '\n')
-        out.write('\t'.join(str(i) for i in row_r_prod) + '\n')
+        elapsed_time = time.time() - start_time
+        print 'Time taken: ' + str(elapsed_time)
+
+        # Order positions from smallest to largest for final table output
+        list_of_positions.sort(key=lambda x: x.x)
+
+        # Write out table
+        print 'Writing output table to ' + args.output + ' ...'
+        if args.max_memory:
+            block_size = row_block_size(args.max_memory, len(list_of_positions))
+            if args.sparse:
+                write_sparse_table_rows(args.output, [ref_name] + list_of_isolates, list_of_positions, get_rows, block_size)
+            else:
+                write_table_rows(args.output, [ref_name] + list_of_isolates, list_of_positions, get_rows, block_size)
+        elif args.sparse:
+            write_sparse_table(args.output, ref_name, list_of_isolates, list_of_positions)
+        else:
+            write_table(args.output, ref_name, list_of_isolates, list_of_positions)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
 
     elapsed_time = time.time() - start_time
     print 'Table compilation finished in ' + str(elapsed_time)
@@ -11,6 +11,7 @@ from operator import itemgetter
 import os, sys, re, collections, operator
 import numpy as np
 from collections import OrderedDict
+from profiling import start_profiling
 
 def parse_args():
     '''
@@ -23,6 +24,7 @@ def parse_args():
     parser.add_argument('--assembly', type=str, required=True, help='assembly file for annotation (can be genbank or fasta)')
     parser.add_argument('--type', type=str, required=True, help='the type of assembly file (is either a genbank or fasta)')
     parser.add_argument('--output', type=str, required=True, help='prefix for output file')
+    parser.add_argument('--profile', type=str, required=False, help='Directory to save profiling information (cProfile stats and memory use) to')
     return parser.parse_args()
 
 def create_feature(hit, end):
@@ -51,9 +53,30 @@ def create_feature(hit, end):
     
     return feature
 
+def annotate_records(record_list, results, output, counts):
+    '''
+    Goes through each contig and annotates any left or right end hits
+    on it, writing the hits to the output table.
+    Yields each contig once it has been annotated.
+    The number of features added is kept in counts['features'].
+    '''
+
+    for record in record_list:
+        if record.name in results:
+            for hit in results[record.name]:
+                # Annotate each hit on this contig
+                new_feature = create_feature(results[record.name][hit], results[record.name][hit][0])
+                record.features.append(new_feature)
+                counts['features'] += 1
+                # Add the hit to the output table
+                output.write(record.name + '\t' + '\t'.join(results[record.name][hit]) + '\n')
+        # Contigs without hits are passed through unchanged
+        yield record
+
 def main():
 
     args = parse_args()
+    start_profiling(args.profile, 'create_genbank_table')
 
     header = ['contig', 'end', 'x', 'y']
     results = collections.defaultdict(dict)
@@ -86,37 +109,17 @@ def main():
     # Open up table for writing output into
     output = open(args.output + '_table.txt', 'w')
     output.write('\t'.join(header) + '\n')
-    # Convert the assembly to a genbank file first
+    # Read the contigs straight from the assembly, fasta
+    # records are written out as genbank records
     if args.type == 'fasta':
-        print('Creating multi entry genbank for annotation...')
-        count = SeqIO.convert(args.assembly, 'fasta', args.output + '.gbk', 'genbank', generic_dna)
-        print('Successfully converted %i records' % count)
-        # read in file
-        record_list = SeqIO.parse(args.output + '.gbk', 'genbank')
-    # Otherwise read in the genbank
+        record_list = SeqIO.parse(args.assembly, 'fasta', generic_dna)
     elif args.type == 'genbank':
         record_list = SeqIO.parse(args.assembly, 'genbank')
-    # Initalise a list where any edited contigs will go
-    new_record_list = []
-    # Intialise number of features added
-    feature_count = 0
-    # Go through each contig and see if there is a left or right end hit
-    for record in record_list:
-        if record.name in results:
-            for hit in results[record.name]:
-                # If there is, then annotate the hit
-                new_feature = create_feature(results[record.name][hit], results[record.name][hit][0])
-                record.features.append(new_feature)
-                feature_count += 1
-                # Add the hit to the output table
-                output.write(record.name + '\t' + '\t'.join(results[record.name][hit]) + '\n')
-            new_record_list.append(record)
-        # Otherwise just pass over this contig
-        else:
-            new_record_list.append(record)
-    # Write out the new genbank file
-    SeqIO.write(new_record_list, args.output + '_annotated.gbk', 'genbank')
-    print('Added ' + str(feature_count) + ' features to ' + args.output + '_annotated.gbk')
+    # Each contig is written out as soon as it has been annotated
+    counts = {'features': 0}
+    count = SeqIO.write(annotate_records(record_list, results, output, counts), args.output + '_annotated.gbk', 'genbank')
+    print('Wrote %i records' % count)
+    print('Added ' + str(counts['features']) + ' features to ' + args.output + '_annotated.gbk')
     output.close()
 
 if __name__ == '__main__':
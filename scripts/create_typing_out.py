@@ -6,14 +6,26 @@ from Bio import SeqFeature
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 from Bio.Alphabet import generic_dna
-from Bio.Blast.Applications import NcbiblastnCommandline
 from operator import itemgetter
-import os, sys, re, collections, operator
+import os, sys, re, collections, operator, copy
 import numpy as np
 from collections import OrderedDict
-from compiled_table import get_flanking_genes, get_qualifiers
+from compiled_table import get_flanking_genes, get_qualifiers, binary_search
+from blast_cache import BlastCache, DEFAULT_CACHE_SIZE, run_blastn
+from banded_align import align_to_query
+from hit_records import hit_record, write_hits
+from profiling import start_profiling
+try:
+    from urllib import quote, unquote
+except ImportError:
+    from urllib.parse import quote, unquote
 
-def parse_args():
+# Typing references read before ismap_daemon.py starts its workers,
+# key = genbank file, value = (record, feature list). read_reference gives
+# each run a copy of the record, as the hits are added to its features.
+warm_references = {}
+
+def parse_args(arguments=None):
 
     parser = ArgumentParser(description="Create a table of features for ISMapper (typing pathway)")
     # Input files
@@ -32,13 +44,18 @@ def parse_args():
     # Parameters for determining known genes
     parser.add_argument('--min_range', type=float, required=False, default=0.2, help='Minimum percent size of the gap to be called a known hit (default 0.2, or 20 percent)')
     parser.add_argument('--max_range', type=float, required=False, default=1.1, help='Maximum percent size of the gap to be called a known hit (default 1.1, or 110 percent)')
+    parser.add_argument('--blast_cache', type=str, required=False, help='Directory to cache BLAST results in, so they can be reused by later runs')
+    parser.add_argument('--blast_cache_size', type=int, required=False, default=DEFAULT_CACHE_SIZE, help='Maximum size of the BLAST cache in MB (default ' + str(DEFAULT_CACHE_SIZE) + ')')
+    parser.add_argument('--between_check', type=str, required=False, default='blast', choices=['blast', 'align'], help='How to check the sequence between the ends of known hits against the IS query, with BLAST or with an in-process banded alignment (default blast)')
     # Output parameters
     parser.add_argument('--temp', type=str, required=True, help='location of temp folder to place intermediate blast files in')
     parser.add_argument('--output', type=str, required=True, help='name for output file')
     parser.add_argument('--igv', type=int, required=True, help='format of output bedfile - if 1, adds IGV trackline and formats 4th column for hovertext display')
     parser.add_argument('--chr_name', type=str, required=True, help='chromosome name for bedfile - must match genome name to load in IGV (default = genbank accession)')
+    parser.add_argument('--profile', type=str, required=False, help='Directory to save profiling information (cProfile stats and memory use) to')
+    parser.add_argument('--genbank', action='store_true', required=False, help='Also write the whole reference genbank with the hits annotated, as well as the GFF3 of the hits')
 
-    return parser.parse_args()
+    return parser.parse_args(arguments)
 
 def insertion_length(insertion):
     '''
@@ -50,15 +67,15 @@ def insertion_length(insertion):
 
     return length
 
-def doBlast(blast_input, blast_output, database):
+def doBlast(blast_input, blast_output, database, cache=None):
     '''
     Perform a BLAST using the NCBI command line tools 
-    in BioPython.
+    in BioPython, reusing the result from the cache if
+    one is given.
     '''
-    blastn_cline = NcbiblastnCommandline(query=blast_input, db=database, outfmt="'6 qseqid qlen sacc pident length slen sstart send evalue bitscore qcovs'", out=blast_output)
-    stdout, stderr = blastn_cline()
+    run_blastn(blast_input, database, blast_output, "'6 qseqid qlen sacc pident length slen sstart send evalue bitscore qcovs'", cache=cache)
 
-def check_seq_between(gb, insertion, start, end, name, temp):
+def check_seq_between(gb, insertion, start, end, name, temp, cache=None):
     '''
     Check the sequence between two ends to see
     if it matches the IS query or not, and what
@@ -72,7 +89,7 @@ def check_seq_between(gb, insertion, start, end, name, temp):
     seq_between = SeqRecord(Seq(str(seq_between), generic_dna), id=name)
     SeqIO.write(seq_between, temp + name + '.fasta', 'fasta')
     # Perform the BLAST
-    doBlast(temp + name + '.fasta', temp + name + '_out.txt', insertion)
+    doBlast(temp + name + '.fasta', temp + name + '_out.txt', insertion, cache)
     # Only want the top hit, so set count variable to 0
     first_result = 0
     # Open the BLAST output file 
@@ -89,6 +106,15 @@ def check_seq_between(gb, insertion, start, end, name, temp):
     hit = []
     return []
 
+def align_seq_between(genbank, query, start, end):
+    '''
+    Check the sequence between two ends against the IS query
+    with a banded alignment in this process, rather than BLAST.
+    Returns the %ID and coverage to the query like check_seq_between.
+    '''
+
+    return align_to_query(genbank.seq[start:end], query)
+
 def createFeature(hits, orient, note):
     '''
     Create a feature for the hit to
@@ -162,7 +188,7 @@ def novel_hit(x_L, y_L, x_R, y_R, x, y, genbank, ref, cds, trna, rrna, gap, orie
     # Store all information for final table output
     results['region_' + str(region)] = [orient, str(x), str(y), gap, call, '', '', gene_left[-1][:-1], gene_left[-1][-1], gene_left[1], gene_right[-1][:-1], gene_right[-1][-1], gene_right[1], func_pred]
 
-def add_known(x_L, x_R, y_L, y_R, gap, genbank, ref, seq, temp, cds, trna, rrna, region, feature_count, results, features, feature_list, removed_results, line, file_loc):
+def add_known(x_L, x_R, y_L, y_R, gap, genbank, ref, seq, temp, cds, trna, rrna, region, feature_count, results, features, feature_list, removed_results, line, file_loc, blast_cache=None, query_seq=None):
     '''
     Adds a value to the table that is a known hit
     '''
@@ -180,10 +206,14 @@ def add_known(x_L, x_R, y_L, y_R, gap, genbank, ref, seq, temp, cds, trna, rrna,
     left_feature, right_feature = createFeature([x_L, y_L, x_R, y_R], orient, note)
     genbank.features.append(left_feature)
     genbank.features.append(right_feature)
-    # Check to see if the sequence between actually belongs to the IS query
-    seq_results = check_seq_between(ref, seq, start, end, 'region_' + str(region), temp)
+    # Check to see if the sequence between actually belongs to the IS query,
+    # aligning to it in process if the query sequence has been given
+    if query_seq is not None:
+        seq_results = align_seq_between(genbank, query_seq, start, end)
+    else:
+        seq_results = check_seq_between(ref, seq, start, end, 'region_' + str(region), temp, blast_cache)
     # This is a known site of coverage and %ID above 80
-    if len(seq_results) != 0 and seq_results[0] >= 80 and seq_results[1] >= 80:
+    if len(seq_results) != 0 and float(seq_results[0]) >= 80 and seq_results[1] >= 80:
         # Taking all four coordinates and finding min and max to avoid coordinates 
         # that overlap the actual IS (don't want to return those in gene calls)
         # Mark as a known call to improve accuracy of gene calling
@@ -207,7 +237,7 @@ def add_known(x_L, x_R, y_L, y_R, gap, genbank, ref, seq, temp, cds, trna, rrna,
         else:
             call = 'Known'
         results['region_' + str(region)] = [orient, str(start), str(end), gap, call, str(seq_results[0]), str('%.2f' % seq_results[1]), gene_left[-1][:-1], gene_left[-1][-1], gene_left[1], gene_right[-1][:-1], gene_right[-1][-1], gene_right[1], func_pred]
-    elif len(seq_results) != 0 and seq_results[0] >=50 and seq_results[1] >= 50:   
+    elif len(seq_results) != 0 and float(seq_results[0]) >= 50 and seq_results[1] >= 50:   
         # Calling it a possible related IS if there is 50% nucleotide ID and 50% coverage
         gene_left, gene_right = get_flanking_genes(features, feature_list, start, end, cds, trna, rrna, len(genbank.seq))
         if 'unpaired' in file_loc:
@@ -228,9 +258,84 @@ def gbk_to_fasta(genbank, fasta):
     sequences = SeqIO.parse(genbank, "genbank")
     SeqIO.write(sequences, fasta, "fasta")
 
-def main():
+def write_gff(features, record, gff):
+    '''
+    Writes the features added to the reference record to a GFF3 file, so
+    the hits can be kept without a copy of the whole reference. The
+    qualifiers of each feature are saved as its attributes.
+    '''
+
+    with open(gff, 'w') as out:
+        out.write('##gff-version 3\n')
+        out.write('##sequence-region ' + record.id + ' 1 ' + str(len(record.seq)) + '\n')
+        for feature in features:
+            attributes = ';'.join(key + '=' + quote(str(feature.qualifiers[key]), safe=' ') for key in sorted(feature.qualifiers))
+            out.write('\t'.join([record.id, 'ISMapper', feature.type, str(int(feature.location.start) + 1),
+                str(int(feature.location.end)), '.', '.', '.', attributes]) + '\n')
+
+def read_gff(gff):
+    '''
+    Reads the features written by write_gff.
+    '''
 
-    args = parse_args()
+    features = []
+    with open(gff) as gff_in:
+        for line in gff_in:
+            if line.startswith('#') or line.strip() == '':
+                continue
+            info = line.rstrip('\n').split('\t')
+            quals = {}
+            if info[8] != '':
+                for attribute in info[8].split(';'):
+                    key, value = attribute.split('=', 1)
+                    quals[key] = unquote(value)
+            location = SeqFeature.FeatureLocation(int(info[3]) - 1, int(info[4]))
+            features.append(SeqFeature.SeqFeature(location, type=info[2], qualifiers=quals))
+    return features
+
+def materialise_genbank(gff, ref, output):
+    '''
+    Writes the reference genbank with the hits in gff (see write_gff)
+    added to it, the same as create_typing_out.py --genbank.
+    '''
+
+    genbank = SeqIO.read(ref, 'genbank')
+    genbank.features += read_gff(gff)
+    SeqIO.write(genbank, output, 'genbank')
+
+def read_reference(ref):
+    '''
+    Reads the reference genbank and creates the list of its CDS,
+    tRNA and rRNA features sorted by start, for searching.
+    If the reference has already been read into warm_references,
+    returns a copy of that record with its own list of features,
+    so the hits of this run aren't added to the shared record.
+    '''
+
+    if ref in warm_references:
+        genbank, feature_list = warm_references[ref]
+        genbank = copy.copy(genbank)
+        genbank.features = list(genbank.features)
+        return genbank, feature_list
+    genbank = SeqIO.read(ref, 'genbank')
+    feature_list = []
+    feature_count_list = 0
+    feature_types = ["CDS", "tRNA", "rRNA"]
+
+    for feature in genbank.features:
+        if feature.type in feature_types:
+            feature_list.append([int(feature.location.start), int(feature.location.end), feature_count_list])
+            feature_count_list += 1
+        else:
+            feature_count_list += 1
+
+    feature_list = sorted(feature_list, key=itemgetter(0))
+    return genbank, feature_list
+
+def main(arguments=None):
+
+    args = parse_args(arguments)
+    start_profiling(args.profile, 'create_typing_out')
 
     # Setup variables: results - for final table, removed_results - table showing
     # results which didn't pass cutoff tests, 
@@ -247,23 +352,24 @@ def main():
         output.write('\t'.join(header) + '\n')
         output.write('No hits found')
         output.close()
+        write_hits(args.output + '_table.hits', [])
         # Exit ISMapper
         sys.exit()
 
-    # Read in genbank and create feature list for searching
-    genbank = SeqIO.read(args.ref, 'genbank')
-    feature_list = []
-    feature_count_list = 0
-    feature_types = ["CDS", "tRNA", "rRNA"]
+    if args.blast_cache:
+        blast_cache = BlastCache(args.blast_cache, args.blast_cache_size)
+    else:
+        blast_cache = None
+    # The IS query to align known hits to, if not using BLAST
+    if args.between_check == 'align':
+        query_seq = str(SeqIO.read(args.seq, 'fasta').seq)
+    else:
+        query_seq = None
 
-    for feature in genbank.features:
-        if feature.type in feature_types:
-            feature_list.append([int(feature.location.start), int(feature.location.end), feature_count_list])
-            feature_count_list += 1
-        else:
-            feature_count_list += 1
-    
-    feature_list = sorted(feature_list, key=itemgetter(0))
+    # Read in genbank and create feature list for searching
+    genbank, feature_list = read_reference(args.ref)
+    # The hits are added as features after the features of the reference
+    reference_features = len(genbank.features)
     # Initialise feature count
     feature_count = 0
 
@@ -330,6 +436,7 @@ def main():
                 output.write('\t'.join(header) + '\n')
                 output.write('No hits found')
                 output.close()
+                write_hits(args.output + '_table.hits', [])
                 # Exit ISMapper
                 sys.exit()
             # Get coordinate info
@@ -365,7 +472,7 @@ def main():
                 # Only a known hit if we're in the a range between (default 0.5 and 1.5) the size
                 # of the IS query
                 elif float(info[6]) / is_length >= args.min_range and float(info[6]) / is_length <= args.max_range:
-                    add_known(x_L, x_R, y_L, y_R, info[6], genbank, args.ref, args.seq, args.temp, args.cds, args.trna, args.rrna, region, feature_count, results, genbank.features, feature_list, removed_results, line, 'closest.bed')
+                    add_known(x_L, x_R, y_L, y_R, info[6], genbank, args.ref, args.seq, args.temp, args.cds, args.trna, args.rrna, region, feature_count, results, genbank.features, feature_list, removed_results, line, 'closest.bed', blast_cache=blast_cache, query_seq=query_seq)
                     region += 1
                     feature_count += 2
                 # Could possibly be a novel hit but the gap size is too large
@@ -423,7 +530,7 @@ def main():
                             feature_count += 2
                         # This is a known hit
                         elif float(info[6]) / is_length >= args.min_range and float(info[6]) / is_length <= args.max_range:
-                            add_known(x_L, x_R, y_L, y_R, info[6], genbank, args.ref, args.seq, args.temp, args.cds, args.trna, args.rrna, region, feature_count, results, genbank.features, feature_list, removed_results, line, 'left_unpaired.bed')
+                            add_known(x_L, x_R, y_L, y_R, info[6], genbank, args.ref, args.seq, args.temp, args.cds, args.trna, args.rrna, region, feature_count, results, genbank.features, feature_list, removed_results, line, 'left_unpaired.bed', blast_cache=blast_cache, query_seq=query_seq)
                             region += 1
                             feature_count += 2
                         # Could possibly be a novel hit but the gap size is too large
@@ -478,7 +585,7 @@ def main():
                             feature_count += 2
                         #a known hit
                         elif float(info[6]) / is_length >= args.min_range and float(info[6]) / is_length <= args.max_range:
-                            add_known(x_L, x_R, y_L, y_R, info[6], genbank, args.ref, args.seq, args.temp, args.cds, args.trna, args.rrna, region, feature_count, results, genbank.features, feature_list, removed_results, line, 'right_unpaired.bed')               
+                            add_known(x_L, x_R, y_L, y_R, info[6], genbank, args.ref, args.seq, args.temp, args.cds, args.trna, args.rrna, region, feature_count, results, genbank.features, feature_list, removed_results, line, 'right_unpaired.bed', blast_cache=blast_cache, query_seq=query_seq)               
                             region += 1
                             feature_count += 2
                         #could possibly be a novel hit but the gap size is too large
@@ -501,15 +608,20 @@ def main():
     for region in table_keys:
         region_indexes.append(region.split('region_')[1])
     arr = np.vstack((table_keys, region_indexes)).transpose()
-    # Write out the found hits to file
+    # Write out the found hits to file, and to the binary hit records
+    # with the indexes of their flanking features
+    hits = []
     if arr != 0:
         sorted_keys = arr[arr[:,1].astype('int').argsort()]
         for key in sorted_keys[:,0]:
-            output.write(key + '\t' + '\t'.join(str(i) for i in results[key]) + '\n')
+            r = results[key]
+            output.write(key + '\t' + '\t'.join(str(i) for i in r) + '\n')
+            hits.append(hit_record(r[0], r[1], r[2], r[3], r[4], r[5], r[6], binary_search(feature_list, int(r[1]), 'L'), binary_search(feature_list, int(r[2]), 'R')))
     # If all the hits failed, write out that no hits were found
     elif arr == 0:
         output.write('No hits found.')
     output.close()
+    write_hits(args.output + '_table.hits', hits)
     
     # Write out the found hits to bed file for viewing in IGV
     with open(args.output + '_hits.bed', 'w') as outfile:
@@ -524,7 +636,7 @@ def main():
             else:
                 for key in sorted_keys[:,0]:
                     r = results[key]
-                    outfile.write(args.chr_name + '\t' + r[1] + '\t' + r[2] + key + '\n')
+                    outfile.write(args.chr_name + '\t' + r[1] + '\t' + r[2] + '\t' + key + '\n')
 
     # Write out hits that were removed for whatever reason to file
     if len(removed_results) != 0:
@@ -533,8 +645,12 @@ def main():
             output_removed.write(removed_results[region])
         output_removed.close()
 
-    SeqIO.write(genbank, args.output + '_annotated.gbk', 'genbank')
-    print('Added ' + str(feature_count) + ' features to ' + args.output + '_annotated.gbk')
+    # Only the hits are written out, unless the whole genbank is asked for
+    write_gff(genbank.features[reference_features:], genbank, args.output + '_annotated.gff')
+    print('Added ' + str(len(genbank.features) - reference_features) + ' features to ' + args.output + '_annotated.gff')
+    if args.genbank:
+        SeqIO.write(genbank, args.output + '_annotated.gbk', 'genbank')
+        print('Added ' + str(feature_count) + ' features to ' + args.output + '_annotated.gbk')
 
     #return(lines, len(removed_results))
 
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Pairwise distances between isolates from a bit-packed binary table
+# (binary_table.py --packed).
+#
+# Both distances are worked out from the number of positions shared by
+# each pair of isolates, which is the popcount of the AND of their packed
+# rows. Summed over a row, that is the dot product of the two rows as 0/1
+# vectors, so a block of rows is unpacked at a time and compared against
+# each block of rows with a matrix product, which BLAS does much faster
+# (and on every core) than counting bits in NumPy. Only two blocks are
+# unpacked at once, so memory use doesn't grow with the number of isolates
+# beyond the rows of output being written.
+
+import sys
+from argparse import ArgumentParser
+import numpy as np
+from binary_table import read_packed_table
+from profiling import start_profiling
+
+def parse_args():
+
+    parser = ArgumentParser(description="Calculate pairwise distances between isolates from a packed ISMapper binary table")
+    parser.add_argument('--table', type=str, required=True, help='packed binary table (.npz from binary_table.py --packed)')
+    parser.add_argument('--output', type=str, required=True, help='output distance matrix, as text, or as a NumPy array if the name ends in .npy')
+    parser.add_argument('--metric', type=str, required=False, default='hamming', choices=['hamming', 'jaccard'], help='distance to calculate: hamming (number of positions where two isolates differ) or jaccard (1 - shared positions / positions in either isolate). Default hamming')
+    parser.add_argument('--uncertain', type=str, required=False, default='absent', choices=['absent', 'present'], help='treat uncertain calls (* and ? calls not given a value of 1 by binary_table.py) as absent or present. Default absent')
+    parser.add_argument('--block', type=int, required=False, default=1024, help='number of isolates compared at a time (default 1024)')
+    parser.add_argument('--delimiter', type=str, required=False, default=',', help='delimiter for text output (default is , can also be t for tab)')
+    parser.add_argument('--profile', type=str, required=False, help='Directory to save profiling information (cProfile stats and memory use) to')
+
+    return parser.parse_args()
+
+def unpack_rows(packed, start, stop):
+    '''
+    Unpacks rows start to stop of a packed matrix into 0/1 float32
+    rows, which hold the counts of up to 2^24 positions exactly.
+    '''
+
+    return np.unpackbits(packed[start:stop], axis=1).astype(np.float32)
+
+def distance_blocks(packed, metric, block_size):
+    '''
+    Yields the start row and the distances of a block of isolates
+    against every isolate, for block_size isolates at a time.
+    '''
+
+    isolate_count = packed.shape[0]
+    totals = np.concatenate([unpack_rows(packed, start, start + block_size).sum(axis=1) for start in range(0, isolate_count, block_size)] or [np.zeros(0)])
+    for start in range(0, isolate_count, block_size):
+        stop = min(start + block_size, isolate_count)
+        rows = unpack_rows(packed, start, stop)
+        # positions shared by each pair of isolates
+        shared = np.empty((stop - start, isolate_count), dtype=np.float32)
+        for column in range(0, isolate_count, block_size):
+            shared[:, column:column + block_size] = rows.dot(unpack_rows(packed, column, column + block_size).T)
+        # positions in either isolate
+        either = totals[start:stop, None] + totals[None, :] - shared
+        if metric == 'hamming':
+            yield start, (either - shared).astype(np.int32)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distances = 1 - shared / either.astype(np.float64)
+            # isolates with no hits are the same as each other
+            distances[either == 0] = 0
+            yield start, distances
+
+def main():
+
+    args = parse_args()
+    start_profiling(args.profile, 'distance_table')
+
+    if args.delimiter != ',' and args.delimiter != 't':
+        print 'Delimiter type unknown. Must be , or t.'
+        sys.exit()
+    if args.delimiter == 't':
+        delimiter = '\t'
+    else:
+        delimiter = ','
+
+    table = read_packed_table(args.table)
+    isolates = list(table['isolates'])
+    packed = table['confident']
+    if args.uncertain == 'present':
+        packed = packed | table['uncertain']
+    dtype = np.int32 if args.metric == 'hamming' else np.float64
+
+    # Write out each block of rows as soon as it has been calculated
+    if args.output.endswith('.npy'):
+        out_matrix = np.lib.format.open_memmap(args.output, mode='w+', dtype=dtype, shape=(len(isolates), len(isolates)))
+        for start, distances in distance_blocks(packed, args.metric, args.block):
+            out_matrix[start:start + len(distances)] = distances
+        out_matrix.flush()
+        with open(args.output[:-len('.npy')] + '_isolates.txt', 'w') as out_file:
+            out_file.write('\n'.join(isolates) + '\n')
+    else:
+        with open(args.output, 'w') as out_file:
+            out_file.write(delimiter.join(['isolate'] + isolates) + '\n')
+            for start, distances in distance_blocks(packed, args.metric, args.block):
+                if args.metric == 'hamming':
+                    rows = distances.astype(str)
+                else:
+                    rows = np.char.mod('%.4f', distances)
+                out_file.write(''.join(delimiter.join([isolate] + list(row)) + '\n' for isolate, row in zip(isolates[start:], rows)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Binary hit records for ISMapper typing runs.
+#
+# create_typing_out.py writes the hits of each isolate to <prefix>_table.hits
+# as well as <prefix>_table.txt, and compiled_table.py can read them without
+# any text parsing. The file is HIT_RECORD_MAGIC followed by the format
+# version in one byte, then the rows of a NumPy structured array (HIT_DTYPE),
+# one per hit, as raw little endian values. Calls are stored as codes into
+# TABLE_CALLS and flanking features as their index in the features of the
+# typing reference genbank (-1 if not found). Novel hits have no %ID or
+# coverage (NaN). An isolate without hits has no rows.
+# A raw file is used rather than .npy or .npz, as the few hits of an isolate
+# are read much faster without the header parsing or zip file of those.
+
+import numpy as np
+
+HIT_RECORD_MAGIC = b'ISMHITS'
+HIT_RECORD_VERSION = 1
+# The calls made by create_typing_out.py, a hit's call is its index in this list
+TABLE_CALLS = ['Novel', 'Novel?', 'Novel*', 'Known', 'Known?', 'Possible releated IS', 'Possible related IS?']
+HIT_DTYPE = np.dtype([('orientation', 'S1'), ('x', '<i8'), ('y', '<i8'), ('gap', '<i8'), ('call', 'i1'),
+    ('identity', '<f4'), ('coverage', '<f4'), ('left_feature', '<i4'), ('right_feature', '<i4')])
+
+def hit_record(orientation, x, y, gap, call, identity, coverage, left_feature, right_feature):
+    '''
+    Returns a hit as a tuple for hit_array, from the values
+    in a row of the _table.txt file and the indexes of the
+    flanking features (which may be error strings).
+    '''
+
+    if identity == '':
+        identity = coverage = 'nan'
+    if type(left_feature) != int:
+        left_feature = -1
+    if type(right_feature) != int:
+        right_feature = -1
+    return (orientation, int(x), int(y), int(gap), TABLE_CALLS.index(call), float(identity), float(coverage), left_feature, right_feature)
+
+def write_hits(hits_file, hits):
+    '''
+    Writes a list of hit_record tuples to hits_file.
+    '''
+
+    with open(hits_file, 'wb') as output:
+        output.write(HIT_RECORD_MAGIC + bytearray([HIT_RECORD_VERSION]))
+        np.array(hits, dtype=HIT_DTYPE).tofile(output)
+
+def read_hits(hits_file):
+    '''
+    Returns the array of hits in hits_file.
+    '''
+
+    with open(hits_file, 'rb') as records:
+        header = bytearray(records.read(len(HIT_RECORD_MAGIC) + 1))
+        if bytes(header[:-1]) != HIT_RECORD_MAGIC:
+            raise ValueError('{} is not a hit record file'.format(hits_file))
+        if header[-1] != HIT_RECORD_VERSION:
+            raise ValueError('{} is hit record version {}, expected version {}'.format(hits_file, header[-1], HIT_RECORD_VERSION))
+        return np.fromfile(records, dtype=HIT_DTYPE)
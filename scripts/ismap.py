@@ -21,7 +21,7 @@
 import logging
 import sys, re, os
 from argparse import ArgumentParser
-from subprocess import call, check_output, CalledProcessError, STDOUT, Popen, PIPE
+from subprocess import check_output, CalledProcessError, STDOUT, Popen, PIPE
 from Bio import SeqIO
 from Bio import SeqFeature
 from Bio.SeqFeature import SeqFeature, FeatureLocation
@@ -31,6 +31,12 @@ from Bio.Alphabet import generic_dna
 import resource
 import time
 import shlex
+import tempfile
+import collections, itertools, gzip, math, glob, io
+from profiling import start_profiling
+from pipeline import Pipeline
+from hit_records import write_hits
+from blast_cache import DEFAULT_CACHE_SIZE
 try:
     from version import ismap_version
 except:
@@ -71,17 +77,22 @@ class RunSamtools:
         cmd = self.samtools_cmd + ' sort'
         if self.version == 1:
             output_bam = output_bam + '.bam'
-            cmd = cmd + ' -T tmp -o {} {}'.format(output_bam, input_bam)
+            # Temporary files are named after the output so sorts can run at the same time
+            cmd = cmd + ' -T {}.tmp -o {} {}'.format(output_bam, output_bam, input_bam)
         else:
             cmd = cmd + ' {} {}'.format(input_bam, output_bam)
         return(shlex.split(cmd))
     def index(self, input_bam):
         cmd = self.samtools_cmd + ' index {}.bam'.format(input_bam)
         return(shlex.split(cmd))
+    def view_regions(self, output_bam, input_bam, regions_bed):
+        cmd = self.samtools_cmd + ' view -b -L {} -o {} {}'.format(regions_bed, output_bam, input_bam)
+        return(shlex.split(cmd))
 
-def parse_args():
+def parse_args(arguments=None):
     '''
     Parse the input arguments, use -h for help.
+    Parses the command line unless a list of arguments is given.
     '''
 
     parser = ArgumentParser(description='IS mapper')
@@ -96,7 +107,7 @@ def parse_args():
     parser.add_argument('--assemblies', nargs='+', type=str, required=False, help='Contig assemblies, one for each read set')
     parser.add_argument('--assemblyid', type=str, required=False, help='Identifier for assemblies eg: sampleName_contigs (specify _contigs) or sampleName_assembly (specify _assembly). Do not specify extension.')
     parser.add_argument('--extension', type=str, required=False, help='Extension for assemblies (eg: .fasta, .fa, .gbk, default is .fasta)', default='.fasta')
-    parser.add_argument('--typingRef', type=str, required=False, help='Reference genome for typing against in genbank format')
+    parser.add_argument('--typingRef', nargs='+', type=str, required=False, help='Reference genome(s) for typing against in genbank format. If more than one is given, the reference name is added to the name of each output file')
     parser.add_argument('--type', type=str, required=False, default='fasta', help='Indicator for contig assembly type, genbank or fasta (default fasta)')
     parser.add_argument('--path', type=str, required=False, default='', help='Path to folder where scripts are (only required for development, default is VLSCI path).')
     # Parameters
@@ -109,20 +120,34 @@ def parse_args():
     parser.add_argument('--t', type=str, required=False, default='1', help='Number of threads for bwa (default 1).')
     parser.add_argument('--min_clip', type=int, required=False, default='10', help='Minimum size for softclipped region to be extracted from initial mapping (default 10).')
     parser.add_argument('--max_clip', type=int, required=False, default=30, help='Maximum size for softclipped regions to be included (default 30).')
+    parser.add_argument('--cpus', type=int, required=False, default=1, help='Number of CPUs to use for running independent steps (eg: the left and right ends) at the same time. bwa steps count as --t CPUs (default 1).')
+    parser.add_argument('--chunk_size', type=int, required=False, default=0, help='Split read sets larger than this many MB into chunks of about this size, and map each chunk to the IS query separately (running at the same time with --cpus). Default 0, no splitting.')
+    parser.add_argument('--collapse', action='store_true', required=False, help='Collapse identical end reads into one read before mapping them to the reference (or assembly), weighting their coverage by the number of copies.')
+    parser.add_argument('--batch_map', action='store_true', required=False, help='Typing only. Map the flanking reads of all samples to the typing reference in one bwa run for each query.')
+    parser.add_argument('--single_map', action='store_true', required=False, help='Map the left and right end reads to the reference (or assembly) in one bwa run instead of two. Faster, but can change the results: reads that map equally well to several places may be placed differently.')
     # Options for table output (typing)
     parser.add_argument('--cds', nargs='+', type=str, required=False, default=['locus_tag', 'gene', 'product'], help='qualifiers to look for in reference genbank for CDS features (default locus_tag gene product)')
     parser.add_argument('--trna', nargs='+', type=str, required=False, default=['locus_tag', 'product'], help='qualifiers to look for in reference genbank for tRNA features (default locus_tag product)')
     parser.add_argument('--rrna', nargs='+', type=str, required=False, default=['locus_tag', 'product'], help='qualifiers to look for in reference genbank for rRNA features (default locus_tag product)')
     parser.add_argument('--igv', action='store_true', help='format of output bedfile - if True, adds IGV trackline and formats 4th column for hovertext display')
     parser.add_argument('--chr_name', type=str, required=False, default='not_specified', help='chromosome name for bedfile - must match genome name to load in IGV (default = genbank accession)')
+    parser.add_argument('--blast_cache', type=str, required=False, help='Directory to cache BLAST results of known hits in, so they can be reused by other samples and runs')
+    parser.add_argument('--blast_cache_size', type=int, required=False, default=DEFAULT_CACHE_SIZE, help='Maximum size of the BLAST cache in MB (default ' + str(DEFAULT_CACHE_SIZE) + ')')
+    parser.add_argument('--between_check', type=str, required=False, default='blast', choices=['blast', 'align'], help='How to check the sequence between the ends of known hits against the IS query: blast, or align to use an in-process banded alignment instead of running BLAST for each hit (default blast)')
     # Reporting options
     parser.add_argument('--log', action='store_true', required=False, help='Switch on logging to file (otherwise log to stdout')
     parser.add_argument('--output', type=str, required=False, help='Prefix for output files. If not supplied, prefix will be current date and time.', default='')
     parser.add_argument('--temp', action='store_true', required=False, help='Switch on keeping the temp folder instead of deleting it at the end of the program')
     parser.add_argument('--bam', action='store_true', required=False, help='Switch on keeping the final bam files instead of deleting them at the end of the program')
+    parser.add_argument('--slim_bam', action='store_true', required=False, help='Switch on keeping only the alignments near each hit in the final bam files, as <bam>_slim.bam, when the full bam files are deleted (typing only)')
+    parser.add_argument('--slim_window', type=int, required=False, default=500, help='Distance either side of each hit to keep alignments for with --slim_bam (default 500)')
+    parser.add_argument('--annotated_gbk', action='store_true', required=False, help='Switch on writing the whole typing reference genbank with the hits annotated, as well as the GFF3 of the hits (typing only)')
     parser.add_argument('--directory', type=str, required=False, default='', help='Output directory for all output files.')
+    parser.add_argument('--profile', type=str, required=False, help='Directory to save profiling information (cProfile stats and memory use) from ISMapper and its scripts to')
+    parser.add_argument('--metrics', type=str, required=False, help='File to append the run time and peak memory of each command to, for fitting resource requests with slurm_ismap.py --history')
+    parser.add_argument('--index_dir', type=str, required=False, help='Directory to keep the indexes of the queries and typing references in, so later runs can reuse them. By default they are built in a temp folder for each run')
 
-    return parser.parse_args()
+    return parser.parse_args(arguments)
 
 # Exception to raise if the command we try to run fails for some reason
 class CommandError(Exception):
@@ -131,6 +156,62 @@ class CommandError(Exception):
 class BedtoolsError(Exception):
     pass
 
+class MetricsWriter(object):
+    '''
+    Appends the run time and peak memory of each command ISMapper runs
+    to a tab separated file, along with the sample and the size of its
+    reads. Each sample also gets a row with stage 'sample', holding the
+    wall time from its start to its end (including the time spent in
+    ISMapper itself, and with steps run at the same time counted once)
+    and its largest peak memory. Several jobs can append to the same file.
+    '''
+
+    header = ['sample', 'query', 'runtype', 'read_bytes', 'stage', 'seconds', 'peak_rss_kb']
+
+    def __init__(self, path, runtype):
+        self.path = path
+        self.runtype = runtype
+        self.sample = '-'
+        self.query = '-'
+        self.read_bytes = 0
+        self.sample_start = None
+        self.sample_peak = 0
+        if not os.path.exists(path):
+            with open(path, 'w') as out:
+                out.write('\t'.join(self.header) + '\n')
+
+    def set_sample(self, sample, query, read_bytes):
+        self.sample = sample
+        self.query = query
+        self.read_bytes = read_bytes
+
+    def record(self, command, seconds, peak_rss):
+        # Name the stage after the program and its subcommand, if it has one
+        stage = os.path.basename(command[0])
+        if len(command) > 1 and re.match('^[a-z]+$', command[1]):
+            stage += ' ' + command[1]
+        self.sample_peak = max(self.sample_peak, peak_rss)
+        self.write_row([self.sample, self.query, self.runtype, str(self.read_bytes), stage, '{:.2f}'.format(seconds), str(peak_rss)])
+
+    def start_sample(self):
+        self.sample_start = time.time()
+        self.sample_peak = 0
+
+    def finish_sample(self, sample, read_bytes):
+        # Python steps run inside ISMapper count towards the peak memory as well
+        peak_rss = max(self.sample_peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        self.write_row([sample, '-', self.runtype, str(read_bytes), 'sample', '{:.2f}'.format(time.time() - self.sample_start), str(peak_rss)])
+
+    def write_row(self, row):
+        with open(self.path, 'a') as out:
+            out.write('\t'.join(row) + '\n')
+
+# Set in main if --metrics is given
+metrics = None
+# Set by ismap_daemon.py to run create_typing_out.py in this process,
+# using the typing references it has already read
+in_process_typing_out = False
+
 def run_command(command, **kwargs):
     '''
     Execute a shell command and check the exit status and any O/S exceptions.
@@ -138,11 +219,22 @@ def run_command(command, **kwargs):
 
     command_str = ' '.join(command)
     logging.info('Running: {}'.format(command_str))
+    start_time = time.time()
     try:
-        exit_status = call(command_str, **kwargs)
+        process = Popen(command_str, **kwargs)
+        # Wait for the command with wait4 so we get its resource usage
+        pid, status, usage = os.wait4(process.pid, 0)
     except OSError as e:
         message = "Command '{}' failed due to O/S error: {}".format(command_str, str(e))
         raise CommandError({"message": message})
+    if os.WIFSIGNALED(status):
+        exit_status = -os.WTERMSIG(status)
+    else:
+        exit_status = os.WEXITSTATUS(status)
+    process.returncode = exit_status
+    logging.info('Finished in {:.2f} s (peak memory {} kb): {}'.format(time.time() - start_time, usage.ru_maxrss, command_str))
+    if metrics is not None:
+        metrics.record(command, time.time() - start_time, usage.ru_maxrss)
     if exit_status == 139 and command[0] == 'closestBed':
         raise BedtoolsError({'message':'One or more bed files are empty. Writing out empty results table.'})
     if exit_status != 0:
@@ -343,6 +435,85 @@ def filter_on_depth(cov_file, out_bed, cov_cutoff):
                 output.write(line)
     output.close()
 
+# Separates the read name from the number of copies of a collapsed read
+COLLAPSE_SEPARATOR = '|x'
+
+def collapse_reads(fastq, collapsed_fastq):
+    '''
+    Writes one copy of each distinct read sequence in the fastq file,
+    named after the first read with that sequence followed by the
+    number of reads that had it (eg: read_1|x12).
+    Returns the number of reads and the number of distinct sequences.
+    '''
+
+    # key = sequence, value = [read name, quality, number of copies]
+    reads = collections.OrderedDict()
+    total = 0
+    with open(fastq) as fastq_in:
+        for name, seq, plus, qual in itertools.izip(*[fastq_in] * 4):
+            total += 1
+            seq = seq.strip()
+            if seq in reads:
+                reads[seq][2] += 1
+            else:
+                reads[seq] = [name[1:].split()[0], qual.strip(), 1]
+    with open(collapsed_fastq, 'w') as out:
+        for seq in reads:
+            name, qual, copies = reads[seq]
+            out.write('@' + name + COLLAPSE_SEPARATOR + str(copies) + '\n' + seq + '\n+\n' + qual + '\n')
+    return total, len(reads)
+
+def read_copies(read_name):
+    '''
+    Returns the number of copies of a collapsed read from its name.
+    '''
+
+    if COLLAPSE_SEPARATOR in read_name:
+        return int(read_name.rsplit(COLLAPSE_SEPARATOR, 1)[1])
+    return 1
+
+def weighted_coverage(sam_file, cov_bed):
+    '''
+    Creates a BED graph of the depth of coverage of the reads in
+    the SAM file, counting each collapsed read as many times as it
+    has copies. Matches bedtools genomecov -bg: each mapped read
+    covers its whole span on the reference, and only regions with
+    coverage are written, in the order of the references in the header.
+    '''
+
+    references = []
+    # key = reference name, value = {position: change in depth}
+    changes = {}
+    with open(sam_file) as sam_in:
+        for line in sam_in:
+            if line.startswith('@'):
+                if line.startswith('@SQ'):
+                    name = [field[3:] for field in line.strip().split('\t') if field.startswith('SN:')][0]
+                    references.append(name)
+                    changes[name] = collections.defaultdict(int)
+                continue
+            entries = line.split('\t')
+            if int(entries[1]) & 4:
+                continue
+            start = int(entries[3]) - 1
+            # The span of the read on the reference
+            length = sum(int(size) for size, op in re.findall('([0-9]+)([MDN=X])', entries[5]))
+            copies = read_copies(entries[0])
+            changes[entries[2]][start] += copies
+            changes[entries[2]][start + length] -= copies
+    with open(cov_bed, 'w') as output:
+        for reference in references:
+            depth = 0
+            region_start = None
+            for position in sorted(changes[reference]):
+                new_depth = depth + changes[reference][position]
+                if new_depth == depth:
+                    continue
+                if depth > 0:
+                    output.write('\t'.join([reference, str(region_start), str(position), str(depth)]) + '\n')
+                depth = new_depth
+                region_start = position
+
 def check_blast_database(fasta):
     '''
     Checks to make sure the BLAST database exists, and creates it
@@ -357,6 +528,15 @@ def check_blast_database(fasta):
         logging.info('Building blast index for {}...'.format(fasta))
         run_command(['makeblastdb -in', fasta, '-dbtype nucl'], shell=True)
 
+def clear_index(fasta):
+    '''
+    Removes a fasta file and the indexes built for it.
+    '''
+
+    for index_file in glob.glob(fasta + '.*') + [fasta]:
+        if os.path.exists(index_file):
+            os.remove(index_file)
+
 def gbk_to_fasta(genbank, fasta):
     '''
     Converts a genbank to a fasta using BioPython
@@ -452,6 +632,658 @@ def extract_clipped_reads(sam_file, min_size, max_size, out_left_file, out_right
                     else:
                         out_right.write('@' + read_name + '\n' + str(soft_clipped_seq) + '\n+\n' + qual_scores + '\n')
 
+# Separates the end tag from the read name when mapping both ends at once
+END_TAG_SEPARATOR = '|'
+
+def tag_reads(fastq_files, tagged_fastq):
+    '''
+    Combines fastq files into one, adding a tag to the start
+    of each read name to show which file it came from.
+    fastq_files is a list of (tag, fastq file).
+    '''
+
+    with open(tagged_fastq, 'w') as out:
+        for tag, fastq in fastq_files:
+            with open(fastq) as fastq_in:
+                for line_number, line in enumerate(fastq_in):
+                    # The first line of each read is its name
+                    if line_number % 4 == 0:
+                        line = '@' + tag + END_TAG_SEPARATOR + line[1:]
+                    out.write(line)
+
+def split_tagged_sam(tagged_sam, outputs):
+    '''
+    Splits a SAM file of tagged reads (see tag_reads) into one
+    SAM file per tag, removing the tag from the read names.
+    outputs is a dictionary where the key is the tag and the value
+    is the SAM file for that tag. Header lines go to every file.
+    bwa writes reads in the order it reads them, so the reads for
+    each tag come together and only one output is open at a time.
+    '''
+
+    header = []
+    written = set()
+    out = None
+    current_tag = None
+    with open(tagged_sam) as sam_in:
+        for line in sam_in:
+            if line.startswith('@'):
+                header.append(line)
+                continue
+            tag, line = line.split(END_TAG_SEPARATOR, 1)
+            if tag != current_tag:
+                if out is not None:
+                    out.close()
+                if tag in written:
+                    out = open(outputs[tag], 'a')
+                else:
+                    out = open(outputs[tag], 'w')
+                    out.writelines(header)
+                    written.add(tag)
+                current_tag = tag
+            out.write(line)
+    if out is not None:
+        out.close()
+    # Tags without any reads still get a SAM file
+    for tag in outputs:
+        if tag not in written:
+            with open(outputs[tag], 'w') as out:
+                out.writelines(header)
+
+def bwa_mem_command(args, reference, reads, output_sam):
+    '''
+    Creates the bwa mem command for mapping reads to a reference.
+    '''
+
+    command = ['bwa', 'mem']
+    if args.a == True:
+        command += ['-a', '-T', args.T]
+    return command + ['-t', args.t, reference, reads, '>', output_sam]
+
+def map_ends_together(args, reference, left_reads, right_reads, left_sam, right_sam, temp_folder):
+    '''
+    Maps the left and right end reads to the reference in one bwa run.
+    The reads are tagged with their end before mapping, then split
+    back into a SAM file for each end.
+    bwa breaks ties between equally good places for a read using the
+    read's position in the input, which for the right end reads is
+    moved along by the left end reads. So reads that map equally well
+    to several places can be placed differently from mapping each end
+    on its own, and the coverage and hits can change.
+    '''
+
+    tagged_reads = os.path.join(temp_folder, 'tagged_ends.fastq')
+    tagged_sam = os.path.join(temp_folder, 'tagged_ends.sam')
+    tag_reads([('left', left_reads), ('right', right_reads)], tagged_reads)
+    run_command(bwa_mem_command(args, reference, tagged_reads, tagged_sam), shell=True)
+    split_tagged_sam(tagged_sam, {'left': left_sam, 'right': right_sam})
+    if not args.temp:
+        os.remove(tagged_reads)
+        os.remove(tagged_sam)
+
+def log_collapse(fastq, collapsed_fastq):
+    '''
+    Collapses the reads in fastq and logs how many were left.
+    '''
+
+    total, distinct = collapse_reads(fastq, collapsed_fastq)
+    logging.info('Collapsed {} reads into {} distinct reads: {}'.format(total, distinct, collapsed_fastq))
+
+def add_mapping_stages(pipeline, args, reference, left_reads, right_reads, left_sam, right_sam, temp_folder):
+    '''
+    Adds the stages mapping the left and right end reads to the reference,
+    either one stage for each end or one for both with --single_map.
+    With --collapse, identical reads are collapsed before mapping.
+    Returns the names of the stages that map the left and right ends.
+    '''
+
+    map_deps = []
+    # The reads to map, which are the collapsed reads with --collapse
+    left_map_reads = left_reads
+    right_map_reads = right_reads
+    # Only the collapsed reads can be removed, the flanking reads
+    # are mapped again for each typing reference
+    collapsed = []
+    if args.collapse:
+        left_map_reads = os.path.splitext(left_reads)[0] + '_collapsed.fastq'
+        right_map_reads = os.path.splitext(right_reads)[0] + '_collapsed.fastq'
+        map_deps = [pipeline.add('left collapse', lambda: log_collapse(left_reads, left_map_reads)),
+            pipeline.add('right collapse', lambda: log_collapse(right_reads, right_map_reads))]
+        collapsed = [left_map_reads, right_map_reads]
+    if args.single_map:
+        map_stage = pipeline.add('map', lambda: map_ends_together(args, reference, left_map_reads, right_map_reads, left_sam, right_sam, temp_folder), map_deps, cpus=int(args.t), temp_inputs=collapsed)
+        return map_stage, map_stage
+    left_map = pipeline.add('left map', lambda: run_command(bwa_mem_command(args, reference, left_map_reads, left_sam), shell=True), map_deps[:1], cpus=int(args.t), temp_inputs=collapsed[:1])
+    right_map = pipeline.add('right map', lambda: run_command(bwa_mem_command(args, reference, right_map_reads, right_sam), shell=True), map_deps[1:], cpus=int(args.t), temp_inputs=collapsed[1:])
+    return left_map, right_map
+
+def add_coverage_stages(pipeline, args, samtools_runner, end, map_stage, to_ref_sam, to_ref_bam, bam_sorted, cov_bed, final_cov, merged_bed, cov_merged=None):
+    '''
+    Adds the stages turning the mapped reads for one end into a sorted,
+    indexed bam and coverage BED files: the full coverage merged
+    (if cov_merged is given), and the coverage above the cutoff merged.
+    '''
+
+    # The reads may already have been mapped, outside the pipeline
+    map_deps = [map_stage] if map_stage is not None else []
+    view = pipeline.add(end + ' view', lambda: run_command(samtools_runner.view(to_ref_bam, to_ref_sam), shell=True), map_deps, temp_inputs=[to_ref_sam])
+    sort = pipeline.add(end + ' sort', lambda: run_command(samtools_runner.sort(bam_sorted, to_ref_bam), shell=True), [view], temp_inputs=[to_ref_bam])
+    pipeline.add(end + ' index', lambda: run_command(samtools_runner.index(bam_sorted), shell=True), [sort])
+    # Create BED file with coverage information, counting
+    # every copy of collapsed reads
+    if args.collapse:
+        coverage = pipeline.add(end + ' coverage', lambda: weighted_coverage(to_ref_sam, cov_bed), map_deps, temp_inputs=[to_ref_sam])
+    else:
+        coverage = pipeline.add(end + ' coverage', lambda: run_command(['bedtools', 'genomecov', '-ibam', bam_sorted + '.bam', '-bg', '>', cov_bed], shell=True), [sort])
+    if cov_merged is not None:
+        pipeline.add(end + ' merge coverage', lambda: run_command(['bedtools', 'merge', '-d', args.merging, '-i', cov_bed, '>', cov_merged], shell=True), [coverage], temp_inputs=[cov_bed])
+    # Filter coverage on the cutoff (so only take
+    # high coverage regions for further analysis)
+    depth = pipeline.add(end + ' filter', lambda: filter_on_depth(cov_bed, final_cov, args.cutoff), [coverage], temp_inputs=[cov_bed])
+    pipeline.add(end + ' merge', lambda: run_command(['bedtools', 'merge', '-d', args.merging, '-i', final_cov, '>', merged_bed], shell=True), [depth])
+
+def prepare_indexes(args, index_folder):
+    '''
+    Writes each query, and the typing references if typing, to a fasta
+    file in the index folder and builds their indexes, so that they are
+    only built once and shared by every sample in the run.
+    Indexes already in the index folder (from --index_dir) are reused,
+    unless the query has changed or the typing reference is newer.
+    Returns a list of (query name, query fasta) and a list of
+    (reference name, reference genbank, reference fasta) for the typing
+    references (empty if not typing).
+    '''
+
+    queries = []
+    for query in SeqIO.parse(args.queries, 'fasta'):
+        # need to write out each query to a file
+        # otherwise it can't be indexed etc
+        query_fasta = index_folder + query.id + '.fasta'
+        if os.path.exists(query_fasta) and str(SeqIO.read(query_fasta, 'fasta').seq) != str(query.seq):
+            logging.info('Query {} has changed, rebuilding its indexes'.format(query.id))
+            clear_index(query_fasta)
+        if not os.path.exists(query_fasta):
+            SeqIO.write(query, query_fasta, 'fasta')
+        # Index the IS query for BWA, and create BLAST database
+        # if known hits are checked with BLAST
+        bwa_index(query_fasta)
+        if args.between_check == 'blast':
+            check_blast_database(query_fasta)
+        queries.append((query.id, query_fasta))
+    typing_refs = []
+    if args.runtype == 'typing':
+        for typingRef in args.typingRef:
+            # Get prefix of typing reference for output filenames
+            (file_path, file_name) = os.path.split(typingRef)
+            typingName = file_name.split('.g')[0]
+            if typingName in [ref[0] for ref in typing_refs]:
+                logging.error('Typing references must have different names: {}'.format(typingRef))
+                exit(-1)
+            # Create reference fasta from genbank, and bwa index for it
+            typingRefFasta = index_folder + typingName + '.fasta'
+            if os.path.exists(typingRefFasta) and os.path.getmtime(typingRef) > os.path.getmtime(typingRefFasta):
+                logging.info('Typing reference {} has changed, rebuilding its indexes'.format(typingRef))
+                clear_index(typingRefFasta)
+            if not os.path.exists(typingRefFasta):
+                gbk_to_fasta(typingRef, typingRefFasta)
+            bwa_index(typingRefFasta)
+            typing_refs.append((typingName, typingRef, typingRefFasta))
+    return queries, typing_refs
+
+def output_prefix(current_dir, sample, query_name, typingName=None):
+    '''
+    Returns the prefix for the output files of a sample and query,
+    with the name of the typing reference added if given.
+    '''
+
+    prefix = current_dir + sample + '_' + query_name
+    if typingName is not None:
+        prefix += '_' + typingName
+    return prefix
+
+def number_of_chunks(read_bytes, chunk_size):
+    '''
+    Returns the number of chunks to split reads of read_bytes into,
+    so that each chunk is about chunk_size MB (0 means don't split).
+    '''
+
+    if chunk_size <= 0:
+        return 1
+    return max(1, int(math.ceil(read_bytes / (chunk_size * 1024.0 * 1024.0))))
+
+def open_reads(read_file):
+    if read_file.endswith('.gz'):
+        return gzip.open(read_file)
+    return io.open(read_file, 'rb')
+
+def read_position(reads):
+    '''
+    Returns how far into the read file (as it is on disk,
+    so compressed for .gz files) reads has got.
+    '''
+
+    if isinstance(reads, gzip.GzipFile):
+        return reads.fileobj.tell()
+    return reads.tell()
+
+class ReadPairSplitter(object):
+    '''
+    Splits a pair of read files into chunks, one chunk at a time, so
+    each chunk can be mapped while the next one is being written.
+    Chunks are saved gzipped as <prefix>_1.fastq.gz and
+    <prefix>_2.fastq.gz, and mates stay in the same chunk. Each chunk
+    holds the reads from an equal share of the forward read file as it
+    is on disk, so a chunk takes about as much space as that share.
+    '''
+
+    def __init__(self, forward_read, reverse_read, chunks):
+        self.forward_read = forward_read
+        self.reverse_read = reverse_read
+        self.chunks = chunks
+        self.forward_bytes = os.path.getsize(forward_read)
+        self.forward_in = None
+        self.reverse_in = None
+        self.records = None
+
+    def write_chunk(self, chunk, chunk_prefix):
+        '''
+        Writes the next chunk of read pairs, chunks must be
+        written in order.
+        '''
+
+        if self.records is None:
+            self.forward_in = open_reads(self.forward_read)
+            self.reverse_in = open_reads(self.reverse_read)
+            self.records = itertools.izip(itertools.izip(*[self.forward_in] * 4), itertools.izip(*[self.reverse_in] * 4))
+        last = chunk == self.chunks - 1
+        chunk_end = self.forward_bytes * (chunk + 1) // self.chunks
+        # Fast compression, the chunks are only read once by bwa
+        forward_out = gzip.open(chunk_prefix + '_1.fastq.gz', 'wb', compresslevel=1)
+        reverse_out = gzip.open(chunk_prefix + '_2.fastq.gz', 'wb', compresslevel=1)
+        for forward_record, reverse_record in self.records:
+            forward_out.writelines(forward_record)
+            reverse_out.writelines(reverse_record)
+            if not last and read_position(self.forward_in) >= chunk_end:
+                break
+        forward_out.close()
+        reverse_out.close()
+        if last:
+            self.forward_in.close()
+            self.reverse_in.close()
+
+def chunk_split_action(splitter, chunk, chunk_prefix):
+    return lambda: splitter.write_chunk(chunk, chunk_prefix)
+
+def chunk_map_action(args, query_tmp, chunk_prefix):
+    '''
+    Returns a function that maps a chunk of reads (see ReadPairSplitter)
+    to the IS query, saving the alignments to <prefix>.sam.
+    '''
+
+    return lambda: run_command(['bwa', 'mem', '-t', args.t, query_tmp, chunk_prefix + '_1.fastq.gz', chunk_prefix + '_2.fastq.gz', '>', chunk_prefix + '.sam'], shell=True)
+
+def add_flank_stages(pipeline, args, samtools_runner, name, file_prefix, output_sam, deps):
+    '''
+    Adds the stages that pull the reads flanking the IS out of the
+    reads mapped to it in output_sam, and the reads soft clipped at
+    its ends, saving them to <file_prefix>_LeftFinal.fastq and
+    <file_prefix>_RightFinal.fastq.
+    The stage names start with name. Returns the names of the last stages.
+    '''
+
+    left_bam = file_prefix + '_left.bam'
+    right_bam = file_prefix + '_right.bam'
+    left_reads = file_prefix + '_left.fastq'
+    right_reads = file_prefix + '_right.fastq'
+    left_clipped_reads = file_prefix + '_left_clipped.fastq'
+    right_clipped_reads = file_prefix + '_right_clipped.fastq'
+    final_left_reads = file_prefix + '_LeftFinal.fastq'
+    final_right_reads = file_prefix + '_RightFinal.fastq'
+    left_view = pipeline.add(name + 'left view', lambda: run_command(samtools_runner.view(left_bam, output_sam, smallF = 36), shell=True), deps, temp_inputs=[output_sam])
+    right_view = pipeline.add(name + 'right view', lambda: run_command(samtools_runner.view(right_bam, output_sam, smallF = 4, bigF = 40), shell=True), deps, temp_inputs=[output_sam])
+    # Turn bams to reads for mapping
+    left_fastq = pipeline.add(name + 'left bamtofastq', lambda: run_command(['bedtools', 'bamtofastq', '-i', left_bam, '-fq', left_reads], shell=True), [left_view], temp_inputs=[left_bam])
+    right_fastq = pipeline.add(name + 'right bamtofastq', lambda: run_command(['bedtools', 'bamtofastq', '-i', right_bam, '-fq', right_reads], shell=True), [right_view], temp_inputs=[right_bam])
+    clipped = pipeline.add(name + 'extract clipped', lambda: extract_clipped_reads(output_sam, args.min_clip, args.max_clip, left_clipped_reads, right_clipped_reads), deps, temp_inputs=[output_sam])
+    left_cat = pipeline.add(name + 'left cat', lambda: run_command(['cat', left_clipped_reads, left_reads, '>', final_left_reads], shell=True), [left_fastq, clipped], temp_inputs=[left_clipped_reads, left_reads])
+    right_cat = pipeline.add(name + 'right cat', lambda: run_command(['cat', right_clipped_reads, right_reads, '>', final_right_reads], shell=True), [right_fastq, clipped], temp_inputs=[right_clipped_reads, right_reads])
+    return [left_cat, right_cat]
+
+# Header of the table written when a sample has no hits
+NO_HITS_HEADERS = {'typing': ["region", "orientation", "x", "y", "gap", "call", "%ID", "%Cov", "left_gene", "left_strand", "left_distance", "right_gene", "right_strand", "right_distance", "functional_prediction"],
+    'improvement': ['contig', 'end', 'x', 'y']}
+
+def write_no_hits(no_hits_table, runtype):
+    with open(no_hits_table, 'w') as f:
+        f.write('\t'.join(NO_HITS_HEADERS[runtype]) + '\nNo hits found')
+    # Typing runs also write binary hit records (see hit_records.py)
+    if runtype == 'typing':
+        write_hits(no_hits_table.replace('_table.txt', '_table.hits'), [])
+
+def extract_flanks(args, samtools_runner, sample, forward_read, reverse_read, query_name, query_tmp, current_dir, output_names=None):
+    '''
+    Maps the reads of a sample to the IS query, and pulls out the reads
+    flanking the IS along with the reads soft clipped at its ends.
+    Returns a dictionary of the files for this sample and query, or None
+    if there are no flanking reads, in which case an empty table is
+    written for each of the output_names (see output_prefix).
+    '''
+
+    if output_names is None:
+        output_names = [None]
+
+    read_bytes = os.path.getsize(forward_read) + os.path.getsize(reverse_read)
+    if metrics is not None:
+        metrics.set_sample(sample, query_name, read_bytes)
+
+    # Create the output file and folder names,
+    # make the folders where necessary
+    temp_folder = current_dir + sample + '_' + query_name + '_temp/'
+    file_prefix = temp_folder + sample + '_' + query_name
+    final_left_reads = file_prefix + '_LeftFinal.fastq'
+    final_right_reads = file_prefix + '_RightFinal.fastq'
+    make_directories([temp_folder])
+
+    # Pull unmapped reads flanking IS, and add the corresponding clipped
+    # reads to their respective left and right ends, running the left
+    # and right ends at the same time if we can
+    logging.info('Extracting soft clipped reads, selecting reads that are <= ' + str(args.max_clip) + 'bp and >= ' + str(args.min_clip) + 'bp')
+    flanks_pipeline = Pipeline(args.cpus, remove_temp=not args.temp)
+    chunks = number_of_chunks(read_bytes, args.chunk_size)
+    if chunks == 1:
+        # Map to IS query
+        output_sam = file_prefix + '.sam'
+        map_stage = flanks_pipeline.add('map', lambda: run_command(['bwa', 'mem', '-t', args.t, query_tmp, forward_read, reverse_read, '>', output_sam], shell=True), cpus=int(args.t))
+        add_flank_stages(flanks_pipeline, args, samtools_runner, '', file_prefix, output_sam, [map_stage])
+    else:
+        # Split the reads into chunks, map each chunk to the IS query and
+        # find its flanking reads, then gather the flanking reads together.
+        # The split is one pass through the reads in Python, done a chunk
+        # at a time so each chunk is mapped while the next one is written
+        logging.info('Splitting {} MB of reads into {} chunks'.format(read_bytes // (1024 * 1024), chunks))
+        chunk_prefixes = [file_prefix + '_chunk' + str(chunk) for chunk in range(chunks)]
+        splitter = ReadPairSplitter(forward_read, reverse_read, chunks)
+        split_stage = None
+        chunk_stages = []
+        for chunk, chunk_prefix in enumerate(chunk_prefixes):
+            name = os.path.basename(chunk_prefix) + ' '
+            split_stage = flanks_pipeline.add(name + 'split', chunk_split_action(splitter, chunk, chunk_prefix), [split_stage] if split_stage else [])
+            map_stage = flanks_pipeline.add(name + 'map', chunk_map_action(args, query_tmp, chunk_prefix), [split_stage], cpus=int(args.t), temp_inputs=[chunk_prefix + '_1.fastq.gz', chunk_prefix + '_2.fastq.gz'])
+            chunk_stages += add_flank_stages(flanks_pipeline, args, samtools_runner, name, chunk_prefix, chunk_prefix + '.sam', [map_stage])
+        chunk_left_reads = [prefix + '_LeftFinal.fastq' for prefix in chunk_prefixes]
+        chunk_right_reads = [prefix + '_RightFinal.fastq' for prefix in chunk_prefixes]
+        flanks_pipeline.add('left gather', lambda: run_command(['cat'] + chunk_left_reads + ['>', final_left_reads], shell=True), chunk_stages, temp_inputs=chunk_left_reads)
+        flanks_pipeline.add('right gather', lambda: run_command(['cat'] + chunk_right_reads + ['>', final_right_reads], shell=True), chunk_stages, temp_inputs=chunk_right_reads)
+    flanks_pipeline.run()
+    print 'Usage after reads concatenated onto previous reads'
+    print ('Memory usage: %s (kb)' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+    if os.stat(final_left_reads)[6] == 0 or os.stat(final_right_reads)[6] == 0:
+        logging.info('One or both read files are empty. This is probably due to no copies of the IS of interest being present in this sample. Program quitting.')
+        for name in output_names:
+            write_no_hits(output_prefix(current_dir, sample, query_name, name) + '_table.txt', args.runtype)
+        remove_temp_directory(args.temp, temp_folder)
+        return None
+
+    return {'sample': sample, 'query_name': query_name, 'query_tmp': query_tmp, 'read_bytes': read_bytes,
+        'temp_folder': temp_folder, 'left_reads': final_left_reads, 'right_reads': final_right_reads}
+
+def improve_unit(args, samtools_runner, unit, assembly, current_dir, profile_args):
+    '''
+    Maps the flanking reads of a sample and query to its assembly,
+    and annotates the assembly with the IS positions found.
+    Returns the prefixes of the sorted bams for the left and right ends.
+    '''
+
+    sample = unit['sample']
+    query_name = unit['query_name']
+    temp_folder = unit['temp_folder']
+    # Get prefix for output filenames
+    left_header = sample + '_left'
+    right_header = sample + '_right'
+    left_to_ref_sam = temp_folder + left_header + '_' + query_name + '.sam'
+    right_to_ref_sam = temp_folder + right_header + '_' + query_name + '.sam'
+    left_to_ref_bam = temp_folder + left_header + '_' + query_name + '.bam'
+    right_to_ref_bam = temp_folder + right_header + '_' + query_name + '.bam'
+    left_bam_sorted = current_dir + left_header + '_' + query_name + '.sorted'
+    right_bam_sorted = current_dir + right_header + '_' + query_name + '.sorted'
+    left_cov_bed = temp_folder + left_header + '_' + query_name + '_cov.bed'
+    right_cov_bed = temp_folder + right_header + '_' + query_name + '_cov.bed'
+    left_final_cov =  current_dir + left_header + '_' + query_name + '_finalcov.bed'
+    right_final_cov = current_dir + right_header + '_' + query_name + '_finalcov.bed'
+    left_merged_bed = current_dir + left_header + '_' + query_name + '_merged.sorted.bed'
+    right_merged_bed = current_dir + right_header + '_' + query_name + '_merged.sorted.bed'
+    final_genbankSingle = current_dir + sample + '_' + query_name + '_annotatedSingle.gbk'
+
+    # create fasta file from genbank if required
+    if args.extension == '.gbk':
+        assembly_gbk = assembly
+        (file_path, file_name_before_ext, full_ext) = get_readFile_components(assembly_gbk)
+        assembly_fasta = os.path.join(temp_folder, file_name_before_ext) + '.fasta'
+        gbk_to_fasta(assembly, assembly_fasta)
+        assembly = assembly_fasta
+    # Map ends back to contigs
+    bwa_index(assembly)
+    # Map the ends, then get their coverage, running
+    # the left and right ends at the same time if we can
+    ends_pipeline = Pipeline(args.cpus, remove_temp=not args.temp)
+    left_map, right_map = add_mapping_stages(ends_pipeline, args, assembly, unit['left_reads'], unit['right_reads'], left_to_ref_sam, right_to_ref_sam, temp_folder)
+    add_coverage_stages(ends_pipeline, args, samtools_runner, 'left', left_map, left_to_ref_sam, left_to_ref_bam, left_bam_sorted, left_cov_bed, left_final_cov, left_merged_bed)
+    add_coverage_stages(ends_pipeline, args, samtools_runner, 'right', right_map, right_to_ref_sam, right_to_ref_bam, right_bam_sorted, right_cov_bed, right_final_cov, right_merged_bed)
+    ends_pipeline.run()
+    # Create table and genbank
+    if args.extension == '.fasta':
+        run_command([args.path + 'create_genbank_table.py', '--left_bed', left_merged_bed, '--right_bed', right_merged_bed, '--assembly', assembly, '--type fasta', '--output', current_dir + sample + '_' + query_name] + profile_args, shell=True)
+    elif args.extension == '.gbk':
+        run_command([args.path + 'create_genbank_table.py', '--left_bed', left_merged_bed, '--right_bed', right_merged_bed, '--assembly', assembly_gbk, '--type genbank', '--output', current_dir + sample + '_' + query_name] + profile_args, shell=True)
+    #create single entry genbank
+    multi_to_single(sample + '_' + query_name + '_annotated.gbk', sample, final_genbankSingle)
+    return left_bam_sorted, right_bam_sorted
+
+def hit_windows(hits_bed, chrom, window, windows_bed):
+    '''
+    Writes a BED file of the regions within window bp of each hit in the
+    _hits.bed file written by create_typing_out.py, on the reference
+    sequence chrom. Returns the number of hits.
+    '''
+
+    hits = 0
+    with open(hits_bed) as hits_in, open(windows_bed, 'w') as out:
+        for line in hits_in:
+            if line.startswith('#') or line.strip() == '':
+                continue
+            info = line.split('\t')
+            start = min(int(info[1]), int(info[2]))
+            end = max(int(info[1]), int(info[2]))
+            out.write('{}\t{}\t{}\n'.format(chrom, max(0, start - window), end + window))
+            hits += 1
+    return hits
+
+def slim_bams(args, samtools_runner, output, typingRefFasta, bam_prefixes, temp_folder):
+    '''
+    Saves the alignments within --slim_window of each hit in the
+    sorted bams (given by their prefixes) as <prefix>_slim.bam,
+    along with their indexes.
+    '''
+
+    hits_bed = output + '_hits.bed'
+    if not os.path.isfile(hits_bed):
+        return
+    # The hits are named after the reference in the genbank (or --chr_name),
+    # the bams after the first sequence in the reference fasta
+    with open(typingRefFasta) as fasta:
+        chrom = fasta.readline()[1:].split()[0]
+    windows_bed = temp_folder + os.path.basename(output) + '_hit_windows.bed'
+    if hit_windows(hits_bed, chrom, args.slim_window, windows_bed) == 0:
+        return
+    for bam_prefix in bam_prefixes:
+        run_command(samtools_runner.view_regions(bam_prefix + '_slim.bam', bam_prefix + '.bam', windows_bed), shell=True)
+        run_command(samtools_runner.index(bam_prefix + '_slim'), shell=True)
+
+def typing_files(unit, typingName, current_dir):
+    '''
+    Creates the names of the files for typing a sample and query
+    against a reference.
+    Returns a dictionary where the key is the file and the value its path.
+    '''
+
+    sample = unit['sample']
+    query_name = unit['query_name']
+    temp_folder = unit['temp_folder']
+    files = {}
+    for end in ['left', 'right']:
+        # Set up file names for output files
+        header = sample + '_' + end + '_' + typingName
+        files[end + '_to_ref_sam'] = temp_folder + header + '_' + query_name + '.sam'
+        files[end + '_to_ref_bam'] = temp_folder + header + '_' + query_name + '.bam'
+        files[end + '_bam_sorted'] = current_dir + header + '_' + query_name + '.sorted'
+        files[end + '_cov_bed'] = temp_folder + header + '_' + query_name + '_cov.bed'
+        files[end + '_cov_merged'] = temp_folder + header + '_' + query_name + '_cov_merged.sorted.bed'
+        files[end + '_final_cov'] = current_dir + header + '_' + query_name + '_finalcov.bed'
+        files[end + '_merged_bed'] = current_dir + header + '_' + query_name + '_merged.sorted.bed'
+        files['bed_unpaired_' + end] = current_dir + sample + '_' + typingName + '_' + query_name + '_' + end + '_unpaired.bed'
+    files['bed_intersect'] = current_dir + sample + '_' + typingName + '_' + query_name + '_intersect.bed'
+    files['bed_closest'] = current_dir + sample + '_' + typingName + '_' + query_name + '_closest.bed'
+    return files
+
+def run_typing_out(typing_out_command, profile_args):
+    '''
+    Runs create_typing_out.py, in this process if in_process_typing_out
+    is set (by ismap_daemon.py), otherwise as a command.
+    In this process it is already covered by the profile of ISMapper,
+    so profile_args are only passed to the command.
+    '''
+
+    if not in_process_typing_out:
+        run_command(typing_out_command + profile_args, shell=True)
+        return
+    import create_typing_out
+    command_str = ' '.join(typing_out_command)
+    logging.info('Running in process: {}'.format(command_str))
+    start_time = time.time()
+    try:
+        create_typing_out.main(shlex.split(' '.join(typing_out_command[1:])))
+    except SystemExit as e:
+        # create_typing_out.py exits early when there are no hits
+        if e.code not in [None, 0]:
+            raise CommandError({"message": "Command '{}' failed with exit status: {}".format(command_str, e.code)})
+    logging.info('Finished in {:.2f} s: {}'.format(time.time() - start_time, command_str))
+
+def type_unit(args, samtools_runner, unit, typing_ref, output, current_dir, profile_args, mapped=False):
+    '''
+    Maps the flanking reads of a sample and query to a typing reference
+    (name, genbank, fasta), and finds the IS positions in the reference.
+    The table and other results are saved with the prefix output.
+    If mapped is True, the reads have already been mapped (see batch_map).
+    Returns the prefixes of the sorted bams for the left and right ends.
+    '''
+
+    if metrics is not None:
+        metrics.set_sample(unit['sample'], unit['query_name'], unit['read_bytes'])
+    temp_folder = unit['temp_folder']
+    typingName, typingRef, typingRefFasta = typing_ref
+    files = typing_files(unit, typingName, current_dir)
+    left_merged_bed = files['left_merged_bed']
+    right_merged_bed = files['right_merged_bed']
+    bed_intersect = files['bed_intersect']
+    bed_closest = files['bed_closest']
+    bed_unpaired_left = files['bed_unpaired_left']
+    bed_unpaired_right = files['bed_unpaired_right']
+
+    # Map reads to reference, then get their coverage, running
+    # the left and right ends at the same time if we can
+    ends_pipeline = Pipeline(args.cpus, remove_temp=not args.temp)
+    if mapped:
+        left_map, right_map = None, None
+    else:
+        left_map, right_map = add_mapping_stages(ends_pipeline, args, typingRefFasta, unit['left_reads'], unit['right_reads'], files['left_to_ref_sam'], files['right_to_ref_sam'], temp_folder)
+    for end, map_stage in [('left', left_map), ('right', right_map)]:
+        add_coverage_stages(ends_pipeline, args, samtools_runner, end, map_stage, files[end + '_to_ref_sam'], files[end + '_to_ref_bam'],
+            files[end + '_bam_sorted'], files[end + '_cov_bed'], files[end + '_final_cov'], files[end + '_merged_bed'], files[end + '_cov_merged'])
+    ends_pipeline.run()
+    # Find intersects and closest points of regions
+    run_command(['bedtools', 'intersect', '-a', left_merged_bed, '-b', right_merged_bed, '-wo', '>', bed_intersect], shell=True)
+    # if one or more of the bed files are empty, then closestBed returns an error
+    # that needs to be caught
+    try:
+        run_command(['closestBed', '-a', left_merged_bed, '-b', right_merged_bed, '-d', '>', bed_closest], shell=True)
+    except BedtoolsError:
+        write_no_hits(output + '_table.txt', 'typing')
+        return files['left_bam_sorted'], files['right_bam_sorted']
+    # Create all possible closest bed files for checking unpaired hits
+    # If any of these fail, just make empty unapired files to pass to create_typing_out
+    try:
+        run_command(['closestBed', '-a', left_merged_bed, '-b', files['right_cov_merged'], '-d', '>', bed_unpaired_left], shell=True)
+    except BedtoolsError:
+        if not os.path.isfile(bed_unpaired_left) or os.stat(bed_unpaired_left)[6] == 0:
+            open(bed_unpaired_left, 'w').close()
+    try:
+        run_command(['closestBed', '-a', files['left_cov_merged'], '-b', right_merged_bed, '-d', '>', bed_unpaired_right], shell=True)
+    except BedtoolsError:
+        if not os.path.isfile(bed_unpaired_right) or os.stat(bed_unpaired_right)[6] == 0:
+            open(bed_unpaired_right, 'w').close()
+    # Create table and annotate genbank with hits
+    if args.igv:
+        igv_flag = '1'
+    else:
+        igv_flag = '0'
+    typing_out_command = [args.path + 'create_typing_out.py', '--intersect', bed_intersect, '--closest', bed_closest,
+        '--left_bed', left_merged_bed, '--right_bed', right_merged_bed,
+        '--left_unpaired', bed_unpaired_left, '--right_unpaired', bed_unpaired_right,
+        '--seq', unit['query_tmp'], '--ref', typingRef, '--temp', temp_folder,
+        '--cds', args.cds, '--trna', args.trna, '--rrna', args.rrna, '--min_range', args.min_range,
+        '--max_range', args.max_range, '--output', output, '--igv', igv_flag, '--chr_name', args.chr_name]
+    if args.blast_cache:
+        typing_out_command += ['--blast_cache', args.blast_cache, '--blast_cache_size', str(args.blast_cache_size)]
+    if args.annotated_gbk:
+        typing_out_command.append('--genbank')
+    if args.between_check != 'blast':
+        typing_out_command += ['--between_check', args.between_check]
+    run_typing_out(typing_out_command, profile_args)
+    if args.slim_bam:
+        slim_bams(args, samtools_runner, output, typingRefFasta, [files['left_bam_sorted'], files['right_bam_sorted']], temp_folder)
+    return files['left_bam_sorted'], files['right_bam_sorted']
+
+def batch_map(args, units, typing_ref, current_dir):
+    '''
+    Maps the left and right end reads of every sample to a typing
+    reference in one bwa run, with each read tagged with its sample
+    and end, then splits the alignments back into a SAM file for
+    each sample and end.
+    '''
+
+    typingName, typingRef, typingRefFasta = typing_ref
+    query_name = units[0]['query_name']
+    batch_folder = current_dir + query_name + '_' + typingName + '_batch_temp/'
+    make_directories([batch_folder])
+    tagged_reads = batch_folder + query_name + '_tagged_ends.fastq'
+    tagged_sam = batch_folder + query_name + '_tagged_ends.sam'
+    fastq_files = []
+    outputs = {}
+    for number, unit in enumerate(units):
+        files = typing_files(unit, typingName, current_dir)
+        for end in ['left', 'right']:
+            reads = unit[end + '_reads']
+            # Reads are only collapsed within a sample
+            if args.collapse:
+                collapsed = os.path.splitext(reads)[0] + '_collapsed.fastq'
+                log_collapse(reads, collapsed)
+                reads = collapsed
+            tag = 'unit' + str(number) + '_' + end
+            fastq_files.append((tag, reads))
+            outputs[tag] = files[end + '_to_ref_sam']
+    tag_reads(fastq_files, tagged_reads)
+    # The collapsed reads have been copied into the tagged reads
+    if args.collapse and not args.temp:
+        for tag, reads in fastq_files:
+            os.remove(reads)
+    if metrics is not None:
+        metrics.set_sample('-', query_name, 0)
+    logging.info('Mapping the flanking reads of {} samples at once'.format(len(units)))
+    run_command(bwa_mem_command(args, typingRefFasta, tagged_reads, tagged_sam), shell=True)
+    split_tagged_sam(tagged_sam, outputs)
+    remove_temp_directory(args.temp, batch_folder)
+
 def remove_temp_directory(keep_temp, temp_folder):
     if not keep_temp:
         run_command(['rm', '-rf', temp_folder], shell=True)
@@ -460,11 +1292,18 @@ def remove_bams(keep_bam, five_bam_sorted, three_bam_sorted):
     if not keep_bam:
         run_command(['rm', five_bam_sorted + '.bam', three_bam_sorted + '.bam', five_bam_sorted + '.bam.bai', three_bam_sorted + '.bam.bai'], shell=True)
 
-def main():
+def main(arguments=None):
+    '''
+    Runs ISMapper on the command line arguments, or on a list of
+    arguments if given (as ismap_daemon.py does for each job).
+    '''
+
+    global metrics
 
     start_time = time.time()
 
-    args = parse_args()
+    args = parse_args(arguments)
+    start_profiling(args.profile, 'ismap')
 
     samtools_runner = RunSamtools()
 
@@ -489,12 +1328,15 @@ def main():
         format='%(asctime)s %(message)s',
         datefmt='%m/%d/%Y %H:%M:%S')
     logging.info('program started')
-    logging.info('command line: {0}'.format(' '.join(sys.argv)))
+    if arguments is None:
+        arguments = sys.argv[1:]
+    logging.info('command line: {0}'.format(' '.join([sys.argv[0]] + arguments)))
 
     # Checks that the correct programs are installed
     check_command(['bwa'], 'bwa')
     #check_command(['samtools'], 'samtools')
-    check_command(['makeblastdb'], 'blast')
+    if args.between_check == 'blast':
+        check_command(['makeblastdb'], 'blast')
     check_command(['bedtools'], 'bedtools')
 
     # Checks to make sure the runtype is valid and provides an error if not
@@ -508,243 +1350,92 @@ def main():
     args.trna = ' '.join(args.trna)
     args.rrna = ' '.join(args.rrna)
 
+    # Pass profiling on to the scripts we run
+    if args.profile:
+        profile_args = ['--profile', args.profile]
+    else:
+        profile_args = []
+
+    if args.metrics:
+        metrics = MetricsWriter(args.metrics, args.runtype)
+
+    # Create the output folder name
+    if args.directory == '':
+        current_dir = os.getcwd() + '/'
+    else:
+        current_dir = args.directory
+    if current_dir[-1] != '/':
+        current_dir = current_dir + '/'
+
     # Gather together the reads in pairs with their corresponding
     # assemblies (if required)
     fileSets = read_file_sets(args)
-    # Start analysing each read set specified
-    for sample in fileSets:
-        forward_read = fileSets[sample][0]
-        reverse_read = fileSets[sample][1]
-        try:
-            assembly = fileSets[sample][2]
-        except IndexError:
-            pass
-
-        # Read in the queries
-        query_records = SeqIO.parse(args.queries, 'fasta')
-        # Cycle through each query on its own before moving onto the next one
-        for query in query_records:
-            # get the name of the query to set up file names
-            query_name = query.id
-
-            # Create the output file and folder names,
-            # make the folders where necessary
-            if args.directory == '':
-                current_dir = os.getcwd() + '/'
-            else:
-                current_dir = args.directory
-            if current_dir[-1] != '/':
-                current_dir = current_dir + '/'
-
-            temp_folder = current_dir + sample + '_' + query_name + '_temp/'
-            output_sam = temp_folder + sample + '_' + query_name + '.sam'
-            left_bam = temp_folder + sample + '_' + query_name + '_left.bam'
-            right_bam = temp_folder + sample + '_' + query_name + '_right.bam'
-            left_reads = temp_folder + sample + '_' + query_name + '_left.fastq'
-            right_reads = temp_folder + sample + '_' + query_name + '_right.fastq'
-            left_clipped_reads = temp_folder + sample + '_' + query_name + '_left_clipped.fastq'
-            right_clipped_reads = temp_folder + sample + '_' + query_name + '_right_clipped.fastq'
-            final_left_reads = temp_folder + sample + '_' + query_name + '_LeftFinal.fastq'
-            final_right_reads = temp_folder + sample + '_' + query_name + '_RightFinal.fastq'
-            no_hits_table = current_dir + sample + '_' + query_name + '_table.txt'
-            make_directories([temp_folder])
-
-            # need to write out each query to a temp file
-            # otherwise it can't be indexed etc
-            query_tmp = temp_folder + query_name + '.fasta'
-            SeqIO.write(query, query_tmp, 'fasta')
-
-            # Index the IS query for BWA
-            bwa_index(query_tmp)
-
-            # Map to IS query
-            run_command(['bwa', 'mem', '-t', args.t, query_tmp, forward_read, reverse_read, '>', output_sam], shell=True)
-            # Pull unmapped reads flanking IS
-            run_command(samtools_runner.view(left_bam, output_sam, smallF = 36), shell=True)
-            run_command(samtools_runner.view(right_bam, output_sam, smallF = 4, bigF = 40), shell=True)
-            # Turn bams to reads for mapping
-            run_command(['bedtools', 'bamtofastq', '-i', left_bam, '-fq', left_reads], shell=True)
-            run_command(['bedtools', 'bamtofastq', '-i', right_bam, '-fq', right_reads], shell=True)
-            # Add corresponding clipped reads to their respective left and right ends
-            print 'Usage before extracting soft-clipped reads'
-            print ('Memory usage: %s (kb)' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-            logging.info('Extracting soft clipped reads, selecting reads that are <= ' + str(args.max_clip) + 'bp and >= ' + str(args.min_clip) + 'bp')
-            extract_clipped_reads(output_sam, args.min_clip, args.max_clip, left_clipped_reads, right_clipped_reads)
-            print 'Usage after reads written out, before concatentation'
-            print ('Memory usage: %s (kb)' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-            run_command(['cat', left_clipped_reads, left_reads, '>', final_left_reads], shell=True)
-            run_command(['cat', right_clipped_reads, right_reads, '>', final_right_reads], shell=True)
-            print 'Usage after reads concatenated onto previous reads'
-            print ('Memory usage: %s (kb)' % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
-
-            # Create BLAST database for IS query
-            check_blast_database(query_tmp)
-            if os.stat(final_left_reads)[6] == 0 or os.stat(final_right_reads)[6] == 0:
-                logging.info('One or both read files are empty. This is probably due to no copies of the IS of interest being present in this sample. Program quitting.')
-                with open(no_hits_table, 'w') as f:
-                    if args.runtype == 'typing':
-                        header = ["region", "orientation", "x", "y", "gap", "call", "%ID", "%Cov", "left_gene", "left_strand", "left_distance", "right_gene", "right_strand", "right_distance", "functional_prediction"]
-                        f.write('\t'.join(header) + '\nNo hits found')
-                    else:
-                        header = ['contig', 'end', 'x', 'y']
-                        f.write('\t'.join(header) + '\nNo hits found')
-                remove_temp_directory(args.temp, temp_folder)
-                continue
-
-            # Improvement mode
-            if args.runtype == "improvement":
-
-                # Get prefix for output filenames
-                left_header = sample + '_left'
-                right_header = sample + '_right'
-                left_to_ref_sam = temp_folder + left_header + '_' + query_name + '.sam'
-                right_to_ref_sam = temp_folder + right_header + '_' + query_name + '.sam'
-                left_to_ref_bam = temp_folder + left_header + '_' + query_name + '.bam'
-                right_to_ref_bam = temp_folder + right_header + '_' + query_name + '.bam'
-                left_bam_sorted = current_dir + left_header + '_' + query_name + '.sorted'
-                right_bam_sorted = current_dir + right_header + '_' + query_name + '.sorted'
-                left_cov_bed = temp_folder + left_header + '_' + query_name + '_cov.bed'
-                right_cov_bed = temp_folder + right_header + '_' + query_name + '_cov.bed'
-                left_final_cov =  current_dir + left_header + '_' + query_name + '_finalcov.bed'
-                right_final_cov = current_dir + right_header + '_' + query_name + '_finalcov.bed'
-                left_merged_bed = current_dir + left_header + '_' + query_name + '_merged.sorted.bed'
-                right_merged_bed = current_dir + right_header + '_' + query_name + '_merged.sorted.bed'
-                final_genbankSingle = current_dir + sample + '_' + query_name + '_annotatedSingle.gbk'
-
-                # create fasta file from genbank if required
-                if args.extension == '.gbk':
-                    assembly_gbk = assembly
-                    (file_path, file_name_before_ext, full_ext) = get_readFile_components(assembly_gbk)
-                    assembly_fasta = os.path.join(temp_folder, file_name_before_ext) + '.fasta'
-                    gbk_to_fasta(assembly, assembly_fasta)
-                    assembly = assembly_fasta
-                # Map ends back to contigs
-                bwa_index(assembly)
-                if args.a == True:
-                    run_command(['bwa', 'mem', 'a', '-T', args.T, '-t', args.t, assembly, final_left_reads, '>', left_to_ref_sam], shell=True)
-                    run_command(['bwa', 'mem', 'a', '-T', args.T, '-t', args.t, assembly, final_right_reads, '>', right_to_ref_sam], shell=True)
-                else:
-                    run_command(['bwa', 'mem', '-t', args.t, assembly, final_left_reads, '>', left_to_ref_sam], shell=True)
-                    run_command(['bwa', 'mem', '-t', args.t, assembly, final_right_reads, '>', right_to_ref_sam], shell=True)
-
-                run_command(samtools_runner.view(left_to_ref_bam, left_to_ref_sam), shell=True)
-                run_command(samtools_runner.view(right_to_ref_bam, right_to_ref_sam), shell=True)
-                run_command(samtools_runner.sort(left_bam_sorted, left_to_ref_bam), shell=True)
-                run_command(samtools_runner.sort(right_bam_sorted, right_to_ref_bam), shell=True)
-                run_command(samtools_runner.index(left_bam_sorted), shell=True)
-                run_command(samtools_runner.index(right_bam_sorted), shell=True)
-                # Create BED file with coverage information
-                run_command(['bedtools', 'genomecov', '-ibam', left_bam_sorted + '.bam', '-bg', '>', left_cov_bed], shell=True)
-                run_command(['bedtools', 'genomecov', '-ibam', right_bam_sorted + '.bam', '-bg', '>', right_cov_bed], shell=True)
-                filter_on_depth(left_cov_bed, left_final_cov, args.cutoff)
-                filter_on_depth(right_cov_bed, right_final_cov, args.cutoff)
-                run_command(['bedtools', 'merge', '-i', left_final_cov, '-d', args.merging, '>', left_merged_bed], shell=True)
-                run_command(['bedtools', 'merge', '-i', right_final_cov, '-d', args.merging, '>', right_merged_bed], shell=True)
-                # Create table and genbank
-                if args.extension == '.fasta':
-                    run_command([args.path + 'create_genbank_table.py', '--left_bed', left_merged_bed, '--right_bed', right_merged_bed, '--assembly', assembly, '--type fasta', '--output', current_dir + sample + '_' + query_name], shell=True)
-                elif args.extension == '.gbk':
-                    run_command([args.path + 'create_genbank_table.py', '--left_bed', left_merged_bed, '--right_bed', right_merged_bed, '--assembly', assembly_gbk, '--type genbank', '--output', current_dir + sample + '_' + query_name], shell=True)
-                #create single entry genbank
-                multi_to_single(sample + '_' + query_name + '_annotated.gbk', sample, final_genbankSingle)
-
-            # Typing mode
-            if args.runtype == "typing":
-
-                # Get prefix of typing reference for output filenames
-                (file_path, file_name) = os.path.split(args.typingRef)
-                typingName = file_name.split('.g')[0]
-                typingRefFasta = temp_folder + typingName + '.fasta'
-                # Create reference fasta from genbank
-                gbk_to_fasta(args.typingRef, typingRefFasta)
-                # Create bwa index file for typing reference
-                bwa_index(typingRefFasta)
-                # Set up file names for output files
-                left_header = sample + '_left_' + typingName
-                right_header = sample + '_right_' + typingName
-                left_to_ref_sam = temp_folder + left_header + '_' + query_name + '.sam'
-                right_to_ref_sam = temp_folder + right_header + '_' + query_name + '.sam'
-                left_to_ref_bam = temp_folder + left_header + '_' + query_name + '.bam'
-                right_to_ref_bam = temp_folder + right_header + '_' + query_name + '.bam'
-                left_bam_sorted = current_dir + left_header + '_' + query_name + '.sorted'
-                right_bam_sorted = current_dir + right_header + '_' + query_name + '.sorted'
-                left_cov_bed = temp_folder + left_header + '_' + query_name + '_cov.bed'
-                right_cov_bed = temp_folder + right_header + '_' + query_name + '_cov.bed'
-                left_cov_merged = temp_folder + left_header + '_' + query_name + '_cov_merged.sorted.bed'
-                right_cov_merged = temp_folder + right_header + '_' + query_name + '_cov_merged.sorted.bed'
-                left_final_cov = current_dir + left_header + '_' + query_name + '_finalcov.bed'
-                right_final_cov = current_dir + right_header + '_' + query_name + '_finalcov.bed'
-                left_merged_bed = current_dir + left_header + '_' + query_name + '_merged.sorted.bed'
-                right_merged_bed = current_dir + right_header + '_' + query_name + '_merged.sorted.bed'
-                bed_intersect = current_dir + sample + '_' + typingName + '_' + query_name + '_intersect.bed'
-                bed_closest = current_dir + sample + '_' + typingName + '_' + query_name + '_closest.bed'
-                bed_unpaired_left = current_dir + sample + '_' + typingName + '_' + query_name + '_left_unpaired.bed'
-                bed_unpaired_right = current_dir + sample + '_' + typingName + '_' + query_name + '_right_unpaired.bed'
-
-                # Map reads to reference, sort
-                if args.a == True:
-                    run_command(['bwa', 'mem', '-a', '-T', args.T, '-t', args.t, typingRefFasta, final_left_reads, '>', left_to_ref_sam], shell=True)
-                    run_command(['bwa', 'mem', '-a', '-T', args.T, '-t', args.t,typingRefFasta, final_right_reads, '>', right_to_ref_sam], shell=True)
-                else:
-                    run_command(['bwa', 'mem', '-t', args.t, typingRefFasta, final_left_reads, '>', left_to_ref_sam], shell=True)
-                    run_command(['bwa', 'mem', '-t', args.t, typingRefFasta, final_right_reads, '>', right_to_ref_sam], shell=True)
-
-                run_command(samtools_runner.view(left_to_ref_bam, left_to_ref_sam), shell=True)
-                run_command(samtools_runner.view(right_to_ref_bam, right_to_ref_sam), shell=True)
-                run_command(samtools_runner.sort(left_bam_sorted, left_to_ref_bam), shell=True)
-                run_command(samtools_runner.sort(right_bam_sorted, right_to_ref_bam), shell=True)
-                run_command(samtools_runner.index(left_bam_sorted), shell=True)
-                run_command(samtools_runner.index(right_bam_sorted), shell=True)
-
-                # Create BED files with coverage information
-                run_command(['bedtools', 'genomecov', '-ibam', left_bam_sorted + '.bam', '-bg', '>', left_cov_bed], shell=True)
-                run_command(['bedtools', 'genomecov', '-ibam', right_bam_sorted + '.bam', '-bg', '>', right_cov_bed], shell=True)
-                run_command(['bedtools', 'merge', '-d', args.merging, '-i', left_cov_bed, '>', left_cov_merged], shell=True)
-                run_command(['bedtools', 'merge', '-d', args.merging, '-i', right_cov_bed, '>', right_cov_merged], shell=True)
-                # Filter coveraged BED files on coverage cutoff (so only take
-                # high coverage regions for further analysis)
-                filter_on_depth(left_cov_bed, left_final_cov, args.cutoff)
-                filter_on_depth(right_cov_bed, right_final_cov, args.cutoff)
-                run_command(['bedtools', 'merge', '-d', args.merging, '-i', left_final_cov, '>', left_merged_bed], shell=True)
-                run_command(['bedtools', 'merge', '-d', args.merging, '-i', right_final_cov, '>', right_merged_bed], shell=True)
-                # Find intersects and closest points of regions
-                run_command(['bedtools', 'intersect', '-a', left_merged_bed, '-b', right_merged_bed, '-wo', '>', bed_intersect], shell=True)
-                # if one or more of the bed files are empty, then closestBed returns an error
-                # that needs to be caught
-                try:
-                    run_command(['closestBed', '-a', left_merged_bed, '-b', right_merged_bed, '-d', '>', bed_closest], shell=True)
-                except BedtoolsError:
-                    with open(no_hits_table, 'w') as f:
-                        header = ["region", "orientation", "x", "y", "gap", "call", "%ID", "%Cov", "left_gene", "left_strand", "left_distance", "right_gene", "right_strand", "right_distance", "functional_prediction"]
-                        f.write('\t'.join(header) + '\nNo hits found')
-                    continue
-                # Create all possible closest bed files for checking unpaired hits
-                # If any of these fail, just make empty unapired files to pass to create_typing_out
-                try:
-                    run_command(['closestBed', '-a', left_merged_bed, '-b', right_cov_merged, '-d', '>', bed_unpaired_left], shell=True)
-                except BedtoolsError:
-                    if not os.path.isfile(bed_unpaired_left) or os.stat(bed_unpaired_left)[6] == 0:
-                        open(bed_unpaired_left, 'w').close()
-                try:
-                    run_command(['closestBed', '-a', left_cov_merged, '-b', right_merged_bed, '-d', '>', bed_unpaired_right], shell=True)
-                except BedtoolsError:
-                    if not os.path.isfile(bed_unpaired_right) or os.stat(bed_unpaired_right)[6] == 0:
-                        open(bed_unpaired_right, 'w').close()
-                # Create table and annotate genbank with hits
-                if args.igv:
-                    igv_flag = '1'
-                else:
-                    igv_flag = '0'
-                run_command([args.path + 'create_typing_out.py', '--intersect', bed_intersect, '--closest', bed_closest,
-                    '--left_bed', left_merged_bed, '--right_bed', right_merged_bed,
-                    '--left_unpaired', bed_unpaired_left, '--right_unpaired', bed_unpaired_right,
-                    '--seq', query_tmp, '--ref', args.typingRef, '--temp', temp_folder,
-                    '--cds', args.cds, '--trna', args.trna, '--rrna', args.rrna, '--min_range', args.min_range,
-                    '--max_range', args.max_range, '--output', current_dir + sample + '_' + query_name, '--igv', igv_flag, '--chr_name', args.chr_name], shell=True)
-
-            # remove temp folder if required
-            remove_temp_directory(args.temp, temp_folder)
-            remove_bams(args.bam, left_bam_sorted, right_bam_sorted)
+    # Index the queries and typing reference once for all samples
+    if args.index_dir:
+        index_folder = os.path.join(args.index_dir, '')
+        make_directories([index_folder])
+    else:
+        index_folder = tempfile.mkdtemp(prefix='ismap_index_', dir=current_dir) + '/'
+    try:
+        queries, typing_refs = prepare_indexes(args, index_folder)
+        # With more than one typing reference, the outputs for
+        # each reference are named after it
+        if len(typing_refs) > 1:
+            output_names = [ref[0] for ref in typing_refs]
+        else:
+            output_names = [None] * len(typing_refs)
+        if args.batch_map and args.runtype == 'typing':
+            # Get the flanking reads of every sample for a query, then map
+            # them all to each reference at once
+            for query_name, query_tmp in queries:
+                units = []
+                for sample in fileSets:
+                    unit = extract_flanks(args, samtools_runner, sample, fileSets[sample][0], fileSets[sample][1], query_name, query_tmp, current_dir, output_names)
+                    if unit is not None:
+                        units.append(unit)
+                for typing_ref, name in zip(typing_refs, output_names):
+                    if len(units) != 0:
+                        batch_map(args, units, typing_ref, current_dir)
+                    for unit in units:
+                        output = output_prefix(current_dir, unit['sample'], query_name, name)
+                        left_bam_sorted, right_bam_sorted = type_unit(args, samtools_runner, unit, typing_ref, output, current_dir, profile_args, mapped=True)
+                        remove_bams(args.bam, left_bam_sorted, right_bam_sorted)
+                # remove temp folders if required
+                for unit in units:
+                    remove_temp_directory(args.temp, unit['temp_folder'])
+        else:
+            # Start analysing each read set specified
+            for sample in fileSets:
+                if metrics is not None:
+                    metrics.start_sample()
+                # Cycle through each query on its own before moving onto the next one
+                for query_name, query_tmp in queries:
+                    # Improvement mode
+                    if args.runtype == "improvement":
+                        unit = extract_flanks(args, samtools_runner, sample, fileSets[sample][0], fileSets[sample][1], query_name, query_tmp, current_dir)
+                        if unit is None:
+                            continue
+                        left_bam_sorted, right_bam_sorted = improve_unit(args, samtools_runner, unit, fileSets[sample][2], current_dir, profile_args)
+                        remove_bams(args.bam, left_bam_sorted, right_bam_sorted)
+                    # Typing mode, the flanking reads are found once
+                    # then typed against each reference in turn
+                    if args.runtype == "typing":
+                        unit = extract_flanks(args, samtools_runner, sample, fileSets[sample][0], fileSets[sample][1], query_name, query_tmp, current_dir, output_names)
+                        if unit is None:
+                            continue
+                        for typing_ref, name in zip(typing_refs, output_names):
+                            output = output_prefix(current_dir, sample, query_name, name)
+                            left_bam_sorted, right_bam_sorted = type_unit(args, samtools_runner, unit, typing_ref, output, current_dir, profile_args)
+                            remove_bams(args.bam, left_bam_sorted, right_bam_sorted)
+                    # remove temp folder if required
+                    remove_temp_directory(args.temp, unit['temp_folder'])
+                if metrics is not None:
+                    metrics.finish_sample(sample, os.path.getsize(fileSets[sample][0]) + os.path.getsize(fileSets[sample][1]))
+    finally:
+        # remove the shared indexes, even if a sample failed,
+        # unless they are kept in --index_dir
+        if not args.index_dir:
+            remove_temp_directory(args.temp, index_folder)
 
     total_time = time.time() - start_time
     time_mins = float(total_time) / 60
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+# Runs ISMapper as a long running service, for samples that arrive a few
+# at a time. The queries and typing references are indexed once into an
+# index directory, and the typing references are read (with their feature
+# lists) before the workers are started. Each job is then run by a worker
+# forked from the daemon, so it starts with Biopython and ISMapper already
+# loaded and the references already read, and only does the work for its
+# own sample.
+#
+# Jobs are submitted through a spool directory. A job is a file in
+# <spool>/new ending in .job, holding the ismap.py options for that sample
+# (eg: --reads /data/s1_1.fastq.gz /data/s1_2.fastq.gz --output s1
+# --directory /results/s1), which are added to the options shared by every
+# job. Write the file under another name first and rename it to .job, so
+# the daemon never reads half a job. Jobs move to <spool>/running while
+# they run, then to <spool>/done or <spool>/failed, with their output in
+# <job name>.out next to them. Creating the file <spool>/stop makes the
+# daemon finish the running jobs and exit.
+
+import os, sys, time, glob, shlex, logging, traceback, multiprocessing
+from argparse import ArgumentParser
+try:
+    # Installed, ismap.py and create_typing_out.py are in the ismap package
+    from ismap import ismap, create_typing_out
+except ImportError:
+    import ismap
+    import create_typing_out
+
+SPOOL_FOLDERS = ['new', 'running', 'done', 'failed']
+
+def parse_args():
+    '''
+    Takes arguments from the command line.
+    '''
+
+    parser = ArgumentParser(description="Run ISMapper as a service, taking jobs from a spool directory")
+    # Daemon options
+    parser.add_argument('--spool', type=str, required=True, help='Spool directory to take jobs from (see the README for its layout)')
+    parser.add_argument('--workers', type=int, required=False, default=1, help='Number of jobs to run at the same time. Default 1')
+    parser.add_argument('--poll', type=float, required=False, default=5, help='Seconds between checks for new jobs. Default 5')
+    parser.add_argument('--index_dir', type=str, required=False, help='Directory to keep the indexes of the queries and typing references in. Default is <spool>/index')
+    # ISMapper options shared by every job
+    parser.add_argument('--queries', type=str, required=True, help='Multifasta file for query gene(s) (eg: insertion sequence) that will be mapped to.')
+    parser.add_argument('--runtype', type=str, required=True, help='Runtype for the program, either improvement or typing')
+    parser.add_argument('--typingRef', nargs='+', type=str, required=False, help='Reference genome(s) for typing against in genbank format')
+    parser.add_argument('--other_args', type=str, required=False, help='String containing all other arguments to pass to ISMapper for every job')
+
+    return parser.parse_args()
+
+def shared_arguments(args):
+    '''
+    Returns the ismap.py arguments shared by every job.
+    '''
+
+    arguments = ['--queries', args.queries, '--runtype', args.runtype, '--index_dir', args.index_dir]
+    if args.typingRef:
+        arguments += ['--typingRef'] + args.typingRef
+    if args.other_args:
+        arguments += shlex.split(args.other_args)
+    return arguments
+
+def warm_up(arguments):
+    '''
+    Builds the indexes of the queries and typing references in the
+    index directory, and reads the typing references, so the workers
+    forked afterwards start with them ready.
+    '''
+
+    ismap_args = ismap.parse_args(arguments)
+    ismap.make_directories([ismap_args.index_dir])
+    queries, typing_refs = ismap.prepare_indexes(ismap_args, os.path.join(ismap_args.index_dir, ''))
+    for typingName, typingRef, typingRefFasta in typing_refs:
+        create_typing_out.warm_references[typingRef] = create_typing_out.read_reference(typingRef)
+        print 'Read typing reference ' + typingRef
+    # create_typing_out.py is run in the workers to use the references read here
+    ismap.in_process_typing_out = True
+    print 'Indexed ' + str(len(queries)) + ' queries and ' + str(len(typing_refs)) + ' typing references in ' + ismap_args.index_dir
+
+def run_job(job_file, arguments):
+    '''
+    Runs ISMapper for a job, in a worker that only runs this job.
+    The worker exits with 0 if the job succeeded, 1 if not.
+    '''
+
+    # Send the output of the job, and of the commands it runs, to its .out file
+    out = open(os.path.splitext(job_file)[0] + '.out', 'w')
+    os.dup2(out.fileno(), sys.stdout.fileno())
+    os.dup2(out.fileno(), sys.stderr.fileno())
+    # The daemon's logging is inherited, let ismap.py set up its own
+    logging.root.handlers = []
+    try:
+        with open(job_file) as job:
+            job_arguments = shlex.split(job.read())
+        ismap.main(arguments + job_arguments)
+        succeeded = True
+    except SystemExit as e:
+        succeeded = e.code in [None, 0]
+    except Exception:
+        traceback.print_exc()
+        succeeded = False
+    sys.stdout.flush()
+    sys.stderr.flush()
+    sys.exit(0 if succeeded else 1)
+
+def move_job(job_file, folder):
+    '''
+    Moves a job file, and its .out file if it has one,
+    to another folder of the spool directory.
+    Returns the new path of the job file.
+    '''
+
+    spool = os.path.dirname(os.path.dirname(job_file))
+    name = os.path.splitext(os.path.basename(job_file))[0]
+    for old_file in [job_file, os.path.splitext(job_file)[0] + '.out']:
+        if os.path.exists(old_file):
+            os.rename(old_file, os.path.join(spool, folder, os.path.basename(old_file)))
+    return os.path.join(spool, folder, name + '.job')
+
+def new_jobs(spool):
+    '''
+    Returns the jobs waiting in the spool directory, oldest first.
+    '''
+
+    return sorted(glob.glob(os.path.join(spool, 'new', '*.job')), key=os.path.getmtime)
+
+def finish_job(spool, job_file, exit_code):
+    '''
+    Moves a job whose worker has exited to done or failed.
+    '''
+
+    name = os.path.splitext(os.path.basename(job_file))[0]
+    if exit_code == 0:
+        move_job(job_file, 'done')
+        print 'Job ' + name + '.job finished'
+    else:
+        if exit_code < 0:
+            # Killed (eg: out of memory) before it could write why
+            with open(os.path.splitext(job_file)[0] + '.out', 'a') as out:
+                out.write('\nWorker killed by signal ' + str(-exit_code) + '\n')
+        move_job(job_file, 'failed')
+        print 'Job ' + name + '.job failed, see ' + os.path.join(spool, 'failed', name + '.out')
+    sys.stdout.flush()
+
+def serve(spool, arguments, workers, poll):
+    '''
+    Runs the jobs put in the spool directory until the stop file
+    is created, then waits for the running jobs to finish.
+    '''
+
+    # Each job is run by a new worker forked from the daemon. The exit code
+    # of every worker is checked, so a worker that is killed fails its job
+    # rather than leaving it running forever.
+    running = {}
+    stopping = False
+    while running or not stopping:
+        for job_file, worker in running.items():
+            if not worker.is_alive():
+                worker.join()
+                finish_job(spool, job_file, worker.exitcode)
+                del running[job_file]
+        if not stopping and os.path.exists(os.path.join(spool, 'stop')):
+            stopping = True
+            print 'Stopping, waiting for ' + str(len(running)) + ' jobs to finish'
+            sys.stdout.flush()
+        if not stopping:
+            # Jobs wait in new until a worker is free
+            for job_file in new_jobs(spool)[:workers - len(running)]:
+                job_file = move_job(job_file, 'running')
+                worker = multiprocessing.Process(target=run_job, args=(job_file, arguments))
+                worker.start()
+                running[job_file] = worker
+                print 'Job ' + os.path.basename(job_file) + ' started'
+                sys.stdout.flush()
+        if running or not stopping:
+            time.sleep(poll)
+
+def main():
+
+    args = parse_args()
+
+    for folder in SPOOL_FOLDERS:
+        if not os.path.exists(os.path.join(args.spool, folder)):
+            os.makedirs(os.path.join(args.spool, folder))
+    if not args.index_dir:
+        args.index_dir = os.path.join(args.spool, 'index')
+    # Jobs can run in other directories
+    args.index_dir = os.path.abspath(args.index_dir)
+    # Jobs left running by a daemon that was killed are run again
+    for job_file in glob.glob(os.path.join(args.spool, 'running', '*.job')):
+        move_job(job_file, 'new')
+    if os.path.exists(os.path.join(args.spool, 'stop')):
+        os.remove(os.path.join(args.spool, 'stop'))
+
+    arguments = shared_arguments(args)
+    warm_up(arguments)
+    print 'Waiting for jobs in ' + os.path.join(args.spool, 'new')
+    sys.stdout.flush()
+    serve(args.spool, arguments, args.workers, args.poll)
+
+if __name__ == '__main__':
+    main()
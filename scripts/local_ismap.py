@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+# Runs ISMapper jobs on the local machine, as a stand in for slurm_ismap.py
+# where there is no SLURM queue. Takes the same ISMapper options as
+# slurm_ismap.py, and runs one ismap.py per sample (or pack of samples) as
+# a subprocess, keeping the CPUs and memory requested by the running jobs
+# within the limits of the machine.
+
+import os, sys, time, resource, multiprocessing
+from argparse import ArgumentParser
+from subprocess import Popen, STDOUT
+from slurm_ismap import read_file_sets, runnable_samples, pack_samples, sample_size, fit_cost_model, pack_resources, walltime_to_seconds
+
+def total_memory():
+    '''
+    Returns the physical memory of the machine in MB.
+    '''
+
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+def parse_args():
+    '''
+    Takes arguments from the command line.
+    '''
+
+    parser = ArgumentParser(description="Run ISMapper jobs on the local machine")
+    # Local resource options
+    parser.add_argument('--cpus', type=int, required=False, default=multiprocessing.cpu_count(), help='Number of CPUs the jobs can use in total. Default is all CPUs on the machine')
+    parser.add_argument('--memory', type=int, required=False, default=total_memory(), help='Amount of memory (in MB) the jobs can use in total. Default is all memory on the machine')
+    parser.add_argument('--job_cpus', type=int, required=False, default=1, help='Number of CPUs for each job, passed to ISMapper as --t. Default 1')
+    parser.add_argument('--job_memory', type=int, required=False, default=8192, help='Amount of memory (in MB) for each job. Default is 8gb')
+    parser.add_argument('--limit_memory', action='store_true', required=False, help='Kill jobs that use more than their memory request (sets the address space limit of each job)')
+    parser.add_argument('--poll', type=float, required=False, default=5, help='Seconds between checks on the running jobs. Default 5')
+    parser.add_argument('--max_skips', type=int, required=False, default=3, help='Without --history to estimate run times, the number of smaller jobs that can be started ahead of the largest waiting job before it is given the next free resources. Default 3')
+    parser.add_argument('--rundir', type=str, required=False, help='Directory to run in. Default is current directory')
+    # ISmapper options
+    parser.add_argument('--script', type=str, required=True, help='Location of ISMapper script, ismap.py')
+    parser.add_argument('--queries', nargs='+', type=str, required=True, help='Path to IS queries.')
+    parser.add_argument('--reads', nargs='+', type=str, required=True, help='Paired end read files in fastq.gz format')
+    parser.add_argument('--forward', type=str, required=False, default='_1', help='Identifier for forward reads if not in MiSeq format (default _1)')
+    parser.add_argument('--reverse', type=str, required=False, default='_2', help='Identifier for reverse reads if not in MiSeq format (default _2)')
+    parser.add_argument('--assemblies', nargs='+', type=str, required=False, help='Contig assemblies, one for each read set (If using improvement option)')
+    parser.add_argument('--assemblyid', type=str, required=False, help='Identifier for assemblies eg: sampleName_contigs (specify _contigs) or sampleName_assembly (specify _assembly). Do not specify extension.')
+    parser.add_argument('--runtype', type=str, required=True, help='Runtype for the program, either improvement or typing')
+    parser.add_argument('--logprefix', type=str, required=False, help='Creates a prefix for the log file (default is just sample name)', default='')
+    parser.add_argument('--other_args', type=str, required=False, help='String containing all other arguments to pass to ISMapper')
+    parser.add_argument('--pack', type=int, required=False, default=1, help='Number of samples to run in each job (default 1). Samples are packed so each job has a similar total read size.')
+    # Resource fitting options
+    parser.add_argument('--history', nargs='+', type=str, required=False, help='Metrics files from previous runs (ismap.py --metrics) to fit the memory and run time of each job from its read size, instead of using --job_memory')
+    parser.add_argument('--margin', type=float, required=False, default=1.5, help='Safety margin to multiply fitted memory by (default 1.5)')
+
+    return parser.parse_args()
+
+class Job(object):
+    '''
+    An ismap.py run for one sample, or a pack of samples.
+    '''
+
+    def __init__(self, name, samples, cmd, cpus, memory, size, seconds=None):
+        self.name = name
+        self.samples = samples
+        self.cmd = cmd
+        self.cpus = cpus
+        self.memory = memory
+        # total size of the input files, larger jobs are started first
+        self.size = size
+        # estimated run time, if there is a model to fit it from
+        self.seconds = seconds
+        # number of jobs started ahead of this one while it waited
+        self.skipped = 0
+        self.process = None
+        self.start_time = None
+        self.end_time = None
+        self.returncode = None
+
+def ismap_command(args, name, samples, fileSets):
+    '''
+    Creates the ismap.py command for a job.
+    '''
+
+    cmd = args.script
+    cmd += ' --queries ' + args.queries
+    cmd += ' --runtype ' + args.runtype
+    cmd += ' --reads ' + ' '.join(read for sample in samples for read in fileSets[sample][:2])
+    if args.runtype == 'improvement':
+        cmd += ' --assemblies ' + ' '.join(fileSets[sample][2] for sample in samples)
+    if args.assemblyid:
+        cmd += ' --assemblyid ' + args.assemblyid
+    if args.logprefix == '':
+        cmd += ' --log --output ' + name
+    elif args.logprefix != '':
+        cmd += ' --log --output ' + args.logprefix + '_' + name
+    cmd += ' --t ' + str(args.job_cpus)
+    if args.other_args:
+        cmd += ' ' + args.other_args
+    return cmd
+
+def create_jobs(args, fileSets, model=None):
+    '''
+    Creates a job for each sample, or for each pack of samples
+    if --pack is more than 1.
+    The memory and run time of each job are fitted from model
+    if there is one.
+    '''
+
+    if args.pack > 1:
+        packs = pack_samples(fileSets, args.pack)
+        names = ['pack_' + str(i) for i in range(len(packs))]
+    else:
+        packs = [[sample] for sample in sorted(fileSets)]
+        names = [pack[0] for pack in packs]
+    jobs = []
+    for name, pack in zip(names, packs):
+        size = sum(sample_size(fileSets[sample]) for sample in pack)
+        memory = args.job_memory
+        seconds = None
+        if model is not None:
+            walltime, memory = pack_resources(model, args, pack, fileSets)
+            memory = int(memory)
+            seconds = walltime_to_seconds(walltime)
+        jobs.append(Job(name, pack, ismap_command(args, name, pack, fileSets), args.job_cpus, memory, size, seconds))
+    return jobs
+
+def memory_limit(memory):
+    '''
+    Returns a function that limits the address space of a
+    process to memory MB, for use as the preexec_fn of a job.
+    '''
+
+    def set_limit():
+        limit = memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    return set_limit
+
+def start_job(job, rundir, limit_memory):
+    '''
+    Starts the job as a subprocess, with its output going to
+    <job name>.out in the run directory.
+    '''
+
+    out = open(os.path.join(rundir, job.name + '.out'), 'w')
+    preexec_fn = None
+    if limit_memory:
+        preexec_fn = memory_limit(job.memory)
+    job.process = Popen(job.cmd, shell=True, cwd=rundir, stdout=out, stderr=STDOUT, preexec_fn=preexec_fn)
+    out.close()
+    job.start_time = time.time()
+
+def report(queued, running, finished, start_time):
+    '''
+    Prints the state of the queue.
+    '''
+
+    failed = len([job for job in finished if job.returncode != 0])
+    print '[{}] running: {}, queued: {}, finished: {}, failed: {} ({:.0f} s elapsed)'.format(time.strftime('%H:%M:%S'), len(running), len(queued), len(finished), failed, time.time() - start_time)
+    sys.stdout.flush()
+
+def reservation(head, running, free_cpus, free_memory, now):
+    '''
+    Works out when the head of the queue can start, from the estimated
+    end of each running job.
+    Returns that time and the CPUs and memory that will be left over
+    once the head job has started, or None if the run times of the
+    running jobs aren't known.
+    '''
+
+    if any(job.seconds is None for job in running):
+        return None
+    for job in sorted(running, key=lambda job: job.start_time + job.seconds):
+        free_cpus += job.cpus
+        free_memory += job.memory
+        if head.cpus <= free_cpus and head.memory <= free_memory:
+            # A job running over its estimate is expected to end any time
+            return max(now, job.start_time + job.seconds), free_cpus - head.cpus, free_memory - head.memory
+    return None
+
+def run_jobs(jobs, cpus, memory, rundir, limit_memory=False, poll=5, max_skips=3):
+    '''
+    Runs the jobs without using more than cpus and memory in total.
+    Jobs are started largest first. When the next job (the head of the
+    queue) doesn't fit in the free resources, smaller jobs further down
+    the queue are started in its place only if they don't hold up the
+    head job (backfilling). With estimated run times, the head job has
+    the resources it needs reserved from the time enough running jobs
+    will have finished, and a smaller job is only started if it will
+    finish before then or fits in what is left over. Without them, at
+    most max_skips smaller jobs are started ahead of the head job.
+    Returns the list of finished jobs.
+    '''
+
+    # A job asking for more than the machine has is run on its own
+    for job in jobs:
+        if job.cpus > cpus or job.memory > memory:
+            print 'Warning, job ' + job.name + ' requests more than the available resources, it will be run on its own'
+            job.cpus = min(job.cpus, cpus)
+            job.memory = min(job.memory, memory)
+    queued = sorted(jobs, key=lambda job: -job.size)
+    running = []
+    finished = []
+    start_time = time.time()
+    while queued or running:
+        changed = False
+        # Collect the jobs that have finished
+        for job in running[:]:
+            if job.process.poll() is not None:
+                job.returncode = job.process.returncode
+                job.end_time = time.time()
+                running.remove(job)
+                finished.append(job)
+                changed = True
+                if job.returncode != 0:
+                    print 'Job ' + job.name + ' failed with exit code ' + str(job.returncode) + ', see ' + os.path.join(rundir, job.name + '.out')
+        free_cpus = cpus - sum(job.cpus for job in running)
+        free_memory = memory - sum(job.memory for job in running)
+        # Start jobs from the head of the queue, largest first, while they fit
+        while queued and queued[0].cpus <= free_cpus and queued[0].memory <= free_memory:
+            job = queued.pop(0)
+            start_job(job, rundir, limit_memory)
+            running.append(job)
+            free_cpus -= job.cpus
+            free_memory -= job.memory
+            changed = True
+        # Backfill smaller jobs that don't hold up the head job
+        if queued:
+            head = queued[0]
+            now = time.time()
+            reserved = reservation(head, running, free_cpus, free_memory, now)
+            for job in queued[1:]:
+                if job.cpus > free_cpus or job.memory > free_memory:
+                    continue
+                if reserved is None:
+                    if head.skipped >= max_skips:
+                        break
+                else:
+                    shadow, extra_cpus, extra_memory = reserved
+                    if job.seconds is not None and now + job.seconds <= shadow:
+                        pass
+                    elif job.cpus <= extra_cpus and job.memory <= extra_memory:
+                        # Still running when the head job starts, so uses
+                        # the resources it doesn't need
+                        reserved = (shadow, extra_cpus - job.cpus, extra_memory - job.memory)
+                    else:
+                        continue
+                start_job(job, rundir, limit_memory)
+                queued.remove(job)
+                running.append(job)
+                free_cpus -= job.cpus
+                free_memory -= job.memory
+                head.skipped += 1
+                changed = True
+        if changed:
+            report(queued, running, finished, start_time)
+        if running:
+            time.sleep(poll)
+    return finished
+
+def main():
+
+    args = parse_args()
+
+    if not args.rundir:
+        args.rundir = os.getcwd()
+    # Get read pairs and their corresponding assemblies
+    # if required
+    fileSets = read_file_sets(args)
+    runnable, unused_fileSets = runnable_samples(args, fileSets)
+
+    args.queries = ' '.join(args.queries)
+    jobs = create_jobs(args, runnable, fit_cost_model(args.history, args.runtype))
+    print 'Running ' + str(len(jobs)) + ' jobs on ' + str(args.cpus) + ' CPUs and ' + str(args.memory) + ' MB of memory'
+    finished = run_jobs(jobs, args.cpus, args.memory, args.rundir, args.limit_memory, args.poll, args.max_skips)
+
+    for job in finished:
+        print job.name + '\t' + ' '.join(job.samples) + '\t' + str(job.returncode) + '\t{:.1f} s'.format(job.end_time - job.start_time)
+    failed = [job.name for job in finished if job.returncode != 0]
+    if len(failed) != 0:
+        print 'The following jobs failed:'
+        print ' '.join(failed)
+    if len(unused_fileSets) != 0:
+        print 'Unable to run the following samples:'
+        print ' '.join(unused_fileSets)
+    if len(failed) != 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
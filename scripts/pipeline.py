@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# A small dependency-graph runner for ISMapper.
+#
+# Each stage of a pipeline is a function to call (usually a run_command of
+# an external program), the stages it depends on, and the number of CPUs it
+# uses. Stages whose dependencies have finished are run at the same time in
+# threads, as long as the CPUs of the running stages fit within the budget.
+# The work itself is done by external programs, so the threads spend their
+# time waiting and the GIL isn't a problem.
+# When a stage fails, no more stages are started, the running ones are left
+# to finish and the error of the failed stage is raised again.
+# Stages can also list the temporary files they read. With remove_temp on,
+# each of these files is deleted as soon as every stage reading it has
+# finished, rather than when the whole temp folder is removed at the end,
+# so fewer intermediate files are on disk at once.
+
+import os, sys, threading, logging
+
+class Stage(object):
+    def __init__(self, name, action, deps, cpus, temp_inputs):
+        self.name = name
+        self.action = action
+        self.deps = deps
+        self.cpus = cpus
+        self.temp_inputs = temp_inputs
+
+class Pipeline(object):
+    def __init__(self, cpus=1, remove_temp=False):
+        # total number of CPUs the running stages can use
+        self.cpus = cpus
+        # delete temporary files once the stages reading them have finished
+        self.remove_temp = remove_temp
+        # key = temporary file, value = names of the stages reading it
+        self.readers = {}
+        # key = stage name, value = Stage
+        self.stages = {}
+        # stage names in the order they were added
+        self.order = []
+
+    def add(self, name, action, deps=[], cpus=1, temp_inputs=[]):
+        '''
+        Adds a stage that calls action once every stage named in deps
+        has finished. temp_inputs are the temporary files the stage
+        reads, which can be deleted once every stage reading them has
+        finished. Returns the name of the stage, to use in the deps
+        of later stages.
+        '''
+
+        if name in self.stages:
+            raise ValueError('Stage {} has already been added'.format(name))
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError('Stage {} depends on unknown stage {}'.format(name, dep))
+        self.stages[name] = Stage(name, action, list(deps), cpus, list(temp_inputs))
+        self.order.append(name)
+        for temp_file in temp_inputs:
+            self.readers.setdefault(temp_file, set()).add(name)
+        return name
+
+    def finished_reading(self, stage):
+        '''
+        Deletes the temporary files read by stage that no
+        other stage still has to read.
+        '''
+
+        for temp_file in stage.temp_inputs:
+            readers = self.readers[temp_file]
+            readers.discard(stage.name)
+            if len(readers) == 0 and self.remove_temp and os.path.exists(temp_file):
+                logging.info('Removing {}'.format(temp_file))
+                os.remove(temp_file)
+
+    def run(self):
+        '''
+        Runs every stage, starting each one as soon as its dependencies
+        have finished and there are enough free CPUs. Stages are started
+        in the order they were added when there is a choice, so a budget
+        of 1 CPU runs them one after the other.
+        A stage that needs more CPUs than the budget is run on its own.
+        '''
+
+        condition = threading.Condition()
+        pending = list(self.order)
+        running = set()
+        finished = set()
+        # state shared with the worker threads
+        state = {'free': self.cpus, 'error': None, 'failed': None}
+
+        def worker(stage):
+            try:
+                stage.action()
+                error = None
+            except Exception:
+                error = sys.exc_info()
+            with condition:
+                running.remove(stage.name)
+                state['free'] += stage.cpus
+                if error is not None and state['error'] is None:
+                    state['error'] = error
+                    state['failed'] = stage.name
+                elif error is None:
+                    finished.add(stage.name)
+                    self.finished_reading(stage)
+                condition.notify_all()
+
+        with condition:
+            while pending or running:
+                if state['error'] is not None and pending:
+                    logging.info('Stage {} failed, cancelling: {}'.format(state['failed'], ', '.join(pending)))
+                    del pending[:]
+                for name in pending[:]:
+                    stage = self.stages[name]
+                    if not all(dep in finished for dep in stage.deps):
+                        continue
+                    if stage.cpus > state['free'] and running:
+                        continue
+                    pending.remove(name)
+                    running.add(name)
+                    state['free'] -= stage.cpus
+                    thread = threading.Thread(target=worker, args=(stage,))
+                    thread.daemon = True
+                    thread.start()
+                if pending or running:
+                    # time out so the main thread can still be interrupted
+                    condition.wait(1)
+
+        if state['error'] is not None:
+            error_type, error_value, traceback = state['error']
+            raise error_type, error_value, traceback
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Profiling for ISMapper scripts, switched on with --profile DIR.
+#
+# Each script invocation saves its cProfile stats and its largest memory
+# allocations to DIR. Scripts started by another script (eg: ismap.py
+# running create_typing_out.py) inherit the run id of their parent through
+# the environment, and the top level script merges the profiles of the
+# whole run into one report when it exits.
+# tracemalloc only exists from Python 3.4, for older versions only the
+# peak memory of each invocation is reported.
+
+import os, glob, atexit, cProfile, pstats, resource, time
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Environment variable holding the id of the run being profiled
+RUN_ID_VARIABLE = 'ISMAP_PROFILE_RUN'
+# Number of functions and allocations to show in the reports
+TOP_ENTRIES = 30
+# Functions whose cumulative time is spent waiting on external programs,
+# as (end of file name, function name)
+EXTERNAL_FUNCTIONS = [('ismap.py', 'run_command'), ('Application/__init__.py', '__call__'),
+    ('subprocess.py', 'call'), ('subprocess.py', 'check_output'), ('subprocess.py', 'communicate'), ('~', '<posix.system>')]
+
+def start_profiling(profile_dir, name):
+    '''
+    Starts profiling this invocation of the script called name,
+    if profile_dir is set. The results are saved to profile_dir
+    when the script exits.
+    '''
+
+    if not profile_dir:
+        return
+    if not os.path.exists(profile_dir):
+        try:
+            os.makedirs(profile_dir)
+        except OSError:
+            # made by another job in the meantime
+            pass
+    # The first script in the run sets the run id and writes the report
+    if RUN_ID_VARIABLE in os.environ:
+        top_level = False
+    else:
+        os.environ[RUN_ID_VARIABLE] = name + '_' + time.strftime('%d%m%y_%H%M%S') + '_' + str(os.getpid())
+        top_level = True
+    prefix = os.path.join(profile_dir, os.environ[RUN_ID_VARIABLE] + '.' + name + '_' + str(os.getpid()))
+    if tracemalloc is not None:
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    atexit.register(finish_profiling, profiler, profile_dir, prefix, time.time(), top_level)
+    profiler.enable()
+
+def finish_profiling(profiler, profile_dir, prefix, start_time, top_level):
+    '''
+    Saves the cProfile stats and memory use of this invocation, and
+    writes the report for the run if this is the top level script.
+    '''
+
+    profiler.disable()
+    profiler.dump_stats(prefix + '.prof')
+    with open(prefix + '.memory.txt', 'w') as out:
+        out.write('Wall time (s): {:.2f}\n'.format(time.time() - start_time))
+        out.write('Peak memory (kb): {}\n'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        if tracemalloc is not None:
+            out.write('Top allocations:\n')
+            for stat in tracemalloc.take_snapshot().statistics('lineno')[:TOP_ENTRIES]:
+                out.write('  ' + str(stat) + '\n')
+            tracemalloc.stop()
+    if top_level:
+        write_report(profile_dir, os.environ[RUN_ID_VARIABLE])
+
+def external_time(stats):
+    '''
+    Returns the time spent waiting on external programs in a pstats.Stats.
+    '''
+
+    total = 0.0
+    for (file_name, line, function), (cc, nc, tt, ct, callers) in stats.stats.items():
+        for external_file, external_function in EXTERNAL_FUNCTIONS:
+            if file_name.endswith(external_file) and function == external_function:
+                # Only count the outermost call, not calls made from
+                # another external function
+                if not any(caller[0].endswith(f) and caller[2] == fn for caller in callers for f, fn in EXTERNAL_FUNCTIONS):
+                    total += ct
+    return total
+
+def write_report(profile_dir, run_id):
+    '''
+    Merges the profiles of every invocation in the run into one report,
+    saved as <run_id>.report.txt in profile_dir.
+    '''
+
+    profiles = sorted(glob.glob(os.path.join(profile_dir, run_id + '.*.prof')))
+    if len(profiles) == 0:
+        return
+    with open(os.path.join(profile_dir, run_id + '.report.txt'), 'w') as out:
+        out.write('Profile report for ' + run_id + '\n\n')
+        out.write('invocation\ttotal (s)\tpython (s)\texternal programs (s)\n')
+        for profile in profiles:
+            stats = pstats.Stats(profile)
+            external = external_time(stats)
+            invocation = os.path.basename(profile)[len(run_id) + 1:-len('.prof')]
+            out.write('{}\t{:.2f}\t{:.2f}\t{:.2f}\n'.format(invocation, stats.total_tt, stats.total_tt - external, external))
+        out.write('\nMemory use of each invocation:\n')
+        for memory_file in sorted(glob.glob(os.path.join(profile_dir, run_id + '.*.memory.txt'))):
+            out.write('\n' + os.path.basename(memory_file)[len(run_id) + 1:-len('.memory.txt')] + '\n')
+            with open(memory_file) as memory_in:
+                out.write(memory_in.read())
+        merged = pstats.Stats(*profiles, stream=out)
+        out.write('\nAll invocations, by internal time:\n')
+        merged.sort_stats('tottime').print_stats(TOP_ENTRIES)
+        out.write('\nAll invocations, by cumulative time:\n')
+        merged.sort_stats('cumulative').print_stats(TOP_ENTRIES)
@@ -24,9 +24,42 @@ def parse_args():
     parser.add_argument('--runtype', type=str, required=True, help='Runtype for the program, either improvement or typing')
     parser.add_argument('--logprefix', type=str, required=False, help='Creates a prefix for the log file (default is just sample name)', default='')
     parser.add_argument('--other_args', type=str, required=False, help='String containing all other arguments to pass to ISMapper')
+    # Array job options
+    parser.add_argument('--array', action='store_true', required=False, help='Submit one array job instead of one job per sample')
+    parser.add_argument('--pack', type=int, required=False, default=1, help='Number of samples to run in each array task (default 1). Samples are packed so each task has a similar total read size. --walltime is per sample, the array walltime is scaled by the pack size.')
+    parser.add_argument('--manifest', type=str, required=False, help='Manifest file listing the samples for each array task (default [logprefix]ismapper_manifest.txt in the run directory)')
+    # Resource fitting options
+    parser.add_argument('--history', nargs='+', type=str, required=False, help='Metrics files from previous runs (ismap.py --metrics) to fit the walltime and memory of each job from its read size')
+    parser.add_argument('--margin', type=float, required=False, default=1.5, help='Safety margin to multiply fitted walltimes and memory by (default 1.5)')
 
     return parser.parse_args()
 
+def job_header(args, job_name, walltime, memory, options=None):
+    '''
+    Creates the SBATCH options and module loads for a job.
+    options is a list of any further SBATCH options for the job.
+    '''
+
+    if options is None:
+        options = []
+
+    cmd = '#!/bin/bash'
+    cmd += '\n#SBATCH -p main'
+    cmd += '\n#SBATCH --job-name=' + job_name
+    cmd += '\n#SBATCH --ntasks=1'
+    cmd += '\n#SBATCH --mem-per-cpu=' + memory
+    cmd += '\n#SBATCH --time=' + walltime
+    for option in options:
+        cmd += '\n#SBATCH ' + option
+    cmd += '\ncd ' + args.rundir
+    cmd += '\nmodule load python-gcc/2.7.5'
+    cmd += '\nmodule load bwa-intel/0.7.12'
+    cmd += '\nmodule load samtools-intel/1.1'
+    cmd += '\nmodule load blast+-gcc/2.2.25'
+    cmd += '\nmodule load bedtools-intel/2.20.1'
+    cmd += '\nmodule load samblaster-gcc/0.1.21'
+    return cmd
+
 def get_readFile_components(full_file_path):
     '''
     Takes the path to the read file and splits it into
@@ -137,6 +170,236 @@ def read_file_sets(args):
 
     return fileSets
 
+# Fewest samples needed in the history to fit resource requests
+MIN_HISTORY = 3
+# Smallest walltime (in seconds) and memory (in MB) to request
+MIN_WALLTIME = 600
+MIN_MEMORY = 1024
+
+def walltime_to_seconds(walltime):
+    '''
+    Converts a SLURM walltime (D-HH:MM:SS, HH:MM:SS or MM:SS) to seconds.
+    '''
+
+    days = 0
+    if '-' in walltime:
+        days, walltime = walltime.split('-')
+    seconds = 0
+    for value in walltime.split(':'):
+        seconds = seconds * 60 + int(value)
+    return int(days) * 86400 + seconds
+
+def seconds_to_walltime(seconds):
+    '''
+    Converts seconds to a SLURM walltime (D-HH:MM:SS).
+    '''
+
+    seconds = int(seconds)
+    return '{}-{:02d}:{:02d}:{:02d}'.format(seconds // 86400, seconds % 86400 // 3600, seconds % 3600 // 60, seconds % 60)
+
+def sample_size(files):
+    '''
+    Returns the total size in bytes of the files for a sample.
+    '''
+
+    return sum(os.path.getsize(f) for f in files if os.path.exists(f))
+
+def pack_samples(fileSets, pack_size):
+    '''
+    Splits the samples into packs of at most pack_size samples,
+    balancing the packs by the total size of their files.
+    The largest samples are placed first, each into the pack with
+    the smallest total size that still has room.
+    Returns a list of packs, each a list of sample names.
+    '''
+
+    num_packs = (len(fileSets) + pack_size - 1) // pack_size
+    packs = [[] for i in range(num_packs)]
+    pack_bytes = [0] * num_packs
+    sizes = dict((sample, sample_size(fileSets[sample])) for sample in fileSets)
+    for sample in sorted(fileSets, key=lambda s: (-sizes[s], s)):
+        open_packs = [i for i in range(num_packs) if len(packs[i]) < pack_size]
+        smallest = min(open_packs, key=lambda i: pack_bytes[i])
+        packs[smallest].append(sample)
+        pack_bytes[smallest] += sizes[sample]
+    return packs
+
+def write_manifest(manifest, packs, fileSets):
+    '''
+    Writes the manifest for an array job, one line per array task:
+    task id, sample names, read files and assemblies (comma separated
+    if more than one sample) separated by tabs.
+    '''
+
+    with open(manifest, 'w') as out:
+        for task, pack in enumerate(packs):
+            reads = [read for sample in pack for read in fileSets[sample][:2]]
+            assemblies = [fileSets[sample][2] for sample in pack if len(fileSets[sample]) > 2]
+            out.write('\t'.join([str(task), ','.join(pack), ' '.join(reads), ' '.join(assemblies)]) + '\n')
+
+def array_job(args, header, manifest):
+    '''
+    Creates the script for an array job, where each task runs ismap
+    on the samples in its line of the manifest.
+    '''
+
+    cmd = header
+    cmd += '\nREADS=$(awk -F \'\\t\' -v task=$SLURM_ARRAY_TASK_ID \'$1 == task {print $3}\' ' + manifest + ')'
+    cmd += '\nASSEMBLIES=$(awk -F \'\\t\' -v task=$SLURM_ARRAY_TASK_ID \'$1 == task {print $4}\' ' + manifest + ')'
+    cmd += '\n ' + args.script
+    cmd += ' --queries ' + args.queries
+    cmd += ' --runtype ' + args.runtype + ' --reads $READS'
+    if args.runtype == 'improvement':
+        cmd += ' --assemblies $ASSEMBLIES'
+    if args.assemblyid:
+        cmd += ' --assemblyid ' + args.assemblyid
+    if args.logprefix == '':
+        cmd += ' --log --output task_$SLURM_ARRAY_TASK_ID'
+    elif args.logprefix != '':
+        cmd += ' --log --output ' + args.logprefix + '_task_$SLURM_ARRAY_TASK_ID'
+    if args.other_args:
+        cmd += ' ' + args.other_args
+    return cmd + '\n'
+
+def read_history(history_files, runtype):
+    '''
+    Reads the metrics files written by ismap.py --metrics.
+    Returns a list of (read bytes, wall time in seconds, peak memory in MB)
+    for each sample of the given runtype, taking the wall time from the
+    sample's own row and the largest peak memory of its rows. Samples
+    without that row (older metrics files, or --batch_map runs) use the
+    time of all of the sample's commands added together.
+    '''
+
+    # key = (sample, read bytes), value = [summed command seconds,
+    # peak memory in kb, sample wall time or None]
+    samples = {}
+    for history_file in history_files:
+        with open(history_file) as history:
+            for line in history:
+                info = line.strip().split('\t')
+                if len(info) != 7 or info[0] in ['sample', '-'] or info[2] != runtype:
+                    continue
+                key = (info[0], int(info[3]))
+                if key not in samples:
+                    samples[key] = [0.0, 0, None]
+                if info[4] == 'sample':
+                    # A sample run more than once is added up, as its commands are
+                    samples[key][2] = (samples[key][2] or 0.0) + float(info[5])
+                else:
+                    samples[key][0] += float(info[5])
+                samples[key][1] = max(samples[key][1], int(info[6]))
+    points = []
+    for key in sorted(samples):
+        command_seconds, peak_memory, wall_time = samples[key]
+        if wall_time is None:
+            wall_time = command_seconds
+        points.append((key[1], wall_time, peak_memory / 1024.0))
+    return points
+
+def fit_line(xs, ys):
+    '''
+    Least squares fit of y = intercept + slope * x.
+    Returns (intercept, slope).
+    '''
+
+    n = float(len(xs))
+    mean_x = sum(xs) / n
+    mean_y = sum(ys) / n
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x == 0:
+        # all samples the same size, so predict the largest seen
+        return (max(ys), 0.0)
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+    return (mean_y - slope * mean_x, slope)
+
+def fit_cost_model(history_files, runtype):
+    '''
+    Fits the wall time and peak memory of a sample against the size
+    of its reads, from the metrics of previous runs.
+    Returns a dictionary of (intercept, slope) for 'seconds' and 'memory',
+    or None if there aren't enough previous runs to fit.
+    '''
+
+    if not history_files:
+        return None
+    points = read_history(history_files, runtype)
+    if len(points) < MIN_HISTORY:
+        print 'Only ' + str(len(points)) + ' samples in the history, using the default walltime and memory'
+        return None
+    sizes = [point[0] for point in points]
+    model = {'seconds': fit_line(sizes, [point[1] for point in points]),
+            'memory': fit_line(sizes, [point[2] for point in points])}
+    print 'Fitted resources from ' + str(len(points)) + ' previous samples:'
+    print '  walltime (s) = {:.1f} + {:.3g} per MB of reads'.format(model['seconds'][0], model['seconds'][1] * 1024 * 1024)
+    print '  memory (MB) = {:.1f} + {:.3g} per MB of reads'.format(model['memory'][0], model['memory'][1] * 1024 * 1024)
+    return model
+
+def pack_resources(model, args, pack, fileSets):
+    '''
+    Returns the walltime and memory (in MB) to request for a job
+    running the samples in pack one after the other.
+    Without a model, the walltime is --walltime for each sample and
+    the memory is --memory.
+    '''
+
+    if model is None:
+        return seconds_to_walltime(walltime_to_seconds(args.walltime) * len(pack)), args.memory
+    seconds = 0
+    memory = 0
+    for sample in pack:
+        size = sample_size(fileSets[sample][:2])
+        seconds += max(model['seconds'][0] + model['seconds'][1] * size, 0)
+        memory = max(memory, model['memory'][0] + model['memory'][1] * size)
+    seconds = max(seconds * args.margin, MIN_WALLTIME)
+    memory = max(memory * args.margin, MIN_MEMORY)
+    return seconds_to_walltime(seconds), str(int(memory))
+
+def runnable_samples(args, fileSets):
+    '''
+    Splits the samples into those that have the files needed for
+    the runtype, and those that can't be run.
+    Returns a dictionary of runnable samples and a list of the others.
+    '''
+
+    # Improvement runs need an assembly, typing runs a pair of reads
+    if args.runtype == 'improvement':
+        required = 3
+    else:
+        required = 2
+    runnable = dict((sample, fileSets[sample]) for sample in fileSets if isinstance(fileSets[sample], list) and len(fileSets[sample]) >= required)
+    unused_fileSets = [sample for sample in fileSets if sample not in runnable]
+    return runnable, unused_fileSets
+
+def submit_array(args, fileSets, job_header, model=None):
+    '''
+    Packs the samples, writes the manifest and submits one array job,
+    with one task per pack of samples.
+    job_header is called with the job name, walltime and memory to
+    create the SBATCH options and module loads for the job.
+    Returns the samples that could not be run.
+    '''
+
+    runnable, unused_fileSets = runnable_samples(args, fileSets)
+    if len(runnable) == 0:
+        return unused_fileSets
+    packs = pack_samples(runnable, args.pack)
+    manifest = args.manifest
+    if not manifest:
+        manifest = os.path.join(args.rundir, args.logprefix + 'ismapper_manifest.txt')
+    write_manifest(manifest, packs, runnable)
+    # Every task in the array gets the resources of the largest pack
+    resources = [pack_resources(model, args, pack, runnable) for pack in packs]
+    walltime = max(resources, key=lambda r: walltime_to_seconds(r[0]))[0]
+    memory = str(max(int(r[1]) for r in resources))
+    job_script = os.path.splitext(manifest)[0] + '.sh'
+    with open(job_script, 'w') as out:
+        options = ['--array=0-' + str(len(packs) - 1), '--output=' + os.path.splitext(manifest)[0] + '_%a.out']
+        out.write(array_job(args, job_header(args, 'ismapper_array', walltime, memory, options), manifest))
+    print 'Submitting array job of ' + str(len(packs)) + ' tasks, manifest in ' + manifest
+    os.system('sbatch ' + job_script)
+    return unused_fileSets
+
 def main():
 
     args = parse_args()
@@ -150,22 +413,17 @@ def main():
     unused_fileSets = []
 
     args.queries = ' '.join(args.queries)
+    # Fit the resources for each job from previous runs
+    model = fit_cost_model(args.history, args.runtype)
+    # Submit all the samples as one array job
+    if args.array:
+        unused_fileSets = submit_array(args, fileSets, job_header, model)
+        fileSets = {}
     # For each read set, launch a job
     for sample in fileSets:
 
-        cmd = '#!/bin/bash'
-        cmd += '\n#SBATCH -p main'
-        cmd += '\n#SBATCH --job-name=ismapper' + sample
-        cmd += '\n#SBATCH --ntasks=1'
-        cmd += '\n#SBATCH --mem-per-cpu=' + args.memory
-        cmd += '\n#SBATCH --time=' + args.walltime
-        cmd += '\ncd ' + args.rundir
-        cmd += '\nmodule load python-gcc/2.7.5'
-        cmd += '\nmodule load bwa-intel/0.7.12'
-        cmd += '\nmodule load samtools-intel/1.1'
-        cmd += '\nmodule load blast+-gcc/2.2.25'
-        cmd += '\nmodule load bedtools-intel/2.20.1'
-        cmd += '\nmodule load samblaster-gcc/0.1.21'
+        walltime, memory = pack_resources(model, args, [sample], fileSets)
+        cmd = job_header(args, 'ismapper' + sample, walltime, memory)
 
         cmd += '\n ' + args.script
         cmd += ' --queries ' + args.queries
@@ -2,6 +2,7 @@
 
 import re, os
 from argparse import ArgumentParser
+from slurm_ismap import submit_array, fit_cost_model, pack_resources
 
 def parse_args():
     '''
@@ -24,9 +25,44 @@ def parse_args():
     parser.add_argument('--runtype', type=str, required=True, help='Runtype for the program, either improvement or typing')
     parser.add_argument('--logprefix', type=str, required=False, help='Creates a prefix for the log file (default is just sample name)', default='')
     parser.add_argument('--other_args', type=str, required=False, help='String containing all other arguments to pass to ISMapper')
+    # Array job options
+    parser.add_argument('--array', action='store_true', required=False, help='Submit one array job instead of one job per sample')
+    parser.add_argument('--pack', type=int, required=False, default=1, help='Number of samples to run in each array task (default 1). Samples are packed so each task has a similar total read size. --walltime is per sample, the array walltime is scaled by the pack size.')
+    parser.add_argument('--manifest', type=str, required=False, help='Manifest file listing the samples for each array task (default [logprefix]ismapper_manifest.txt in the run directory)')
+    # Resource fitting options
+    parser.add_argument('--history', nargs='+', type=str, required=False, help='Metrics files from previous runs (ismap.py --metrics) to fit the walltime and memory of each job from its read size')
+    parser.add_argument('--margin', type=float, required=False, default=1.5, help='Safety margin to multiply fitted walltimes and memory by (default 1.5)')
 
     return parser.parse_args()
 
+def job_header(args, job_name, walltime, memory, options=None):
+    '''
+    Creates the SBATCH options and module loads for a job.
+    options is a list of any further SBATCH options for the job.
+    '''
+
+    if options is None:
+        options = []
+
+    cmd = '#!/bin/bash'
+    cmd += '\n#SBATCH -p sysgen'
+    cmd += '\n#SBATCH --job-name=' + job_name
+    cmd += '\n#SBATCH --ntasks=1'
+    cmd += '\n#SBATCH --mem-per-cpu=' + memory
+    cmd += '\n#SBATCH --time=' + walltime
+    for option in options:
+        cmd += '\n#SBATCH ' + option
+    cmd += '\ncd ' + args.rundir
+    cmd += '\nmodule load Python/2.7.10-vlsci_intel-2015.08.25-SG'
+    cmd += '\nmodule load BWA/0.7.15-iccifort-2015.2.164-GCC-4.9.2'
+    cmd += '\nmodule load SAMtools/1.2-iccifort-2015.2.164-GCC-4.9.2-HTSlib-1.2.1'
+    #cmd += '\nmodule load SAMtools/0.1.19-vlsci_intel-2015.08.25'
+    #cmd += '\nmodule load SAMtools/0.1.18-iccifort-2015.2.164-GCC-4.9.2'
+    cmd += '\nmodule load BLAST+/2.2.30-vlsci_intel-2015.08.25-Python-2.7.10'
+    cmd += '\nmodule load BEDTools/2.25.0-iccifort-2015.2.164-GCC-4.9.2'
+    cmd += '\nmodule load SAMblaster/0.1.22-iccifort-2015.2.164-GCC-4.9.2'
+    return cmd
+
 def get_readFile_components(full_file_path):
     '''
     Takes the path to the read file and splits it into
@@ -150,24 +186,17 @@ def main():
     unused_fileSets = []
 
     args.queries = ' '.join(args.queries)
+    # Fit the resources for each job from previous runs
+    model = fit_cost_model(args.history, args.runtype)
+    # Submit all the samples as one array job
+    if args.array:
+        unused_fileSets = submit_array(args, fileSets, job_header, model)
+        fileSets = {}
     # For each read set, launch a job
     for sample in fileSets:
 
-        cmd = '#!/bin/bash'
-        cmd += '\n#SBATCH -p sysgen'
-        cmd += '\n#SBATCH --job-name=ismapper' + sample
-        cmd += '\n#SBATCH --ntasks=1'
-        cmd += '\n#SBATCH --mem-per-cpu=' + args.memory
-        cmd += '\n#SBATCH --time=' + args.walltime
-        cmd += '\ncd ' + args.rundir
-        cmd += '\nmodule load Python/2.7.10-vlsci_intel-2015.08.25-SG'
-        cmd += '\nmodule load BWA/0.7.15-iccifort-2015.2.164-GCC-4.9.2'
-        cmd += '\nmodule load SAMtools/1.2-iccifort-2015.2.164-GCC-4.9.2-HTSlib-1.2.1'
-        #cmd += '\nmodule load SAMtools/0.1.19-vlsci_intel-2015.08.25'
-        #cmd += '\nmodule load SAMtools/0.1.18-iccifort-2015.2.164-GCC-4.9.2'
-        cmd += '\nmodule load BLAST+/2.2.30-vlsci_intel-2015.08.25-Python-2.7.10'
-        cmd += '\nmodule load BEDTools/2.25.0-iccifort-2015.2.164-GCC-4.9.2'
-        cmd += '\nmodule load SAMblaster/0.1.22-iccifort-2015.2.164-GCC-4.9.2'
+        walltime, memory = pack_resources(model, args, [sample], fileSets)
+        cmd = job_header(args, 'ismapper' + sample, walltime, memory)
 
         cmd += '\n ' + args.script
         cmd += ' --queries ' + args.queries
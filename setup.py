@@ -9,7 +9,12 @@ setup(
     author_email='hawkey.jane@gmail.com',
     packages=['ismap'],
     scripts=['scripts/binary_table.py', 'scripts/compiled_table.py', 'scripts/create_genbank_table.py',
-            'scripts/slurm_ismap.py', 'scripts/create_typing_out.py', 'scripts/slurm_ismap_sg.py'],
+            'scripts/slurm_ismap.py', 'scripts/create_typing_out.py', 'scripts/slurm_ismap_sg.py',
+            'scripts/local_ismap.py', 'scripts/annotate_genbank.py', 'scripts/distance_table.py',
+            'scripts/ismap_daemon.py',
+            # Modules imported by the scripts above, installed next to them
+            'scripts/profiling.py', 'scripts/blast_cache.py', 'scripts/hit_records.py',
+            'scripts/banded_align.py', 'scripts/pipeline.py'],
     entry_points={
         'console_scripts': ['ismap = ismap.ismap:main']
     },
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+
+# End-to-end benchmark for ISMapper.
+#
+# Inserts the IS query into a reference genome at known positions and
+# orientations, simulates paired end reads from the modified genome and
+# runs ismap.py in typing mode (against the original reference) and in
+# improvement mode (against an assembly broken at each insertion).
+# Reports the time, memory and disk used by each stage, and checks that
+# the called positions match the inserted ones.
+#
+# Example:
+#   ismap_benchmark.py --reference S_suis_P17.gbk --scales 1x 10x --output bench_out
+
+import os, sys, re, gzip, json, random, time, threading
+from argparse import ArgumentParser
+from subprocess import Popen
+from Bio import SeqIO
+from Bio.Seq import Seq
+from Bio.Alphabet import generic_dna
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCHMARK_DIR, '..', '..', 'scripts')
+
+# Scale presets, multiplier of the number of simulated reads
+SCALES = {'1x': 1, '10x': 10, '100x': 100}
+
+def parse_args():
+    '''
+    Parse the input arguments, use -h for help.
+    '''
+
+    parser = ArgumentParser(description='Synthetic end-to-end benchmark for ISMapper')
+    # Inputs
+    parser.add_argument('--reference', type=str, required=True, help='Reference genome in genbank format')
+    parser.add_argument('--query', type=str, required=False, default=os.path.join(BENCHMARK_DIR, '..', 'inputs', 'ISSsu3.fasta'), help='IS query to insert (default test/inputs/ISSsu3.fasta)')
+    parser.add_argument('--ismap', type=str, required=False, default=os.path.join(SCRIPTS_DIR, 'ismap.py'), help='Path to ismap.py (default is the one in this repository)')
+    # Insertions
+    parser.add_argument('--insertions', type=int, required=False, default=10, help='Number of random insertions to make (default 10)')
+    parser.add_argument('--positions', nargs='+', type=str, required=False, help='Insertions to make instead of random ones, as position:orientation (eg: 10000:F 250000:R)')
+    parser.add_argument('--tsd', type=int, required=False, default=8, help='Length of the target site duplication made by each insertion (default 8)')
+    # Read simulation
+    parser.add_argument('--depth', type=float, required=False, default=10, help='Read depth at the 1x scale (default 10)')
+    parser.add_argument('--scales', nargs='+', type=str, required=False, default=['1x'], help='Scale presets to run, multiplying the number of reads: 1x, 10x and/or 100x (default 1x)')
+    parser.add_argument('--read_length', type=int, required=False, default=100, help='Read length (default 100)')
+    parser.add_argument('--fragment_size', type=int, required=False, default=300, help='Mean fragment size (default 300)')
+    parser.add_argument('--error_rate', type=float, required=False, default=0.001, help='Substitution error rate of the reads (default 0.001)')
+    parser.add_argument('--seed', type=int, required=False, default=1, help='Seed for the random number generator (default 1)')
+    # Running
+    parser.add_argument('--runtypes', nargs='+', type=str, required=False, default=['typing', 'improvement'], help='Runtypes to benchmark (default typing improvement)')
+    parser.add_argument('--ismap_args', type=str, required=False, default='', help='String containing other arguments to pass to ISMapper')
+    parser.add_argument('--tolerance', type=int, required=False, default=20, help='Maximum distance (bp) between a called and an inserted position to count as found (default 20)')
+    # Output
+    parser.add_argument('--output', type=str, required=True, help='Directory for the simulated data, ISMapper output and benchmark report')
+    parser.add_argument('--baseline', type=str, required=False, help='Benchmark report (json) from a previous run to compare the calls against')
+
+    return parser.parse_args()
+
+def choose_insertions(args, genome_length):
+    '''
+    Returns a sorted list of (position, orientation) for the insertions,
+    either from --positions or chosen at random at least 5 kb apart.
+    '''
+
+    if args.positions:
+        insertions = []
+        for insertion in args.positions:
+            position, orientation = insertion.split(':')
+            insertions.append((int(position), orientation))
+        return sorted(insertions)
+    insertions = []
+    while len(insertions) < args.insertions:
+        position = random.randint(5000, genome_length - 5000)
+        if all(abs(position - other) > 5000 for other, orientation in insertions):
+            insertions.append((position, random.choice('FR')))
+    return sorted(insertions)
+
+def insert_query(reference_seq, query_seq, insertions, tsd):
+    '''
+    Inserts the query into the reference at each insertion, duplicating
+    the tsd bases after the insertion point.
+    Returns the modified genome and the pieces of reference sequence
+    between insertions (used as contigs for the improvement runs).
+    '''
+
+    pieces = []
+    genome = []
+    previous = 0
+    for position, orientation in insertions:
+        pieces.append(reference_seq[previous:position + tsd])
+        genome.append(reference_seq[previous:position + tsd])
+        if orientation == 'F':
+            genome.append(query_seq)
+        else:
+            genome.append(str(Seq(query_seq, generic_dna).reverse_complement()))
+        previous = position
+    pieces.append(reference_seq[previous:])
+    genome.append(reference_seq[previous:])
+    return ''.join(genome), pieces
+
+def add_errors(read, error_rate):
+    '''
+    Adds random substitutions to the read.
+    '''
+
+    if error_rate == 0:
+        return read
+    read = list(read)
+    for i in range(len(read)):
+        if random.random() < error_rate:
+            read[i] = random.choice('ACGT'.replace(read[i], ''))
+    return ''.join(read)
+
+def simulate_reads(genome, depth, read_length, fragment_size, error_rate, forward_file, reverse_file):
+    '''
+    Simulates paired end reads from the genome, writing them
+    to gzipped fastq files. Returns the number of read pairs.
+    '''
+
+    genome_rc = str(Seq(genome, generic_dna).reverse_complement())
+    num_pairs = int(depth * len(genome) / (2 * read_length))
+    quality = 'I' * read_length
+    with gzip.open(forward_file, 'wb', 1) as forward, gzip.open(reverse_file, 'wb', 1) as reverse:
+        for pair in range(num_pairs):
+            size = max(read_length, int(random.gauss(fragment_size, fragment_size * 0.1)))
+            start = random.randint(0, len(genome) - size)
+            # Sample the fragment from either strand
+            if random.random() < 0.5:
+                fragment = genome[start:start + size]
+            else:
+                fragment = genome_rc[start:start + size]
+            read_1 = add_errors(fragment[:read_length], error_rate)
+            read_2 = add_errors(str(Seq(fragment[-read_length:], generic_dna).reverse_complement()), error_rate)
+            name = 'read_' + str(pair)
+            forward.write('@' + name + '/1\n' + read_1 + '\n+\n' + quality + '\n')
+            reverse.write('@' + name + '/2\n' + read_2 + '\n+\n' + quality + '\n')
+    return num_pairs
+
+def directory_size(directory):
+    '''
+    Returns the total size in bytes of all files under the directory.
+    '''
+
+    total = 0
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                # removed while we were looking
+                pass
+    return total
+
+class DiskMonitor(threading.Thread):
+    '''
+    Polls the size of a directory to find the peak disk use of a run.
+    '''
+
+    def __init__(self, directory, interval=0.5):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.interval = interval
+        self.peak = 0
+        self.finished = threading.Event()
+
+    def run(self):
+        while not self.finished.is_set():
+            self.peak = max(self.peak, directory_size(self.directory))
+            self.finished.wait(self.interval)
+
+    def stop(self):
+        self.finished.set()
+        self.join()
+        self.peak = max(self.peak, directory_size(self.directory))
+
+def stage_name(command):
+    '''
+    Returns a short stage name for a command from the ISMapper log,
+    eg: bwa mem, samtools sort, create_typing_out.py
+    '''
+
+    words = command.split()
+    program = os.path.basename(words[0])
+    if program in ['bwa', 'samtools', 'bedtools'] and len(words) > 1:
+        return program + ' ' + words[1]
+    return program
+
+def read_stage_metrics(log_file):
+    '''
+    Collects the time and peak memory of each stage from the ISMapper log.
+    Returns a dictionary, key = stage name, value = [number of commands,
+    total seconds, peak memory in kb].
+    '''
+
+    stages = {}
+    if not os.path.exists(log_file):
+        return stages
+    with open(log_file) as log:
+        for line in log:
+            m = re.search('Finished in ([0-9.]+) s \(peak memory ([0-9]+) kb\): (.*)$', line)
+            if m:
+                stage = stage_name(m.group(3))
+                if stage not in stages:
+                    stages[stage] = [0, 0.0, 0]
+                stages[stage][0] += 1
+                stages[stage][1] += float(m.group(1))
+                stages[stage][2] = max(stages[stage][2], int(m.group(2)))
+    return stages
+
+def run_ismap(args, runtype, run_dir, name, reads, reference_gbk, assembly):
+    '''
+    Runs ISMapper and returns its metrics: wall time, peak memory,
+    peak and final disk use, and the time and memory of each stage.
+    '''
+
+    command = [sys.executable, args.ismap, '--runtype', runtype, '--reads'] + reads
+    command += ['--queries', os.path.abspath(args.query), '--output', name, '--directory', run_dir, '--log', '--path', os.path.abspath(SCRIPTS_DIR) + '/']
+    if runtype == 'typing':
+        command += ['--typingRef', os.path.abspath(reference_gbk)]
+    else:
+        command += ['--assemblies', assembly, '--assemblyid', '_assembly', '--extension', '.fasta']
+    command += args.ismap_args.split()
+    os.makedirs(run_dir)
+    monitor = DiskMonitor(run_dir)
+    monitor.start()
+    start_time = time.time()
+    process = Popen(command)
+    pid, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    wall_time = time.time() - start_time
+    monitor.stop()
+    stages = read_stage_metrics(os.path.join(run_dir, name + '.log'))
+    command_time = sum(stage[1] for stage in stages.values())
+    # Whatever wasn't spent in external commands was spent in ismap.py itself
+    stages['ismap.py'] = [1, max(0.0, wall_time - command_time), usage.ru_maxrss]
+    return {'exit_status': process.returncode, 'wall_time': wall_time, 'peak_memory_kb': usage.ru_maxrss,
+            'peak_disk': monitor.peak, 'final_disk': directory_size(run_dir), 'stages': stages}
+
+def read_table(table_file):
+    '''
+    Reads an ISMapper _table.txt file, returns a list of rows (lists of values).
+    '''
+
+    rows = []
+    if not os.path.exists(table_file):
+        return rows
+    with open(table_file) as table:
+        table.readline()
+        for line in table:
+            info = line.strip('\n').split('\t')
+            if len(info) > 1:
+                rows.append(info)
+    return rows
+
+def check_typing_calls(calls, insertions, tsd, tolerance):
+    '''
+    Matches the typing calls (orientation, x, y) to the inserted positions.
+    Returns the inserted positions that were found, the ones that were
+    missed, and any extra calls that don't match an insertion.
+    '''
+
+    found = []
+    missed = []
+    matched = set()
+    for position, orientation in insertions:
+        match = None
+        for index, call in enumerate(calls):
+            if call[1] == orientation and abs(int(call[2]) - position) <= tolerance and abs(int(call[3]) - (position + tsd)) <= tolerance:
+                match = index
+                break
+        if match is None:
+            missed.append([position, orientation])
+        else:
+            matched.add(match)
+            found.append([position, orientation])
+    extra = [call for index, call in enumerate(calls) if index not in matched]
+    return found, missed, extra
+
+def check_improvement_calls(calls, insertions):
+    '''
+    Each insertion breaks the assembly between contig_i and contig_i+1,
+    so both contigs should have an end hit.
+    Returns the insertions that were found and the ones that were missed.
+    '''
+
+    contigs_hit = set(call[0] for call in calls)
+    found = []
+    missed = []
+    for index, insertion in enumerate(insertions):
+        if 'contig_' + str(index + 1) in contigs_hit and 'contig_' + str(index + 2) in contigs_hit:
+            found.append(list(insertion))
+        else:
+            missed.append(list(insertion))
+    return found, missed
+
+def format_size(size):
+    return '{:.1f} MB'.format(size / 1024.0 / 1024.0)
+
+def print_report(report):
+    '''
+    Prints a summary of the benchmark runs.
+    '''
+
+    print '\nscale\truntype\tpairs\twall (s)\tpeak memory\tpeak disk\tfinal disk\tfound\tmissed\textra'
+    for run in report['runs']:
+        print '\t'.join([run['scale'], run['runtype'], str(run['read_pairs']), '{:.1f}'.format(run['wall_time']),
+            format_size(run['peak_memory_kb'] * 1024), format_size(run['peak_disk']), format_size(run['final_disk']),
+            str(len(run['found'])), str(len(run['missed'])), str(len(run.get('extra', [])))])
+    for run in report['runs']:
+        print '\nStages for ' + run['runtype'] + ' at ' + run['scale'] + ':'
+        print 'stage\tcommands\ttime (s)\tpeak memory'
+        for stage, (count, seconds, memory) in sorted(run['stages'].items(), key=lambda s: -s[1][1]):
+            print '\t'.join([stage, str(count), '{:.2f}'.format(seconds), format_size(memory * 1024)])
+
+def compare_to_baseline(report, baseline_file):
+    '''
+    Compares the calls of each run against the same run in a previous report.
+    Returns True if all the calls are the same.
+    '''
+
+    with open(baseline_file) as baseline_in:
+        baseline = json.load(baseline_in)
+    baseline_calls = dict(((run['scale'], run['runtype']), run['calls']) for run in baseline['runs'])
+    unchanged = True
+    print ''
+    for run in report['runs']:
+        key = (run['scale'], run['runtype'])
+        if key not in baseline_calls:
+            print 'No baseline for ' + run['runtype'] + ' at ' + run['scale']
+        elif baseline_calls[key] == run['calls']:
+            print 'Calls for ' + run['runtype'] + ' at ' + run['scale'] + ' are unchanged'
+        else:
+            print 'Calls for ' + run['runtype'] + ' at ' + run['scale'] + ' have CHANGED from the baseline'
+            unchanged = False
+    return unchanged
+
+def main():
+
+    args = parse_args()
+    random.seed(args.seed)
+
+    for scale in args.scales:
+        if scale not in SCALES:
+            print 'Unknown scale ' + scale + ', must be one of ' + ' '.join(sorted(SCALES))
+            sys.exit(1)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    output = os.path.abspath(args.output)
+
+    # Insert the query into the reference
+    reference = SeqIO.read(args.reference, 'genbank')
+    reference_seq = str(reference.seq).upper()
+    query_seq = str(SeqIO.read(args.query, 'fasta').seq).upper()
+    insertions = choose_insertions(args, len(reference_seq))
+    genome, pieces = insert_query(reference_seq, query_seq, insertions, args.tsd)
+    print 'Inserted ' + str(len(insertions)) + ' copies of the query: ' + ' '.join(str(p) + ':' + o for p, o in insertions)
+    # The assembly for improvement runs is broken at each insertion
+    assembly = os.path.join(output, 'synthetic_assembly.fasta')
+    with open(assembly, 'w') as assembly_out:
+        for index, piece in enumerate(pieces):
+            assembly_out.write('>contig_' + str(index + 1) + '\n' + piece + '\n')
+
+    report = {'reference': os.path.abspath(args.reference), 'query': os.path.abspath(args.query),
+              'insertions': insertions, 'tsd': args.tsd, 'runs': []}
+    for scale in args.scales:
+        name = 'synthetic' + scale
+        forward = os.path.join(output, name + '_1.fastq.gz')
+        reverse = os.path.join(output, name + '_2.fastq.gz')
+        print 'Simulating reads for scale ' + scale + ' ...'
+        read_pairs = simulate_reads(genome, args.depth * SCALES[scale], args.read_length, args.fragment_size, args.error_rate, forward, reverse)
+        for runtype in args.runtypes:
+            print 'Running ISMapper (' + runtype + ') at scale ' + scale + ' ...'
+            run_dir = os.path.join(output, scale + '_' + runtype + '_' + time.strftime('%d%m%y_%H%M%S'))
+            sample_assembly = os.path.join(output, name + '_assembly.fasta')
+            if runtype == 'improvement' and not os.path.exists(sample_assembly):
+                os.symlink(assembly, sample_assembly)
+            run = run_ismap(args, runtype, run_dir, name, [forward, reverse], args.reference, sample_assembly)
+            run.update({'scale': scale, 'runtype': runtype, 'read_pairs': read_pairs})
+            calls = []
+            for table_file in sorted(os.listdir(run_dir)):
+                if table_file.endswith('_table.txt'):
+                    calls += read_table(os.path.join(run_dir, table_file))
+            if runtype == 'typing':
+                run['calls'] = [call[1:6] for call in calls]
+                run['found'], run['missed'], run['extra'] = check_typing_calls(calls, insertions, args.tsd, args.tolerance)
+            else:
+                run['calls'] = [call[:4] for call in calls]
+                run['found'], run['missed'] = check_improvement_calls(calls, insertions)
+            report['runs'].append(run)
+
+    print_report(report)
+    with open(os.path.join(output, 'benchmark_report.json'), 'w') as report_out:
+        json.dump(report, report_out, indent=1)
+    print '\nReport written to ' + os.path.join(output, 'benchmark_report.json')
+
+    failed = [result for result in report['runs'] if result['exit_status'] != 0 or result['missed']]
+    if args.baseline and not compare_to_baseline(report, args.baseline):
+        failed.append('baseline')
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
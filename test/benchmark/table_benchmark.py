@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+
+# Scaling benchmark for compiled_table.py and binary_table.py.
+#
+# Synthesises a reference genome carrying a few copies of the IS query and
+# the _table.txt (or _table.hits) files of N isolates, then times the table
+# compilation in each mode (one process, --processes, --max_memory) and the
+# conversion of the compiled table to a binary table, at several scales.
+# Isolates share hit sites the way real cohorts do: a few sites are found in
+# most isolates and many in only a few. Each hit is jittered within --gap of
+# its site, and a share of the calls are uncertain (?) or imprecise (*).
+# Reports the time and peak memory of each step, the time of each phase of
+# compiled_table.py (from its "Time taken" checkpoints), and how the time of
+# each step grows with the number of hits, so a change that makes
+# check_ranges, final_ranges_check or the writers scale worse shows up.
+#
+# Example:
+#   table_benchmark.py --scales 100x50 1000x200 10000x500 --output table_bench_out
+
+import os, sys, re, json, math, random, time, threading
+from argparse import ArgumentParser
+from subprocess import Popen, STDOUT
+from Bio import SeqIO
+from Bio import SeqFeature
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.Alphabet import generic_dna
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCHMARK_DIR, '..', '..', 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+from hit_records import hit_record, write_hits
+
+# Extra compiled_table.py options for each compile mode
+MODES = {'serial': lambda args: [],
+         'processes': lambda args: ['--processes', str(args.processes)],
+         'max_memory': lambda args: ['--max_memory', str(args.max_memory)]}
+# Phases of compiled_table.py, in the order of its "Time taken" checkpoints
+PHASES = ['reference', 'collate', 'flanking genes', 'write']
+# Steps whose time is compared against the baseline need to have
+# slowed down by more than this many seconds as well
+MIN_SLOWDOWN_SECONDS = 1.0
+
+def parse_args():
+    '''
+    Parse the input arguments, use -h for help.
+    '''
+
+    parser = ArgumentParser(description='Scaling benchmark for compiled_table.py and binary_table.py')
+    # Inputs
+    parser.add_argument('--query', type=str, required=False, default=os.path.join(BENCHMARK_DIR, '..', 'inputs', 'ISSsu3.fasta'), help='IS query (default test/inputs/ISSsu3.fasta)')
+    parser.add_argument('--genome_size', type=int, required=False, default=1000000, help='Size of the synthetic reference genome (default 1000000)')
+    parser.add_argument('--known_sites', type=int, required=False, default=5, help='Number of copies of the query in the reference, shared by most isolates (default 5)')
+    # Synthetic tables
+    parser.add_argument('--scales', nargs='+', type=str, required=False, default=['100x50', '1000x200'], help='Scales to run, as ISOLATESxSITES, the number of isolates and of novel hit sites among them (default 100x50 1000x200)')
+    parser.add_argument('--hits_per_isolate', type=float, required=False, default=20, help='Mean number of hits in each isolate (default 20)')
+    parser.add_argument('--no_hits', type=float, required=False, default=0.02, help='Fraction of isolates without any hits (default 0.02)')
+    parser.add_argument('--uncertain', type=float, required=False, default=0.15, help='Fraction of calls that are uncertain (?) (default 0.15)')
+    parser.add_argument('--imprecise', type=float, required=False, default=0.1, help='Fraction of novel calls that are imprecise (*) (default 0.1)')
+    parser.add_argument('--gap', type=int, required=False, default=10, help='--gap for compiled_table.py, hits are jittered within it of their site (default 10)')
+    parser.add_argument('--format', type=str, required=False, default='txt', choices=['txt', 'hits'], help='Isolate tables to compile, _table.txt or binary _table.hits (default txt)')
+    parser.add_argument('--seed', type=int, required=False, default=1, help='Seed for the random number generator (default 1)')
+    # Running
+    parser.add_argument('--modes', nargs='+', type=str, required=False, default=['serial', 'processes', 'max_memory'], help='compiled_table.py modes to run: serial, processes and/or max_memory (default all three)')
+    parser.add_argument('--processes', type=int, required=False, default=4, help='--processes for the processes mode (default 4)')
+    parser.add_argument('--max_memory', type=int, required=False, default=256, help='--max_memory (MB) for the max_memory mode (default 256)')
+    parser.add_argument('--timeout', type=float, required=False, help='Stop any step that takes longer than this many seconds, and record it as timed out')
+    parser.add_argument('--profile', action='store_true', required=False, help='Also save the cProfile stats and memory use of each step (--profile of the scripts) in its run directory')
+    # Output
+    parser.add_argument('--output', type=str, required=True, help='Directory for the synthetic data, compiled tables and benchmark report')
+    parser.add_argument('--baseline', type=str, required=False, help='Benchmark report (json) from a previous run to compare the times against')
+    parser.add_argument('--slowdown', type=float, required=False, default=1.5, help='Report a step as slower than the baseline if it takes this many times as long (default 1.5)')
+
+    return parser.parse_args()
+
+def parse_scale(scale):
+    '''
+    Returns the number of isolates and sites of a scale, eg: 1000x200.
+    '''
+
+    m = re.match('^([0-9]+)x([0-9]+)$', scale)
+    if not m:
+        print 'Unknown scale ' + scale + ', must be ISOLATESxSITES (eg: 1000x200)'
+        sys.exit(1)
+    return int(m.group(1)), int(m.group(2))
+
+def random_sequence(length):
+    return ''.join(random.choice('ACGT') for i in range(length))
+
+def make_reference(reference_gbk, query_seq, genome_size, known_sites):
+    '''
+    Writes a synthetic reference genbank, with copies of the query
+    evenly spread along it (alternating orientation) and a CDS every kb.
+    Returns the (x, y, orientation) of each copy of the query.
+    '''
+
+    spacing = genome_size // (known_sites + 1)
+    pieces = []
+    copies = []
+    length = 0
+    for copy in range(known_sites):
+        background = random_sequence(spacing)
+        pieces.append(background)
+        length += len(background)
+        orientation = 'FR'[copy % 2]
+        if orientation == 'F':
+            pieces.append(query_seq)
+        else:
+            pieces.append(str(Seq(query_seq, generic_dna).reverse_complement()))
+        copies.append((length + 1, length + len(query_seq), orientation))
+        length += len(query_seq)
+    pieces.append(random_sequence(genome_size - length))
+    record = SeqRecord(Seq(''.join(pieces), generic_dna), id='synthetic', name='synthetic', description='synthetic reference for table_benchmark.py')
+    for index, start in enumerate(range(100, genome_size - 1000, 1000)):
+        qualifiers = {'locus_tag': ['SYN_' + str(index).zfill(5)], 'product': ['hypothetical protein ' + str(index)]}
+        location = SeqFeature.FeatureLocation(start, start + 900, strand=1 if index % 2 == 0 else -1)
+        record.features.append(SeqFeature.SeqFeature(location, type='CDS', qualifiers=qualifiers))
+    SeqIO.write(record, reference_gbk, 'genbank')
+    return copies
+
+def make_sites(copies, novel_sites, genome_size, gap, hits_per_isolate):
+    '''
+    Returns the hit sites shared among the isolates, as
+    (x, y, orientation, known, frequency). The query copies in the
+    reference are known sites found in most isolates, the novel sites
+    are spread along the genome and most are found in only a few
+    isolates. Frequencies are scaled to give hits_per_isolate hits
+    to an isolate on average.
+    '''
+
+    sites = []
+    for x, y, orientation in copies:
+        sites.append([x, y, orientation, True, random.uniform(0.7, 1.0)])
+    known_hits = sum(site[4] for site in sites)
+    # Novel sites are kept apart from each other and the known sites
+    slot = genome_size // max(1, novel_sites)
+    weights = [random.paretovariate(1.2) for site in range(novel_sites)]
+    frequencies = [0.0] * novel_sites
+    # Capping the most common sites at 1 loses some hits, so rescale
+    # the rest until the mean is (nearly) reached
+    for attempt in range(20):
+        missing = hits_per_isolate - known_hits - sum(frequencies)
+        uncapped = sum(weight for weight, frequency in zip(weights, frequencies) if frequency < 1.0)
+        if missing < 0.01 * hits_per_isolate or uncapped == 0:
+            break
+        frequencies = [min(1.0, frequency + weight * missing / uncapped) if frequency < 1.0 else frequency for weight, frequency in zip(weights, frequencies)]
+    for index, frequency in enumerate(frequencies):
+        x = index * slot + random.randint(4 * gap + 100, max(4 * gap + 100, slot - 4 * gap - 100))
+        if any(abs(x - site[0]) < 4 * gap + 100 or abs(x - site[1]) < 4 * gap + 100 for site in sites if site[3]):
+            x += 8 * gap + 200
+        # Novel hits overlap by the length of the target site duplication
+        sites.append([x, x - random.randint(5, 9), random.choice('FR'), False, frequency])
+    return sites
+
+def hit_call(known, uncertain, imprecise):
+    '''
+    Returns a random call for a hit, at a known or a novel site.
+    '''
+
+    if random.random() < uncertain:
+        return 'Known?' if known else 'Novel?'
+    if known:
+        return 'Known'
+    if random.random() < imprecise:
+        return 'Novel*'
+    return 'Novel'
+
+def write_isolate_tables(table_dir, isolates, sites, args):
+    '''
+    Writes the _table.txt and _table.hits files of each synthetic isolate.
+    Returns the list of tables in --format and the total number of hits.
+    '''
+
+    header = ['region', 'orientation', 'x', 'y', 'gap', 'call', 'Percent_ID', 'Percent_Cov', 'left_gene', 'left_strand', 'left_distance', 'right_gene', 'right_strand', 'right_distance', 'functional_prediction']
+    os.makedirs(table_dir)
+    tables = []
+    total_hits = 0
+    jitter = args.gap // 2
+    for isolate in range(isolates):
+        prefix = os.path.join(table_dir, 'isolate' + str(isolate).zfill(len(str(isolates))))
+        rows = []
+        hits = []
+        if random.random() >= args.no_hits:
+            for x, y, orientation, known, frequency in sites:
+                if random.random() >= frequency:
+                    continue
+                shift = random.randint(-jitter, jitter)
+                call = hit_call(known, args.uncertain, args.imprecise)
+                if known:
+                    row = [orientation, str(x + shift), str(y + shift), str(y - x + 1), call, '%.3f' % random.uniform(98, 100), '100.00']
+                else:
+                    row = [orientation, str(x + shift), str(y + shift), str(y - x), call, '', '']
+                rows.append(row + ["['gene']", '1', '100', "['gene']", '-1', '100', ''])
+                hits.append(hit_record(*(row + [-1, -1])))
+        with open(prefix + '_table.txt', 'w') as table:
+            table.write('\t'.join(header) + '\n')
+            for region, row in enumerate(rows, 1):
+                table.write('region_' + str(region) + '\t' + '\t'.join(row) + '\n')
+            if len(rows) == 0:
+                table.write('No hits found')
+        write_hits(prefix + '_table.hits', hits)
+        tables.append(prefix + '_table.' + args.format)
+        total_hits += len(rows)
+    return tables, total_hits
+
+def run_step(command, log_file, timeout=None):
+    '''
+    Runs a command with its output going to log_file.
+    Returns its exit status, wall time and peak memory in kb.
+    '''
+
+    with open(log_file, 'w') as log:
+        start_time = time.time()
+        process = Popen(command, stdout=log, stderr=STDOUT)
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, process.kill)
+            timer.start()
+        pid, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.time() - start_time
+        if timer:
+            timer.cancel()
+    if os.WIFSIGNALED(status):
+        exit_status = -os.WTERMSIG(status)
+    else:
+        exit_status = os.WEXITSTATUS(status)
+    return {'exit_status': exit_status, 'wall_time': wall_time, 'peak_memory_kb': usage.ru_maxrss,
+            'timed_out': bool(timeout) and exit_status != 0 and wall_time >= timeout}
+
+def read_phases(log_file):
+    '''
+    Returns the time of each phase of compiled_table.py (see PHASES),
+    from the elapsed times it prints at each checkpoint.
+    '''
+
+    checkpoints = []
+    with open(log_file) as log:
+        for line in log:
+            m = re.match('^(Time taken:|Table compilation finished in) ([0-9.]+)', line)
+            if m:
+                checkpoints.append(float(m.group(2)))
+    phases = {}
+    previous = 0.0
+    for phase, checkpoint in zip(PHASES, checkpoints):
+        phases[phase] = checkpoint - previous
+        previous = checkpoint
+    return phases
+
+def run_scale(args, scale, output, reference_gbk):
+    '''
+    Writes the isolate tables for a scale and runs every step on them.
+    Returns the runs of the scale.
+    '''
+
+    isolates, novel_sites = parse_scale(scale)
+    scale_dir = os.path.join(output, scale)
+    print 'Writing ' + str(isolates) + ' isolate tables with ' + str(novel_sites) + ' novel sites for scale ' + scale + ' ...'
+    sites = make_sites(args.copies, novel_sites, args.genome_size, args.gap, args.hits_per_isolate)
+    tables, total_hits = write_isolate_tables(os.path.join(scale_dir, 'tables'), isolates, sites, args)
+    print 'Wrote ' + str(total_hits) + ' hits'
+    runs = []
+    for mode in args.modes:
+        run_dir = os.path.join(scale_dir, mode)
+        os.makedirs(run_dir)
+        compiled = os.path.join(run_dir, 'compiled_table.txt')
+        binary = os.path.join(run_dir, 'binary_table.csv')
+        profile_args = ['--profile', os.path.join(run_dir, 'profile')] if args.profile else []
+        steps = [('compile', [sys.executable, os.path.join(SCRIPTS_DIR, 'compiled_table.py'), '--tables'] + tables +
+                    ['--reference_gbk', reference_gbk, '--seq', os.path.abspath(args.query), '--gap', str(args.gap), '--output', compiled] + MODES[mode](args)),
+                 ('binary', [sys.executable, os.path.join(SCRIPTS_DIR, 'binary_table.py'), '--table', compiled, '--output', binary])]
+        for step, command in steps:
+            print 'Running ' + step + ' (' + mode + ') at scale ' + scale + ' ...'
+            sys.stdout.flush()
+            log_file = os.path.join(run_dir, step + '.log')
+            run = run_step(command + profile_args, log_file, args.timeout)
+            run.update({'scale': scale, 'isolates': isolates, 'sites': len(sites), 'hits': total_hits, 'mode': mode, 'step': step})
+            if step == 'compile':
+                run['phases'] = read_phases(log_file)
+                if os.path.exists(compiled):
+                    with open(compiled) as table:
+                        run['positions'] = len(table.readline().split('\t')) - 1
+            runs.append(run)
+            if run['exit_status'] != 0:
+                print step + ' (' + mode + ') failed at scale ' + scale + ', see ' + log_file
+                break
+    # --processes and --max_memory merge the hits the same way, so must
+    # give the same table (one process merges in the order of the tables)
+    tables = [os.path.join(scale_dir, mode, 'compiled_table.txt') for mode in ['processes', 'max_memory'] if mode in args.modes]
+    if len(tables) == 2 and all(os.path.exists(table) for table in tables):
+        with open(tables[0]) as processes_table, open(tables[1]) as max_memory_table:
+            if processes_table.read() != max_memory_table.read():
+                print 'The processes and max_memory tables differ at scale ' + scale
+                args.mismatches.append(scale)
+    return runs
+
+def growth(runs):
+    '''
+    Returns how the time of each step, and of each phase of the compile
+    step, grows with the number of hits, as the exponent k of
+    time ~ hits^k between consecutive scales.
+    key = 'mode step', value = list of [from scale, to scale, k].
+    '''
+
+    timings = {}
+    for run in runs:
+        if run['exit_status'] != 0:
+            continue
+        timings.setdefault(run['mode'] + ' ' + run['step'], []).append((run['hits'], run['scale'], run['wall_time']))
+        for phase, phase_time in run.get('phases', {}).items():
+            timings.setdefault(run['mode'] + ' ' + run['step'] + ' (' + phase + ')', []).append((run['hits'], run['scale'], phase_time))
+    exponents = {}
+    for key, times in timings.items():
+        times = sorted(times)
+        for (smaller_hits, smaller, smaller_time), (larger_hits, larger, larger_time) in zip(times, times[1:]):
+            # Phases too quick to time can't be compared
+            if smaller_hits == 0 or larger_hits == smaller_hits or smaller_time < 0.01 or larger_time < 0.01:
+                continue
+            k = math.log(larger_time / smaller_time) / math.log(float(larger_hits) / smaller_hits)
+            exponents.setdefault(key, []).append([smaller, larger, k])
+    return exponents
+
+def format_size(size):
+    return '{:.1f} MB'.format(size / 1024.0 / 1024.0)
+
+def print_report(report):
+    '''
+    Prints a summary of the benchmark runs.
+    '''
+
+    print '\nscale\tisolates\thits\tmode\tstep\twall (s)\tpeak memory\t' + '\t'.join(PHASES) + '\tpositions'
+    for run in report['runs']:
+        wall_time = '{:.2f}'.format(run['wall_time'])
+        if run['timed_out']:
+            wall_time = '>' + wall_time
+        elif run['exit_status'] != 0:
+            wall_time = 'failed'
+        phases = ['{:.2f}'.format(run['phases'][phase]) if phase in run.get('phases', {}) else '' for phase in PHASES]
+        print '\t'.join([run['scale'], str(run['isolates']), str(run['hits']), run['mode'], run['step'], wall_time,
+            format_size(run['peak_memory_kb'] * 1024)] + phases + [str(run.get('positions', ''))])
+    print '\nGrowth of time with the number of hits (time ~ hits^k):'
+    print 'step\tscales\tk'
+    for step, exponents in sorted(report['growth'].items()):
+        for smaller, larger, k in exponents:
+            print '\t'.join([step, smaller + ' -> ' + larger, '{:.2f}'.format(k)])
+
+def compare_to_baseline(report, baseline_file, slowdown):
+    '''
+    Compares the time of each step against the same step in a previous
+    report. Returns True if no step is slowdown times slower.
+    '''
+
+    with open(baseline_file) as baseline_in:
+        baseline = json.load(baseline_in)
+    baseline_runs = dict(((run['scale'], run['mode'], run['step']), run) for run in baseline['runs'])
+    unchanged = True
+    print ''
+    for run in report['runs']:
+        key = (run['scale'], run['mode'], run['step'])
+        name = run['step'] + ' (' + run['mode'] + ') at ' + run['scale']
+        if key not in baseline_runs:
+            print 'No baseline for ' + name
+            continue
+        before = baseline_runs[key]['wall_time']
+        if run['exit_status'] != 0:
+            print name + ' FAILED, took {:.2f} s in the baseline'.format(before)
+            unchanged = False
+        elif run['wall_time'] > before * slowdown and run['wall_time'] - before > MIN_SLOWDOWN_SECONDS:
+            print name + ' is SLOWER than the baseline: {:.2f} s, was {:.2f} s'.format(run['wall_time'], before)
+            unchanged = False
+        else:
+            print name + ': {:.2f} s, was {:.2f} s'.format(run['wall_time'], before)
+    return unchanged
+
+def main():
+
+    args = parse_args()
+    random.seed(args.seed)
+
+    for scale in args.scales:
+        parse_scale(scale)
+    for mode in args.modes:
+        if mode not in MODES:
+            print 'Unknown mode ' + mode + ', must be one of ' + ' '.join(sorted(MODES))
+            sys.exit(1)
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    # Each benchmark gets its own directory, as compiled_table.py
+    # writes the fasta and BLAST database next to the reference
+    output = os.path.join(os.path.abspath(args.output), 'tables_' + time.strftime('%d%m%y_%H%M%S'))
+    os.makedirs(output)
+
+    print 'Writing synthetic reference ...'
+    query_seq = str(SeqIO.read(args.query, 'fasta').seq).upper()
+    reference_gbk = os.path.join(output, 'reference.gbk')
+    args.mismatches = []
+    args.copies = make_reference(reference_gbk, query_seq, args.genome_size, args.known_sites)
+
+    report = {'query': os.path.abspath(args.query), 'genome_size': args.genome_size, 'known_sites': args.known_sites,
+              'gap': args.gap, 'format': args.format, 'runs': []}
+    for scale in args.scales:
+        report['runs'] += run_scale(args, scale, output, reference_gbk)
+    report['growth'] = growth(report['runs'])
+    report['mismatches'] = args.mismatches
+
+    print_report(report)
+    report_file = os.path.join(os.path.abspath(args.output), 'table_benchmark_report.json')
+    with open(report_file, 'w') as report_out:
+        json.dump(report, report_out, indent=1)
+    print '\nReport written to ' + report_file
+
+    failed = [run for run in report['runs'] if run['exit_status'] != 0] + args.mismatches
+    if args.baseline and not compare_to_baseline(report, args.baseline, args.slowdown):
+        failed.append('baseline')
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()